@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+This script builds the local first-tier index used by the scheme analysis
+agent. Point it at the folder of scheme and loan PDFs that were imported into
+the Vertex RAG corpus; it extracts and chunks the text, then writes a BM25
+index (and, optionally, an embedding matrix) next to the agent code so that
+`deploy.py` ships it with the agent.
+
+Requires `pypdf`. The optional embedding index also requires `numpy` and
+`sentence-transformers`.
+
+Example:
+    python build_scheme_index.py ./scheme_pdfs --uri-prefix gs://one4farmers/schemes/
+"""
+
+import json
+import os
+import sys
+
+import click
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "manager_agent"))
+
+from sub_agents.scheme_analysis_agent.local_index import DEFAULT_INDEX_DIR, build_index
+
+
+def _extract_pdf_text(path: str) -> str:
+    """Extracts the plain text of every page in a PDF."""
+    from pypdf import PdfReader
+
+    reader = PdfReader(path)
+    return "\n".join(page.extract_text() or "" for page in reader.pages)
+
+
+def _chunk_words(text: str, chunk_size: int, overlap: int):
+    """Splits text into overlapping windows of `chunk_size` words."""
+    words = text.split()
+    step = max(chunk_size - overlap, 1)
+    for start in range(0, len(words), step):
+        window = words[start:start + chunk_size]
+        if window:
+            yield " ".join(window)
+        if start + chunk_size >= len(words):
+            break
+
+
+@click.command()
+@click.argument("pdf_folder", type=click.Path(exists=True, file_okay=False))
+@click.option("--out-dir", default=DEFAULT_INDEX_DIR, show_default=True, help="Where to write the index.")
+@click.option("--uri-prefix", default="", help="Prefix for each file name to form its source URI, e.g. gs://bucket/schemes/.")
+@click.option("--source-map", type=click.Path(exists=True, dir_okay=False), help="JSON file mapping PDF file names to source URIs.")
+@click.option("--chunk-size", default=300, show_default=True, help="Chunk size in words.")
+@click.option("--overlap", default=50, show_default=True, help="Overlap between chunks in words.")
+@click.option("--embedding-model", default=None, help="Optional sentence-transformers model for a dense index.")
+@click.option("--invalidate-cache/--keep-cache", default=True, show_default=True,
+              help="Purge the shared scheme retrieval cache, whose entries were built from the old index.")
+def main(pdf_folder, out_dir, uri_prefix, source_map, chunk_size, overlap, embedding_model, invalidate_cache):
+    """Builds the local scheme index from a folder of PDFs."""
+    uri_map = {}
+    if source_map:
+        with open(source_map, "r", encoding="utf-8") as f:
+            uri_map = json.load(f)
+
+    chunks = []
+    for file_name in sorted(os.listdir(pdf_folder)):
+        if not file_name.lower().endswith(".pdf"):
+            continue
+        source = uri_map.get(file_name) or f"{uri_prefix}{file_name}"
+        click.echo(f"Extracting text from {file_name}...")
+        text = _extract_pdf_text(os.path.join(pdf_folder, file_name))
+        for chunk_text in _chunk_words(text, chunk_size, overlap):
+            chunks.append({"text": chunk_text, "source": source})
+
+    if not chunks:
+        raise click.ClickException(f"No text could be extracted from PDFs in {pdf_folder}.")
+
+    embeddings = None
+    if embedding_model:
+        from sentence_transformers import SentenceTransformer
+
+        click.echo(f"Embedding {len(chunks)} chunks with {embedding_model}...")
+        model = SentenceTransformer(embedding_model)
+        embeddings = model.encode([c["text"] for c in chunks], normalize_embeddings=True, show_progress_bar=True)
+
+    metadata = build_index(chunks, out_dir, embeddings=embeddings, embedding_model=embedding_model)
+    click.echo(
+        f"Wrote {len(chunks)} chunks from {len(metadata['sources'])} documents "
+        f"({len(metadata['terms'])} terms) to {out_dir}. Build id: {metadata['build_id']}"
+    )
+
+    if invalidate_cache:
+        # Entries for the old build id can never be hit again; this removes them.
+        from sub_agents.scheme_analysis_agent.retrieval_cache import retrieval_cache
+
+        try:
+            deleted = retrieval_cache.invalidate(all_versions=True)
+            click.echo(f"Deleted {deleted} shared scheme retrieval cache entries.")
+        except Exception as e:
+            click.echo(f"Warning: Could not invalidate the scheme retrieval cache: {e}", err=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -153,6 +153,15 @@ try:
         )
         click.echo(f"New agent '{display_name}' created successfully.")
 
+    # Purge shared retrieval results cached for any other corpus version than the deployed one.
+    try:
+        from sub_agents.scheme_analysis_agent import retrieval_cache as scheme_cache
+        if env_vars and env_vars.get('SCHEME_CORPUS_VERSION'):
+            scheme_cache.CORPUS_VERSION = env_vars['SCHEME_CORPUS_VERSION']
+        scheme_cache.retrieval_cache.invalidate()
+    except Exception as e:
+        click.echo(f'Warning: Could not invalidate the scheme retrieval cache: {e}')
+
 finally:
     click.echo(f'Cleaning up the temp folder: {temp_folder}')
     if os.path.exists(temp_folder):
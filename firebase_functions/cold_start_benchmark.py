@@ -0,0 +1,129 @@
+"""
+Cold-start benchmark for the Firebase functions.
+
+Each endpoint is measured in a fresh Python process, as on a new instance:
+the time to import `main.py`, the time of the endpoint's first request, and
+which heavy SDKs (Vertex AI, Speech-to-Text, Translate) were loaded by each step.
+
+Requests are served in-process, so Firestore must be reachable: run against
+the emulator (`firebase emulators:start --only firestore` and
+`FIRESTORE_EMULATOR_HOST=localhost:8080`) for reproducible numbers. Endpoints
+that call the agent need Google Cloud credentials and are skipped unless
+`--include-ai` is passed.
+
+Usage:
+    python cold_start_benchmark.py [--runs 5] [--include-ai] [--json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+FUNCTIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "functions")
+
+HEAVY_MODULES = {
+    "vertexai": "vertexai",
+    "speech": "google.cloud.speech",
+    "translate": "google.cloud.translate_v2",
+}
+
+# (function name, method, query string, JSON body, needs Vertex AI)
+# list_products and list_user_products read the user's agent session.
+ENDPOINTS = [
+    ("list_products", "GET", "user_id=benchmark-user", None, True),
+    ("list_orders", "GET", "user_id=benchmark-user", None, False),
+    ("list_user_products", "GET", "user_id=benchmark-user", None, True),
+    ("get_agent_dashboard_orders", "GET", "agent_id=benchmark-agent", None, False),
+    ("getCommunityMessages", "GET", "limit=20", None, False),
+    ("searchCommunityMessages", "GET", "q=tomato", None, False),
+    ("getChatRooms", "GET", "user_id=benchmark-user", None, False),
+    ("sendCommunityMessage", "POST", "", {"senderId": "benchmark-user", "senderName": "Benchmark", "text": "hello"}, False),
+    ("get_or_create_session", "POST", "", {"user_id": "benchmark-user"}, True),
+    ("stream_query_agent", "POST", "", {"user_id": "benchmark-user", "message": "hello"}, True),
+]
+
+# Runs in the child process. Prints one JSON line with the measurements.
+_CHILD = r"""
+import json, sys, time
+name, method, query, body = sys.argv[1], sys.argv[2], sys.argv[3], json.loads(sys.argv[4])
+heavy = json.loads(sys.argv[5])
+
+def loaded():
+    return sorted(label for label, module in heavy.items() if module in sys.modules)
+
+start = time.perf_counter()
+import main
+import_ms = (time.perf_counter() - start) * 1000
+after_import = loaded()
+
+from flask import Request
+from werkzeug.test import EnvironBuilder
+environ = EnvironBuilder(path="/", method=method, query_string=query, json=body).get_environ()
+start = time.perf_counter()
+response = getattr(main, name)(Request(environ))
+request_ms = (time.perf_counter() - start) * 1000
+print(json.dumps({
+    "import_ms": import_ms,
+    "first_request_ms": request_ms,
+    "status": response.status_code,
+    "loaded_on_import": after_import,
+    "loaded_on_request": [m for m in loaded() if m not in after_import],
+}))
+"""
+
+
+def measure(name: str, method: str, query: str, body) -> dict:
+    result = subprocess.run(
+        [sys.executable, "-c", _CHILD, name, method, query, json.dumps(body), json.dumps(HEAVY_MODULES)],
+        cwd=FUNCTIONS_DIR, capture_output=True, text=True, timeout=300,
+    )
+    lines = [line for line in result.stdout.splitlines() if line.startswith("{")]
+    if result.returncode != 0 or not lines:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "no output")
+    return json.loads(lines[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Fresh processes per endpoint.")
+    parser.add_argument("--include-ai", action="store_true", help="Also measure the endpoints that call the agent.")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    args = parser.parse_args()
+
+    report = []
+    for name, method, query, body, needs_ai in ENDPOINTS:
+        if needs_ai and not args.include_ai:
+            continue
+        try:
+            runs = [measure(name, method, query, body) for _ in range(args.runs)]
+        except Exception as e:
+            report.append({"endpoint": name, "error": str(e)})
+            continue
+        report.append({
+            "endpoint": name,
+            "import_ms": statistics.median(r["import_ms"] for r in runs),
+            "first_request_ms": statistics.median(r["first_request_ms"] for r in runs),
+            "status": runs[-1]["status"],
+            "loaded_on_import": runs[-1]["loaded_on_import"],
+            "loaded_on_request": runs[-1]["loaded_on_request"],
+        })
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{'endpoint':<28}{'import ms':>11}{'1st req ms':>12}{'status':>8}  heavy SDKs (import / request)")
+    for row in report:
+        if "error" in row:
+            print(f"{row['endpoint']:<28}  error: {row['error']}")
+            continue
+        print(
+            f"{row['endpoint']:<28}{row['import_ms']:>11.0f}{row['first_request_ms']:>12.0f}{row['status']:>8}  "
+            f"{','.join(row['loaded_on_import']) or '-'} / {','.join(row['loaded_on_request']) or '-'}"
+        )
+    print(f"Medians of {args.runs} fresh processes per endpoint.")
+
+
+if __name__ == "__main__":
+    main()
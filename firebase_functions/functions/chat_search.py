@@ -0,0 +1,146 @@
+"""
+Multilingual full-text search over community chat messages.
+
+Each message stores the unique search tokens of its original text and its
+translations in a `searchTokens` array. Firestore indexes array fields
+automatically, so that index is the inverted index: it is maintained
+incrementally as messages are written. A search counts the messages that
+contain each query token, reads the newest messages containing the rarest
+one (the anchor) in batches of `SEARCH_CANDIDATE_LIMIT`, and ranks each batch
+in memory by the inverse document frequency of the tokens it matches. Page
+tokens carry the anchor and a cursor, so paging continues past the first batch.
+
+Tokenization handles Indic scripts: vowel signs and viramas are kept inside
+words, zero-width joiners are removed and text is NFKC-normalized, so the
+same Hindi or Tamil word always yields the same token.
+"""
+import base64
+import json
+import math
+import re
+import unicodedata
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Latin word characters plus the Indic script blocks (Devanagari to Sinhala),
+# so that vowel signs do not split Hindi or Tamil words apart.
+_TOKEN_RE = re.compile(r"[\w\u0900-\u0DFF]+")
+_ZERO_WIDTH_RE = re.compile(r"[\u200b-\u200d\ufeff]")
+
+STOP_WORDS = frozenset("""
+a about all am an and any are as at be been but by can could do does for from
+has have how i if in into is it its me my of on or our so than that the their
+them then there these they this to us was we what when where which who why will
+with would you your talked talk said say anyone someone
+का की के को में से है हैं और पर भी ने था थे यह वह कि तो ही एक
+ஒரு மற்றும் இது அது என்று உள்ள இந்த அந்த
+""".split())
+
+# Each query token costs one count aggregation per search, so longer queries are cut off.
+MAX_QUERY_TOKENS = 10
+# A message stores at most this many tokens.
+MAX_MESSAGE_TOKENS = 300
+# Results are ranked in batches of this many messages containing the anchor token.
+SEARCH_CANDIDATE_LIMIT = 200
+# Scores lose half of their recency bonus every this many days.
+RECENCY_HALF_LIFE_DAYS = 30
+
+
+def _stem(token: str) -> str:
+    """A very basic stemmer so 'bollworms' and 'bollworm' share a token."""
+    if token.endswith("ies") and len(token) > 4:
+        return token[:-3] + "y"
+    if token.endswith("s") and not token.endswith("ss") and len(token) > 3 and token.isascii():
+        return token[:-1]
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    """Normalizes, splits and stems text, dropping stop-words and one-letter tokens."""
+    text = _ZERO_WIDTH_RE.sub("", unicodedata.normalize("NFKC", text or "")).lower()
+    return [
+        _stem(token)
+        for token in _TOKEN_RE.findall(text)
+        if token not in STOP_WORDS and len(token) > 1
+    ]
+
+
+def message_search_tokens(texts: Iterable[str]) -> List[str]:
+    """Returns the unique search tokens of a message's text in every language."""
+    tokens = []
+    seen = set()
+    for text in texts:
+        for token in tokenize(text):
+            if token not in seen:
+                seen.add(token)
+                tokens.append(token)
+    return tokens[:MAX_MESSAGE_TOKENS]
+
+
+def query_tokens(query: str) -> List[str]:
+    """Returns the unique tokens of a search query, longest first, capped at MAX_QUERY_TOKENS."""
+    unique = list(dict.fromkeys(tokenize(query)))
+    # Longer tokens are usually the more specific ones.
+    return sorted(unique, key=len, reverse=True)[:MAX_QUERY_TOKENS]
+
+
+def choose_anchor(frequencies: Dict[str, int]) -> Optional[str]:
+    """Returns the rarest token that occurs at all, or None if none does."""
+    present = [token for token, count in frequencies.items() if count]
+    return min(present, key=lambda token: frequencies[token]) if present else None
+
+
+def rank_messages(messages: List[dict], tokens: List[str], document_frequency: Optional[Dict[str, int]] = None,
+                  total: Optional[int] = None) -> List[dict]:
+    """
+    Ranks candidate messages by the inverse document frequency of the query
+    tokens they contain, plus a recency bonus. Frequencies are those of the
+    whole room when given, and of the candidate set otherwise.
+    Each message must have 'searchTokens' and may have a 'timestamp'.
+    """
+    if not messages:
+        return []
+    if document_frequency is None:
+        document_frequency = Counter()
+        for message in messages:
+            document_frequency.update(set(message.get('searchTokens') or []) & set(tokens))
+        total = len(messages)
+    total = max(total or 0, len(messages))
+    now = datetime.now(timezone.utc)
+    scored = []
+    for message in messages:
+        matched = set(message.get('searchTokens') or []) & set(tokens)
+        score = sum(math.log(1 + total / max(document_frequency.get(token, 0), 1)) for token in matched)
+        timestamp = message.get('timestamp')
+        if isinstance(timestamp, datetime):
+            age_days = max((now - timestamp).total_seconds() / 86400, 0)
+            score *= 1 + 0.5 ** (age_days / RECENCY_HALF_LIFE_DAYS) * 0.25
+        scored.append((score, len(matched), message))
+    scored.sort(key=lambda item: (item[0], item[1]), reverse=True)
+    return [message for _, _, message in scored]
+
+
+def encode_page_token(anchor: str, after: Optional[Tuple[str, str]], offset: int) -> str:
+    """
+    Encodes a position in a search: the anchor token, the (ISO timestamp,
+    message ID) the current batch starts after, and the offset in the batch.
+    """
+    payload = {"anchor": anchor, "after": list(after) if after else None, "offset": offset}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode("utf-8")).decode("ascii")
+
+
+def decode_page_token(token: str) -> dict:
+    """Decodes a page token into its 'anchor', 'after' and 'offset'. Raises ValueError if it is invalid."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        page = {
+            "anchor": str(payload["anchor"]),
+            "after": (datetime.fromisoformat(payload["after"][0]), str(payload["after"][1])) if payload["after"] else None,
+            "offset": int(payload["offset"]),
+        }
+    except Exception:
+        raise ValueError("Invalid page_token.")
+    if page["offset"] < 0:
+        raise ValueError("Invalid page_token.")
+    return page
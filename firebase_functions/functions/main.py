@@ -1,16 +1,24 @@
-from firebase_functions import https_fn, firestore_fn
-from firebase_functions.options import set_global_options, MemoryOption
-from firebase_admin import initialize_app, firestore, storage, messaging
-from google.cloud import translate_v2 as translate
-from google.cloud import speech
+from firebase_functions import https_fn, firestore_fn, tasks_fn
+from firebase_functions.options import set_global_options, MemoryOption, RetryConfig
+from firebase_admin import initialize_app, firestore, messaging, functions as admin_functions
 
+import base64
+import hashlib
 import os
-import vertexai
-from vertexai import agent_engines, generative_models
-from vertexai.generative_models import Part, Content
+import threading
+import time
 import json
+import math
+import mimetypes
+import re
 import requests
-from datetime import datetime
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from urllib.parse import unquote, urlparse
+from chat_search import SEARCH_CANDIDATE_LIMIT, choose_anchor, decode_page_token, encode_page_token, message_search_tokens, query_tokens, rank_messages
+from responses import json_response
+from translation import TRANSLATION_TARGET_LANGUAGES, translate_text
 
 # --- Custom JSON Encoder ---
 class DateTimeEncoder(json.JSONEncoder):
@@ -30,21 +38,66 @@ PROJECT_ID = os.environ.get("GCP_PROJECT", "valued-mediator-461216-k7")
 LOCATION = os.environ.get("GCP_LOCATION", "us-central1")
 REASONING_ENGINE_ID = os.environ.get("REASONING_ENGINE_ID", "2569752188159000576")
 DATABASE = os.environ.get("FIRESTORE_DATABASE", "one4farmers")
+# Pass Cloud Storage media to the agent by gs:// reference instead of downloading it.
+MEDIA_GCS_PASSTHROUGH = os.environ.get("MEDIA_GCS_PASSTHROUGH", "true").lower() == "true"
+# Media from other hosts is downloaded in chunks, up to this size.
+MAX_MEDIA_BYTES = int(os.environ.get("MAX_MEDIA_BYTES", str(20 * 1024 * 1024)))
+MEDIA_DOWNLOAD_TIMEOUT = (5, 30)  # (connect, read) seconds
+# Field surveys: the most images per request, and how many are analyzed at once.
+FIELD_SURVEY_MAX_IMAGES = int(os.environ.get("FIELD_SURVEY_MAX_IMAGES", "50"))
+FIELD_SURVEY_CONCURRENCY = int(os.environ.get("FIELD_SURVEY_CONCURRENCY", "4"))
+# Survey sessions left behind by a failed delete are removed after this long.
+SURVEY_SESSION_MAX_AGE_SECONDS = int(os.environ.get("SURVEY_SESSION_MAX_AGE_SECONDS", "3600"))
 # --------------------
 
 # Initialize Firebase Admin SDK once in the global scope.
 initialize_app()
 set_global_options(
-    max_instances=10,
+    # With a fixed instance count, throughput scales with the per-instance concurrency below.
+    max_instances=int(os.environ.get("MAX_INSTANCES", "10")),
     memory=MemoryOption.GB_1,
     timeout_sec=300,  # Increase timeout to 5 minutes
 )
 
-# --- Lazy Initialization for Vertex AI Client ---
+# --- Function Groups ---
+# Every function imports this module on a cold start, so the Vertex AI, Speech
+# and Translate SDKs are only imported inside the lazy getters below. Functions
+# that call them, including the marketplace endpoints that read or update the
+# user's agent session, are in the AI group. The others only ever create the
+# Firestore client and get less memory (but a full CPU for fast imports) and
+# a shorter timeout.
+#
+# Each instance serves many requests at once on separate threads, so the
+# clients are created once under a lock and request state is never kept in
+# globals. Concurrency above 1 requires a full CPU. AI requests mostly wait on
+# the agent but may hold downloaded media, so they get a lower limit.
+AI_CONCURRENCY = int(os.environ.get("AI_CONCURRENCY", "10"))
+LIGHT_CONCURRENCY = int(os.environ.get("LIGHT_CONCURRENCY", "80"))
+AI_FUNCTION_OPTIONS = {
+    "memory": MemoryOption.GB_1,
+    "cpu": 1,
+    "concurrency": AI_CONCURRENCY,
+    "timeout_sec": 300,
+    "min_instances": int(os.environ.get("AI_MIN_INSTANCES", "0")),
+}
+LIGHT_FUNCTION_OPTIONS = {
+    "memory": MemoryOption.MB_512,
+    "cpu": 1,
+    "concurrency": LIGHT_CONCURRENCY,
+    "timeout_sec": 60,
+}
+
+# --- Lazy, Thread-Safe Client Initialization ---
+# Each client has its own lock, so a slow Vertex AI connection never blocks
+# Firestore requests. The unlocked check keeps the common path lock-free.
 _remote_app = None
 _db = None
 _translate_client = None
 _speech_client = None
+_remote_app_lock = threading.Lock()
+_db_lock = threading.Lock()
+_translate_client_lock = threading.Lock()
+_speech_client_lock = threading.Lock()
 
 def get_remote_app():
     """
@@ -53,11 +106,15 @@ def get_remote_app():
     """
     global _remote_app
     if _remote_app is None:
-        print("Initializing Vertex AI client for the first time...")
-        engine_resource_name = f"projects/{PROJECT_ID}/locations/{LOCATION}/reasoningEngines/{REASONING_ENGINE_ID}"
-        print(f"Connecting to Reasoning Engine: {engine_resource_name}")
-        _remote_app = agent_engines.get(engine_resource_name)
-        print("Vertex AI client initialized.")
+        with _remote_app_lock:
+            if _remote_app is None:
+                print("Initializing Vertex AI client for the first time...")
+                from vertexai import agent_engines
+
+                engine_resource_name = f"projects/{PROJECT_ID}/locations/{LOCATION}/reasoningEngines/{REASONING_ENGINE_ID}"
+                print(f"Connecting to Reasoning Engine: {engine_resource_name}")
+                _remote_app = agent_engines.get(engine_resource_name)
+                print("Vertex AI client initialized.")
     return _remote_app
 
 
@@ -68,9 +125,11 @@ def get_firestore_client():
     """
     global _db
     if _db is None:
-        print("Initializing Firestore client for the first time...")
-        _db = firestore.Client(project=PROJECT_ID, database=DATABASE)
-        print("Firestore client initialized.")
+        with _db_lock:
+            if _db is None:
+                print("Initializing Firestore client for the first time...")
+                _db = firestore.Client(project=PROJECT_ID, database=DATABASE)
+                print("Firestore client initialized.")
     return _db
 
 def get_translate_client():
@@ -80,9 +139,13 @@ def get_translate_client():
     """
     global _translate_client
     if _translate_client is None:
-        print("Initializing Google Translate client...")
-        _translate_client = translate.Client()
-        print("Google Translate client initialized.")
+        with _translate_client_lock:
+            if _translate_client is None:
+                print("Initializing Google Translate client...")
+                from google.cloud import translate_v2 as translate
+
+                _translate_client = translate.Client()
+                print("Google Translate client initialized.")
     return _translate_client
 
 def get_speech_client():
@@ -92,13 +155,17 @@ def get_speech_client():
     """
     global _speech_client
     if _speech_client is None:
-        print("Initializing Google Speech-to-Text client...")
-        _speech_client = speech.SpeechClient()
-        print("Google Speech-to-Text client initialized.")
+        with _speech_client_lock:
+            if _speech_client is None:
+                print("Initializing Google Speech-to-Text client...")
+                from google.cloud import speech
+
+                _speech_client = speech.SpeechClient()
+                print("Google Speech-to-Text client initialized.")
     return _speech_client
 
 
-@https_fn.on_request()
+@https_fn.on_request(**AI_FUNCTION_OPTIONS)
 def get_or_create_session(req: https_fn.Request) -> https_fn.Response:
     """
     An HTTP endpoint that finds an existing session for a user_id,
@@ -152,12 +219,148 @@ def get_or_create_session(req: https_fn.Request) -> https_fn.Response:
         print(f"An internal error occurred: {e}")
         return https_fn.Response(f"An internal error occurred: {e}", status=500)
 
-@https_fn.on_request()
+def _gcs_uri_from_url(url: str):
+    """
+    Returns the gs:// URI for a Cloud Storage object given as a gs:// URI, a
+    storage.googleapis.com URL or a Firebase Storage download URL, or None
+    for any other URL.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == "gs":
+        return url
+    if parsed.scheme != "https":
+        return None
+    if parsed.netloc in ("storage.googleapis.com", "storage.cloud.google.com"):
+        bucket, _, object_name = parsed.path.lstrip("/").partition("/")
+        return f"gs://{bucket}/{unquote(object_name)}" if bucket and object_name else None
+    if parsed.netloc == "firebasestorage.googleapis.com":
+        # Format: /v0/b/<bucket>/o/<url-encoded object name>
+        segments = parsed.path.split("/")
+        if len(segments) >= 6 and segments[1] == "v0" and segments[2] == "b" and segments[4] == "o":
+            return f"gs://{segments[3]}/{unquote('/'.join(segments[5:]))}"
+    return None
+
+
+def _download_media(url: str):
+    """
+    Downloads media in chunks with a timeout and a size cap.
+    Returns a tuple of (data, content_type). Raises ValueError if the file is too large.
+    """
+    with requests.get(url, stream=True, timeout=MEDIA_DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        content_length = response.headers.get('content-length')
+        if content_length and int(content_length) > MAX_MEDIA_BYTES:
+            raise ValueError(f"Media file is too large ({content_length} bytes). The limit is {MAX_MEDIA_BYTES} bytes.")
+
+        chunks = []
+        total = 0
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            total += len(chunk)
+            if total > MAX_MEDIA_BYTES:
+                raise ValueError(f"Media file is too large. The limit is {MAX_MEDIA_BYTES} bytes.")
+            chunks.append(chunk)
+        return b"".join(chunks), response.headers.get('content-type')
+
+
+def _media_part(url: str, default_mime_type: str, trust_response_type: bool):
+    """
+    Builds a message Part for a media URL. Cloud Storage objects are passed by
+    gs:// reference so the model reads them directly; anything else is downloaded.
+    """
+    from vertexai.generative_models import Part
+
+    gcs_uri = _gcs_uri_from_url(url) if MEDIA_GCS_PASSTHROUGH else None
+    guessed_mime_type = mimetypes.guess_type(urlparse(gcs_uri or url).path)[0]
+
+    if gcs_uri:
+        mime_type = guessed_mime_type or default_mime_type
+        print(f"Passing '{gcs_uri}' to the agent by reference with MIME type '{mime_type}'.")
+        return Part.from_uri(uri=gcs_uri, mime_type=mime_type)
+
+    data, content_type = _download_media(url)
+    mime_type = (content_type if trust_response_type else None) or guessed_mime_type or default_mime_type
+    print(f"Downloaded {len(data)} bytes with MIME type '{mime_type}'.")
+    return Part.from_data(data=data, mime_type=mime_type)
+
+
+def _build_agent_message(request_json: dict):
+    """
+    Builds the agent message from the 'message', 'audio_url' and 'image_url'
+    fields of a request. Returns the message as a dictionary, or None if the
+    request contains none of them.
+    """
+    from vertexai.generative_models import Content, Part
+
+    message_parts = []
+    
+    text_message = request_json.get('message')
+    audio_url = request_json.get('audio_url')
+    image_url = request_json.get('image_url')
+    
+    if audio_url:
+        print(f"Received audio URL: {audio_url}")
+        # The app records .m4a (AAC in an MP4 container), so that is the default.
+        message_parts.append(_media_part(audio_url, default_mime_type="audio/mp4", trust_response_type=False))
+        print("Successfully processed audio URL into a message Part.")
+
+        if not text_message:
+            text_message = "Listen to the audio, understand the user's question, and respond in the language spoken in the audio."
+            print(f"No text message provided with audio. Using default: '{text_message}'")
+
+    if image_url:
+        print(f"Received image URL: {image_url}")
+        message_parts.append(_media_part(image_url, default_mime_type="image/jpeg", trust_response_type=True))
+        print("Successfully processed image URL into a message Part.")
+
+    if text_message:
+        message_parts.append(Part.from_text(text_message))
+        print(f"Added text message: '{text_message}'")
+    
+    if not message_parts:
+        return None
+
+    # --- THIS IS THE FIX: Create a Content object and convert it to a dictionary ---
+    # This matches the `Dict[str, Any]` type expected by the function.
+    return Content(parts=message_parts, role="user").to_dict()
+
+
+def _agent_stream_chunks(event: dict) -> list:
+    """
+    Converts one agent event into the chunks forwarded to a streaming client:
+    text parts, and tool-progress updates for function calls and responses.
+    """
+    chunks = []
+    content = event.get('content') or {}
+    for part in content.get('parts') or []:
+        if part.get('text'):
+            chunks.append({"type": "text", "text": part['text'], "author": event.get('author')})
+        elif part.get('function_call'):
+            chunks.append({"type": "tool_call", "name": part['function_call'].get('name'), "author": event.get('author')})
+        elif part.get('function_response'):
+            chunks.append({"type": "tool_result", "name": part['function_response'].get('name'), "author": event.get('author')})
+    return chunks
+
+
+def _format_stream_chunk(chunk: dict, stream_format: str) -> str:
+    """Serializes a chunk as a Server-Sent Event or as one line of NDJSON."""
+    payload = json.dumps(chunk, cls=DateTimeEncoder)
+    if stream_format == "sse":
+        return f"event: {chunk['type']}\ndata: {payload}\n\n"
+    return payload + "\n"
+
+
+@https_fn.on_request(**AI_FUNCTION_OPTIONS)
 def stream_query_agent(req: https_fn.Request) -> https_fn.Response:
     """
     An HTTP endpoint that queries the agent with either text or audio.
     Expects a JSON body with 'user_id', 'session_id', and either 'message' (text)
     or 'audio_url' (a GCS link to an audio file).
+
+    By default the full response is returned as one JSON body. Set 'stream'
+    (in the body or query string) to "sse" or "ndjson" to receive text parts
+    and tool-progress events as they are produced. Each streamed chunk has a
+    'type' of "text", "tool_call", "tool_result", "done" or "error". If the
+    client disconnects, the agent stream is closed.
     """
     try:
         request_json = req.get_json(silent=True)
@@ -167,67 +370,56 @@ def stream_query_agent(req: https_fn.Request) -> https_fn.Response:
         
         user_id = request_json['user_id']
         session_id = request_json['session_id']
+        stream_format = str(req.args.get("stream") or request_json.get("stream") or "").lower()
+        if stream_format in ("true", "1"):
+            stream_format = "ndjson"
+        if stream_format and stream_format not in ("sse", "ndjson"):
+            return https_fn.Response("Error: 'stream' must be 'sse' or 'ndjson'.", status=400)
         
         # --- Prepare the message for the agent ---
-        message_parts = []
-        
-        text_message = request_json.get('message')
-        audio_url = request_json.get('audio_url')
-        image_url = request_json.get('image_url')
-        
-        if audio_url:
-            print(f"Received audio URL: {audio_url}")
-            response = requests.get(audio_url)
-            response.raise_for_status()
-            audio_data = response.content
-            
-            # Assume the audio is always .m4a (AAC in an MP4 container)
-            mime_type = "audio/mp4"
-            print(f"Using hardcoded MIME type: '{mime_type}' for .m4a file.")
-
-            audio_part = Part.from_data(data=audio_data, mime_type=mime_type)
-            message_parts.append(audio_part)
-            print("Successfully processed audio URL into a message Part.")
-
-            if not text_message:
-                text_message = "Listen to the audio, understand the user's question, and respond in the language spoken in the audio."
-                print(f"No text message provided with audio. Using default: '{text_message}'")
-
-        if image_url:
-            print(f"Received image URL: {image_url}")
-            response = requests.get(image_url)
-            response.raise_for_status()
-            image_data = response.content
-            
-            # Try to get mime_type from headers, default to jpeg
-            mime_type = response.headers.get('content-type', 'image/jpeg')
-            print(f"Inferred MIME type: '{mime_type}' for image.")
-
-            image_part = Part.from_data(data=image_data, mime_type=mime_type)
-            message_parts.append(image_part)
-            print("Successfully processed image URL into a message Part.")
-
-        if text_message:
-            message_parts.append(Part.from_text(text_message))
-            print(f"Added text message: '{text_message}'")
-        
-        if not message_parts:
+        final_message = _build_agent_message(request_json)
+        if final_message is None:
             return https_fn.Response("Error: Please provide a 'message', 'audio_url', or 'image_url'.", status=400)
 
-        # --- THIS IS THE FIX: Create a Content object and convert it to a dictionary ---
-        # This matches the `Dict[str, Any]` type expected by the function.
-        final_message = Content(parts=message_parts, role="user").to_dict()
-
         remote_app = get_remote_app()
 
-        # --- Query the Agent and Collect the Streamed Response ---
         print(f"Streaming query for session '{session_id}'...")
-        full_response_text = ""
-        for event in remote_app.stream_query(
+        agent_events = remote_app.stream_query(
             user_id=user_id,
             session_id=session_id,
             message=final_message, # Send the correctly formatted dictionary
-        ):
+        )
+
+        # --- Streaming mode: forward each part as soon as it arrives ---
+        if stream_format:
+            def generate():
+                try:
+                    for event in agent_events:
+                        for chunk in _agent_stream_chunks(event):
+                            yield _format_stream_chunk(chunk, stream_format)
+                    yield _format_stream_chunk({"type": "done"}, stream_format)
+                except GeneratorExit:
+                    # The server closes the generator when the client disconnects.
+                    print(f"Client disconnected. Cancelling stream for session '{session_id}'.")
+                    raise
+                except Exception as e:
+                    print(f"An error occurred while streaming for session '{session_id}': {e}")
+                    yield _format_stream_chunk({"type": "error", "error": f"An internal error occurred: {e}"}, stream_format)
+                finally:
+                    close = getattr(agent_events, "close", None)
+                    if callable(close):
+                        close()
+
+            mimetype = "text/event-stream" if stream_format == "sse" else "application/x-ndjson"
+            return https_fn.Response(
+                generate(),
+                mimetype=mimetype,
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+
+        # --- Buffered mode: collect the streamed response into one body ---
+        full_response_text = ""
+        for event in agent_events:
             print(f"\n[EVENT]: {event}")
             if event.get('content') and event.get('content').get('parts'):
                 for part in event['content']['parts']:
@@ -239,12 +431,306 @@ def stream_query_agent(req: https_fn.Request) -> https_fn.Response:
         response_data = json.dumps({"response": full_response_text})
         return https_fn.Response(response_data, mimetype="application/json")
 
+    except ValueError as ve:
+        return https_fn.Response(f"Error: {ve}", status=400)
     except Exception as e:
         print(f"An error occurred in stream_query_agent: {e}")
         return https_fn.Response(f"An internal error occurred: {e}", status=500)
 
 
-@https_fn.on_request()
+# --- Field Survey Analysis ---
+FIELD_SURVEY_PROMPT = """This photo is one plant from a field survey. Analyze it and reply with ONLY a JSON object, no other text:
+{"crop": "<crop name>", "healthy": true or false,
+ "issues": [{"name": "<disease, pest or deficiency>", "type": "disease" | "pest" | "nutrient" | "other", "severity": "low" | "medium" | "high"}],
+ "recommended_products": ["<product to buy>"], "notes": "<one short sentence>"}"""
+SEVERITY_ORDER = ["low", "medium", "high"]
+_JSON_OBJECT_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+
+def _parse_survey_finding(text: str) -> dict:
+    """Extracts the JSON finding from the agent's reply. Raises ValueError if there is none."""
+    match = _JSON_OBJECT_RE.search(text or "")
+    if not match:
+        raise ValueError("The agent did not return a JSON finding.")
+    finding = json.loads(match.group(0))
+    if not isinstance(finding, dict):
+        raise ValueError("The agent did not return a JSON finding.")
+    return finding
+
+
+def _survey_user_id(user_id: str) -> str:
+    """
+    The user ID survey sessions are created under. Other endpoints take a
+    user's first session as "the" session, so survey sessions must never be
+    listed under the real user.
+    """
+    return f"{user_id}#survey"
+
+
+def _sweep_survey_sessions(remote_app, survey_user_id: str) -> None:
+    """Deletes survey sessions that a failed delete left behind."""
+    try:
+        response = remote_app.list_sessions(user_id=survey_user_id) or {}
+        cutoff = time.time() - SURVEY_SESSION_MAX_AGE_SECONDS
+        for session in response.get('sessions') or []:
+            updated = session.get('lastUpdateTime') or session.get('last_update_time') or 0
+            if updated < cutoff:
+                remote_app.delete_session(user_id=survey_user_id, session_id=session['id'])
+                print(f"Deleted leftover survey session '{session['id']}'.")
+    except Exception as e:
+        print(f"Could not sweep survey sessions for '{survey_user_id}': {e}")
+
+
+def _analyze_survey_image(remote_app, user_id: str, state: dict, image_url: str, question: str) -> dict:
+    """
+    Analyzes one survey image in a throwaway session under the survey user
+    ID, so concurrent analyses never interleave in, or become, the user's
+    own conversation.
+    """
+    user_id = _survey_user_id(user_id)
+    message = _build_agent_message({"image_url": image_url, "message": question})
+    session = remote_app.create_session(user_id=user_id, state=state)
+    try:
+        text = ""
+        for event in remote_app.stream_query(user_id=user_id, session_id=session['id'], message=message):
+            for part in (event.get('content') or {}).get('parts') or []:
+                if part.get('text'):
+                    text += part['text']
+        return _parse_survey_finding(text)
+    finally:
+        try:
+            remote_app.delete_session(user_id=user_id, session_id=session['id'])
+        except Exception as e:
+            print(f"Could not delete survey session '{session['id']}': {e}")
+
+
+def _aggregate_survey(results: list) -> dict:
+    """Builds the field-level report from per-image findings."""
+    analyzed = [r for r in results if r.get("finding") is not None]
+    issues = {}
+    products = Counter()
+    crops = Counter()
+    healthy = 0
+    for result in analyzed:
+        finding = result["finding"]
+        if finding.get("crop"):
+            crops[str(finding["crop"]).strip().lower()] += 1
+        found = [i for i in finding.get("issues") or [] if isinstance(i, dict) and i.get("name")]
+        if finding.get("healthy") or not found:
+            healthy += 1
+        # Count each issue once per plant, at its highest reported severity.
+        per_plant = {}
+        for issue in found:
+            name = str(issue["name"]).strip().lower()
+            severity = issue.get("severity") if issue.get("severity") in SEVERITY_ORDER else "low"
+            previous = per_plant.get(name)
+            if previous is None or SEVERITY_ORDER.index(severity) > SEVERITY_ORDER.index(previous[1]):
+                per_plant[name] = (issue.get("type") or "other", severity)
+        for name, (issue_type, severity) in per_plant.items():
+            entry = issues.setdefault(name, {"name": name, "type": issue_type, "plants": 0,
+                                             "severity": {level: 0 for level in SEVERITY_ORDER}})
+            entry["plants"] += 1
+            entry["severity"][severity] += 1
+        products.update({str(p).strip() for p in finding.get("recommended_products") or [] if p})
+
+    total = len(analyzed)
+    issue_list = sorted(issues.values(), key=lambda i: i["plants"], reverse=True)
+    for entry in issue_list:
+        entry["share_of_plants"] = round(entry["plants"] / total, 3) if total else 0.0
+    return {
+        "images_submitted": len(results),
+        "images_analyzed": total,
+        "images_failed": len(results) - total,
+        "healthy_plants": healthy,
+        "crops": dict(crops.most_common()),
+        "issues": issue_list,
+        "products_to_buy": [{"name": name, "plants": count} for name, count in products.most_common()],
+    }
+
+
+@https_fn.on_request(**AI_FUNCTION_OPTIONS)
+def analyze_field_survey(req: https_fn.Request) -> https_fn.Response:
+    """
+    An HTTP endpoint that analyzes many field survey photos in one request.
+    Expects a JSON body with 'user_id', 'session_id' and 'image_urls', and an
+    optional 'message' with extra instructions for every image.
+
+    Images are analyzed concurrently (FIELD_SURVEY_CONCURRENCY at a time) and
+    the findings are aggregated into one field-level report: counts per
+    disease or pest by severity, and the products to buy. Set 'stream' to
+    "sse" or "ndjson" to receive a "progress" chunk as each image finishes,
+    then a "report" chunk and a "done" chunk.
+    """
+    try:
+        request_json = req.get_json(silent=True)
+        if not request_json or 'user_id' not in request_json or 'session_id' not in request_json:
+            return https_fn.Response("Error: Please provide 'user_id' and 'session_id'.", status=400)
+
+        user_id = request_json['user_id']
+        session_id = request_json['session_id']
+        image_urls = request_json.get('image_urls')
+        if not isinstance(image_urls, list) or not image_urls or not all(isinstance(u, str) and u for u in image_urls):
+            return https_fn.Response("Error: 'image_urls' must be a non-empty list of URLs.", status=400)
+        if len(image_urls) > FIELD_SURVEY_MAX_IMAGES:
+            return https_fn.Response(f"Error: A survey can have at most {FIELD_SURVEY_MAX_IMAGES} images.", status=400)
+
+        stream_format = str(req.args.get("stream") or request_json.get("stream") or "").lower()
+        if stream_format in ("true", "1"):
+            stream_format = "ndjson"
+        if stream_format and stream_format not in ("sse", "ndjson"):
+            return https_fn.Response("Error: 'stream' must be 'sse' or 'ndjson'.", status=400)
+
+        question = FIELD_SURVEY_PROMPT
+        if request_json.get('message'):
+            question += f"\nAdditional instructions: {request_json['message']}"
+
+        remote_app = get_remote_app()
+        # Every analysis starts from the user's state, e.g. their location.
+        session = remote_app.get_session(user_id=user_id, session_id=session_id)
+        state = (session or {}).get('state', {})
+
+        print(f"Analyzing {len(image_urls)} survey images for user '{user_id}'...")
+        executor = ThreadPoolExecutor(max_workers=max(1, FIELD_SURVEY_CONCURRENCY))
+        executor.submit(_sweep_survey_sessions, remote_app, _survey_user_id(user_id))
+        futures = {
+            executor.submit(_analyze_survey_image, remote_app, user_id, state, url, question): index
+            for index, url in enumerate(image_urls)
+        }
+
+        def results_as_completed():
+            """Yields one result per image, in completion order."""
+            for future in as_completed(futures):
+                index = futures[future]
+                result = {"index": index, "image_url": image_urls[index], "finding": None}
+                try:
+                    result["finding"] = future.result()
+                except Exception as e:
+                    print(f"Survey image {index} failed: {e}")
+                    result["error"] = str(e)
+                yield result
+
+        if stream_format:
+            def generate():
+                results = []
+                try:
+                    for result in results_as_completed():
+                        results.append(result)
+                        yield _format_stream_chunk({"type": "progress", "completed": len(results),
+                                                    "total": len(image_urls), **result}, stream_format)
+                    yield _format_stream_chunk({"type": "report", "report": _aggregate_survey(results)}, stream_format)
+                    yield _format_stream_chunk({"type": "done"}, stream_format)
+                except GeneratorExit:
+                    print(f"Client disconnected. Cancelling the remaining survey images for user '{user_id}'.")
+                    raise
+                finally:
+                    executor.shutdown(wait=False, cancel_futures=True)
+
+            mimetype = "text/event-stream" if stream_format == "sse" else "application/x-ndjson"
+            return https_fn.Response(
+                generate(),
+                mimetype=mimetype,
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+
+        try:
+            results = sorted(results_as_completed(), key=lambda r: r["index"])
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        response_data = json.dumps({"report": _aggregate_survey(results), "images": results}, cls=DateTimeEncoder)
+        return https_fn.Response(response_data, mimetype="application/json")
+
+    except Exception as e:
+        print(f"An error occurred in analyze_field_survey: {e}")
+        return https_fn.Response(f"An internal error occurred: {e}", status=500)
+
+
+# --- List Pagination ---
+# The product and order list endpoints share one contract:
+# - fields: a comma-separated list of fields to return (the ID is always included).
+# - limit: the page size, at most MAX_LIST_PAGE_SIZE. Without it the whole
+#   list is returned, as before pagination was added.
+# - page_token: the 'next_page_token' from the previous page.
+# Fields are projected with select() and pages come from ordered queries, so
+# each request reads at most 'limit' documents.
+MAX_LIST_PAGE_SIZE = 200
+_FIELD_NAME_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]{0,63}$")
+
+
+def _list_params(req: https_fn.Request, request_json: dict, id_field: str):
+    """
+    Reads the 'fields', 'limit' and 'page_token' parameters from the query or body.
+
+    Returns:
+        A tuple of (field names, or None for all fields and [] for only the ID,
+        limit or None for no limit, page token or None).
+        Raises ValueError if a parameter is invalid.
+    """
+    fields = req.args.get("fields") or request_json.get("fields") or None
+    if fields is not None:
+        if isinstance(fields, str):
+            fields = fields.split(",")
+        fields = list(dict.fromkeys(str(field).strip() for field in fields if str(field).strip()))
+        invalid = [field for field in fields if not _FIELD_NAME_RE.match(field)]
+        if invalid:
+            raise ValueError(f"Invalid field name(s): {', '.join(invalid)}.")
+        # The ID comes from the document name, not from a field.
+        fields = [field for field in fields if field != id_field]
+    limit = req.args.get("limit") or request_json.get("limit") or None
+    if limit is not None:
+        try:
+            limit = min(max(int(limit), 1), MAX_LIST_PAGE_SIZE)
+        except (TypeError, ValueError):
+            raise ValueError("'limit' must be a number.")
+    page_token = req.args.get("page_token") or request_json.get("page_token") or None
+    return fields, limit, page_token
+
+
+def _select_paths(fields: list) -> list:
+    """Returns the field paths to select(); an empty projection would return every field."""
+    return fields or ["__name__"]
+
+
+def _project(data: dict, fields) -> dict:
+    """Keeps only the requested fields of a document's data."""
+    if fields is None:
+        return data
+    return {field: data[field] for field in fields if field in data}
+
+
+def _decode_offset_cursor(token: str) -> int:
+    """Decodes a page token over a list of IDs into an offset. Raises ValueError if it is invalid."""
+    offset, _ = _decode_cursor(token)
+    if not isinstance(offset, int) or offset < 0:
+        raise ValueError("Invalid page_token.")
+    return offset
+
+
+def _get_documents_page(db, collection_name: str, ids: list, fields, limit, page_token):
+    """
+    Reads one page of documents from a list of IDs with a single batched read.
+    With no limit, reads every ID from the page token on.
+
+    Returns:
+        A tuple of (the existing documents in list order, next page token or None).
+    """
+    offset = _decode_offset_cursor(page_token) if page_token else 0
+    page_ids = ids[offset:offset + limit] if limit else ids[offset:]
+    if not page_ids:
+        return [], None
+    collection = db.collection(collection_name)
+    # An empty mask is not an ID-only read, so callers project the data instead.
+    snapshots = {
+        doc.id: doc
+        for doc in db.get_all([collection.document(doc_id) for doc_id in page_ids], field_paths=fields or None)
+        if doc.exists
+    }
+    docs = [snapshots[doc_id] for doc_id in page_ids if doc_id in snapshots]
+    next_offset = offset + len(page_ids)
+    next_page_token = _encode_cursor(next_offset, page_ids[-1]) if next_offset < len(ids) else None
+    return docs, next_page_token
+
+
+@https_fn.on_request(**AI_FUNCTION_OPTIONS)
 def list_products(req: https_fn.Request) -> https_fn.Response:
     """
     An HTTP endpoint that lists available products from the Firestore 'products'
@@ -254,6 +740,9 @@ def list_products(req: https_fn.Request) -> https_fn.Response:
     - If 'user_id' is provided without a location, it attempts to find the user's
       location from their active session.
     - If a 'user_id' is provided, it will always filter out products listed by that user.
+    Supports 'fields', 'limit' and 'page_token'. Products are ordered by product
+    ID, so pages are stable but not sorted by recency, and may be shorter than
+    'limit' when the user's own products are skipped.
     """
     try:
         # Make the function robust by checking for parameters in both the
@@ -262,6 +751,7 @@ def list_products(req: https_fn.Request) -> https_fn.Response:
         user_id = req.args.get("user_id") or request_json.get("user_id")
         state = req.args.get("state") or request_json.get("state")
         district = req.args.get("district") or request_json.get("district")
+        fields, limit, page_token = _list_params(req, request_json, "product_id")
 
         print(f"list_products invoked with user_id: {user_id}, state: {state}, district: {district}")
         # If location is not provided directly, try to fetch it from the user's session.
@@ -282,45 +772,53 @@ def list_products(req: https_fn.Request) -> https_fn.Response:
                 print(f"Could not fetch session location for user '{user_id}': {e}")
 
         db = get_firestore_client()
-        all_docs = {}
-
-        # Query 1: Products available to everyone (e.g., fertilizers, seeds)
-        global_query = db.collection("products").where(
-            filter=firestore.FieldFilter("state", "==", "any")
-        ).where(
-            filter=firestore.FieldFilter("district", "==", "any")
-        )
-        for doc in global_query.stream():
-            all_docs[doc.id] = doc
-        
-        print(f"Found {len(all_docs)} global products.")
-
-        # Query 2: Products specific to the user's location (if location is known)
+        # Products available to everyone (e.g., fertilizers, seeds) and, if the
+        # location is known, products specific to it, in one ordered query.
+        location_filter = firestore.And([
+            firestore.FieldFilter("state", "==", "any"),
+            firestore.FieldFilter("district", "==", "any"),
+        ])
         if state and district:
-            local_query = db.collection("products").where(
-                filter=firestore.FieldFilter("state", "==", state)
-            ).where(
-                filter=firestore.FieldFilter("district", "==", district)
-            )
-            for doc in local_query.stream():
-                all_docs[doc.id] = doc  # Overwrites if duplicate, which is fine.
-            print(f"After adding local products from {district}, {state}, total unique products: {len(all_docs)}.")
+            location_filter = firestore.Or([
+                location_filter,
+                firestore.And([
+                    firestore.FieldFilter("state", "==", state),
+                    firestore.FieldFilter("district", "==", district),
+                ]),
+            ])
+        products = db.collection("products")
+        query = products.where(filter=location_filter).order_by("__name__")
+        if page_token:
+            _, last_id = _decode_cursor(page_token)
+            if not isinstance(last_id, str) or not last_id:
+                raise ValueError("Invalid page_token.")
+            query = query.start_after({"__name__": products.document(last_id)})
+        if fields is not None:
+            # The seller is needed to filter out the user's own products.
+            query = query.select(_select_paths(fields + (["seller_id"] if user_id and "seller_id" not in fields else [])))
+        if limit:
+            query = query.limit(limit)
+        docs = list(query.stream())
 
         products_list = []
-        for doc_id, doc in all_docs.items():
+        for doc in docs:
             product_data = doc.to_dict()
             
             # Apply the filter for the user's own products here in the code.
             if user_id and product_data.get("seller_id") == user_id:
                 continue
 
-            product_data["product_id"] = doc_id  # Add the document ID to the data
+            product_data = _project(product_data, fields)
+            product_data["product_id"] = doc.id  # Add the document ID to the data
             products_list.append(product_data)
         
-        print(f"Final list contains {len(products_list)} products after filtering.")
+        next_page_token = _encode_cursor(None, docs[-1].id) if limit and len(docs) == limit else None
+        print(f"Returning {len(products_list)} of {len(docs)} products read after filtering.")
 
-        return https_fn.Response(json.dumps({"products": products_list}, cls=DateTimeEncoder), mimetype="application/json")
+        return json_response(req, {"products": products_list, "next_page_token": next_page_token})
 
+    except ValueError as ve:
+        return https_fn.Response(json.dumps({"error": str(ve)}), status=400, mimetype="application/json")
     except Exception as e:
         print(f"An error occurred while listing products: {e}")
         return https_fn.Response(f"An internal error occurred: {e}", status=500)
@@ -350,7 +848,7 @@ def _transactional_purchase(transaction, product_ref, quantity_to_buy: int):
     return data, new_quantity
 
 
-@https_fn.on_request()
+@https_fn.on_request(**AI_FUNCTION_OPTIONS)
 def purchase_product(req: https_fn.Request) -> https_fn.Response:
     """
     An HTTP endpoint for an app to purchase one or more products from a shopping cart.
@@ -523,11 +1021,13 @@ def purchase_product(req: https_fn.Request) -> https_fn.Response:
         return https_fn.Response(json.dumps({"error": f"An internal error occurred: {e}"}), status=500, mimetype="application/json")
 
 
-@https_fn.on_request()
+@https_fn.on_request(**LIGHT_FUNCTION_OPTIONS)
 def list_orders(req: https_fn.Request) -> https_fn.Response:
     """
-    An HTTP endpoint that lists all orders for a given user from the 'orders' collection.
-    Expects a 'user_id' in the request body or query parameters.
+    An HTTP endpoint that lists a user's orders from the 'orders' collection,
+    newest first.
+    Expects a 'user_id' in the request body or query parameters, and supports
+    'fields', 'limit' and 'page_token'.
     """
     try:
         # Make the function robust by checking for parameters in both the
@@ -538,38 +1038,63 @@ def list_orders(req: https_fn.Request) -> https_fn.Response:
         if not user_id:
             return https_fn.Response(json.dumps({"error": "Missing 'user_id' in request."}), status=400, mimetype="application/json")
 
+        fields, limit, page_token = _list_params(req, request_json, "order_id")
         print(f"list_orders invoked for user_id: {user_id}")
 
         db = get_firestore_client()
-        # Query the 'orders' collection, filtering by the buyer's ID.
-        # The ordering is done in the application code to avoid needing a composite
-        # index in Firestore for filtering on one field and ordering on another.
-        query = db.collection("orders").where(
-            filter=firestore.FieldFilter("buyer_id", "==", user_id)
-        )
-
-        docs = query.stream()
-
-        orders_list = [doc.to_dict() | {"order_id": doc.id} for doc in docs]
-
-        # Sort the list of orders by 'order_time' in descending order.
-        orders_list.sort(key=lambda x: x.get("order_time"), reverse=True)
+        orders = db.collection("orders")
+        query = orders.where(filter=firestore.FieldFilter("buyer_id", "==", user_id))
+        if fields is not None:
+            # The order time is needed for sorting and for the next page's cursor.
+            query = query.select(fields + ([] if "order_time" in fields else ["order_time"]))
+
+        if not (limit or page_token):
+            # The whole history is sorted here rather than by the query, which
+            # would need the composite index and drop orders without an order_time.
+            # DocumentSnapshot.get() raises KeyError for a missing field, so sort the data.
+            rows = [(doc.id, doc.to_dict() or {}) for doc in query.stream()]
+            rows.sort(
+                key=lambda order: (order[1].get("order_time") is not None, order[1].get("order_time") or datetime.min),
+                reverse=True,
+            )
+            orders_list = [_project(data, fields) | {"order_id": order_id} for order_id, data in rows]
+            print(f"Found {len(orders_list)} orders for user '{user_id}'.")
+            return json_response(req, {"orders": orders_list, "next_page_token": None})
+
+        # Requires a composite index on buyer_id, order_time (descending) and __name__ (descending).
+        # Orders without an order_time are not paged.
+        query = query.order_by("order_time", direction=firestore.Query.DESCENDING) \
+            .order_by("__name__", direction=firestore.Query.DESCENDING)
+        if page_token:
+            order_time, last_id = _decode_time_cursor(page_token)
+            if not last_id:
+                raise ValueError("Invalid page_token.")
+            query = query.start_after({"order_time": order_time, "__name__": orders.document(last_id)})
+        if limit:
+            query = query.limit(limit)
+        docs = list(query.stream())
+
+        orders_list = [_project(doc.to_dict(), fields) | {"order_id": doc.id} for doc in docs]
+        next_page_token = _encode_cursor(docs[-1].get("order_time"), docs[-1].id) if limit and len(docs) == limit else None
 
         print(f"Found {len(orders_list)} orders for user '{user_id}'.")
-        return https_fn.Response(json.dumps({"orders": orders_list}, cls=DateTimeEncoder), mimetype="application/json")
+        return json_response(req, {"orders": orders_list, "next_page_token": next_page_token})
 
+    except ValueError as ve:
+        return https_fn.Response(json.dumps({"error": str(ve)}), status=400, mimetype="application/json")
     except Exception as e:
         print(f"An error occurred while listing orders: {e}")
         return https_fn.Response(json.dumps({"error": f"An internal error occurred: {e}"}), status=500, mimetype="application/json")
 
 
-@https_fn.on_request()
+@https_fn.on_request(**AI_FUNCTION_OPTIONS)
 def list_user_products(req: https_fn.Request) -> https_fn.Response:
     """
     An HTTP endpoint that lists all products a specific user has listed for sale.
     It retrieves the list of product IDs from the user's session state and then
-    fetches the full details for each product from Firestore.
-    Expects a 'user_id' in the request body or query parameters.
+    fetches the details for each product from Firestore, most recently listed first.
+    Expects a 'user_id' in the request body or query parameters, and supports
+    'fields', 'limit' and 'page_token'.
     """
     try:
         request_json = req.get_json(silent=True) or {}
@@ -578,6 +1103,7 @@ def list_user_products(req: https_fn.Request) -> https_fn.Response:
         if not user_id:
             return https_fn.Response(json.dumps({"error": "Missing 'user_id' in request."}), status=400, mimetype="application/json")
 
+        fields, limit, page_token = _list_params(req, request_json, "product_id")
         print(f"list_user_products invoked for user_id: {user_id}")
 
         # 1. Fetch the user's session to get the list of their products
@@ -592,36 +1118,35 @@ def list_user_products(req: https_fn.Request) -> https_fn.Response:
             print(f"Found {len(product_ids)} product IDs in session for user '{user_id}'.")
         else:
             print(f"No active session found for user '{user_id}'.")
-            return https_fn.Response(json.dumps({"products": []}), mimetype="application/json")
+            return https_fn.Response(json.dumps({"products": [], "next_page_token": None}), mimetype="application/json")
 
         if not product_ids:
-            return https_fn.Response(json.dumps({"products": []}), mimetype="application/json")
+            return https_fn.Response(json.dumps({"products": [], "next_page_token": None}), mimetype="application/json")
 
-        # 2. Fetch the full details for each product ID from Firestore
+        # 2. Fetch one page of products in a single batched read. Products are
+        # appended to the session as they are listed, so newest come last.
         db = get_firestore_client()
-        user_products = []
-        products_collection = db.collection("products")
-        for product_id in product_ids:
-            doc = products_collection.document(product_id).get()
-            if doc.exists:
-                product_data = doc.to_dict()
-                product_data["product_id"] = doc.id
-                user_products.append(product_data)
-        
-        user_products.sort(key=lambda x: x.get("listed_at"), reverse=True)
-        return https_fn.Response(json.dumps({"products": user_products}, cls=DateTimeEncoder), mimetype="application/json")
+        docs, next_page_token = _get_documents_page(
+            db, "products", list(reversed(product_ids)), fields, limit, page_token
+        )
+        user_products = [_project(doc.to_dict(), fields) | {"product_id": doc.id} for doc in docs]
+        return json_response(req, {"products": user_products, "next_page_token": next_page_token})
 
+    except ValueError as ve:
+        return https_fn.Response(json.dumps({"error": str(ve)}), status=400, mimetype="application/json")
     except Exception as e:
         print(f"An error occurred while listing user products: {e}")
         return https_fn.Response(json.dumps({"error": f"An internal error occurred: {e}"}), status=500, mimetype="application/json")
 
-@https_fn.on_request()
+@https_fn.on_request(**LIGHT_FUNCTION_OPTIONS)
 def get_agent_dashboard_orders(req: https_fn.Request) -> https_fn.Response:
     """
     An HTTP endpoint that fetches all order details for a specific delivery agent.
     It first finds the agent by their agent_id, retrieves their list of assigned
-    order IDs, and then fetches the details for each of those orders.
-    Expects a 'agent_id' in the request body or query parameters.
+    order IDs, and then fetches the details for those orders, most recently
+    assigned first.
+    Expects a 'agent_id' in the request body or query parameters, and supports
+    'fields', 'limit' and 'page_token'.
     """
     try:
         request_json = req.get_json(silent=True) or {}
@@ -630,6 +1155,7 @@ def get_agent_dashboard_orders(req: https_fn.Request) -> https_fn.Response:
         if not agent_id:
             return https_fn.Response(json.dumps({"error": "Missing 'agent_id' in request."}), status=400, mimetype="application/json")
 
+        fields, limit, page_token = _list_params(req, request_json, "order_id")
         print(f"get_agent_dashboard_orders invoked for agent_id: {agent_id}")
 
         db = get_firestore_client()
@@ -649,35 +1175,27 @@ def get_agent_dashboard_orders(req: https_fn.Request) -> https_fn.Response:
 
         if not order_ids:
             print(f"Agent {agent_id} has no orders assigned.")
-            return https_fn.Response(json.dumps({"orders": []}), mimetype="application/json")
+            return https_fn.Response(json.dumps({"orders": [], "next_page_token": None}), mimetype="application/json")
 
         print(f"Found {len(order_ids)} assigned orders for agent {agent_id}. Fetching details...")
 
-        # 2. Fetch order details for the assigned order IDs.
-        # IMPORTANT: Firestore 'in' queries are limited to 30 items.
-        # The following logic fetches each document individually to avoid issues
-        # with special field filters like DOCUMENT_ID.
-        all_orders = []
-        if order_ids:
-            orders_collection = db.collection("orders")
-            for order_id in order_ids:
-                doc = orders_collection.document(order_id).get()
-                if doc.exists:
-                    order_data = doc.to_dict()
-                    order_data["order_id"] = doc.id
-                    all_orders.append(order_data)
-
-        # 3. Sort the results by order time
-        all_orders.sort(key=lambda x: x.get("order_time"), reverse=True)
+        # 2. Fetch one page of the assigned orders in a single batched read.
+        # Orders are appended as they are assigned, so newest come last.
+        docs, next_page_token = _get_documents_page(
+            db, "orders", list(reversed(order_ids)), fields, limit, page_token
+        )
+        all_orders = [_project(doc.to_dict(), fields) | {"order_id": doc.id} for doc in docs]
 
         print(f"Successfully fetched details for {len(all_orders)} orders.")
-        return https_fn.Response(json.dumps({"orders": all_orders}, cls=DateTimeEncoder), mimetype="application/json")
+        return json_response(req, {"orders": all_orders, "next_page_token": next_page_token})
 
+    except ValueError as ve:
+        return https_fn.Response(json.dumps({"error": str(ve)}), status=400, mimetype="application/json")
     except Exception as e:
         print(f"An error occurred while fetching agent dashboard orders: {e}")
         return https_fn.Response(json.dumps({"error": f"An internal error occurred: {e}"}), status=500, mimetype="application/json")
 
-@https_fn.on_request()
+@https_fn.on_request(**LIGHT_FUNCTION_OPTIONS)
 def delivery_update(req: https_fn.Request) -> https_fn.Response:
     """
     An HTTP endpoint for a delivery agent to update an order's status and
@@ -725,7 +1243,7 @@ def delivery_update(req: https_fn.Request) -> https_fn.Response:
         print(f"An error occurred during delivery update: {e}")
         return https_fn.Response(json.dumps({"error": f"An internal error occurred: {e}"}), status=500, mimetype="application/json")
 
-@https_fn.on_request()
+@https_fn.on_request(**AI_FUNCTION_OPTIONS)
 def rate_product(req: https_fn.Request) -> https_fn.Response:
     """
     An HTTP endpoint for a user to rate a product they have purchased.
@@ -802,7 +1320,7 @@ def rate_product(req: https_fn.Request) -> https_fn.Response:
     except Exception as e:
         return https_fn.Response(json.dumps({"error": f"An internal error occurred: {e}"}), status=500, mimetype="application/json")
 
-@https_fn.on_request()
+@https_fn.on_request(**AI_FUNCTION_OPTIONS)
 def sell_product(req: https_fn.Request) -> https_fn.Response:
     """
     An HTTP endpoint for an app to list a new product for sale.
@@ -910,42 +1428,525 @@ def sell_product(req: https_fn.Request) -> https_fn.Response:
 
 # --- Community Chat Functions ---
 
-@https_fn.on_request()
+# --- Community Chat Rooms ---
+# Messages live in one collection per room. The global room keeps the original
+# 'community_chat' collection; district and crop rooms are stored under
+# 'chat_rooms/{room}/messages'. Each room has its own FCM topic, and the rooms
+# a user has joined are stored in their profile ('users/{user_id}.chatRooms').
+DEFAULT_CHAT_ROOM = "global"
+CHAT_ROOM_KINDS = ("district", "crop")
+USERS_COLLECTION = "users"
+_CHAT_ROOM_RE = re.compile(r"^(district|crop)-[a-z0-9-]{1,60}$")
+_LANGUAGE_CODE_RE = re.compile(r"^([a-z]{2,3})(-[A-Z]{2})?$")
+# Speech-to-Text accepts a primary language and at most three alternatives.
+MAX_TRANSCRIBE_LANGUAGES = 4
+FCM_TOPIC = "community_chat_updates"
+
+
+def _slugify(name: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "-", name.strip().lower()).strip("-")
+
+
+def _chat_room_id(kind: str, name: str) -> str:
+    """Builds a room ID such as 'district-coimbatore' or 'crop-green-chilli'."""
+    if kind not in CHAT_ROOM_KINDS:
+        raise ValueError(f"Room kind must be one of {list(CHAT_ROOM_KINDS)}.")
+    slug = _slugify(name)
+    if not slug:
+        raise ValueError(f"Invalid {kind} name.")
+    return f"{kind}-{slug}"
+
+
+def _validate_chat_room(room: str) -> str:
+    """Returns the room ID, defaulting to the global room. Raises ValueError if it is invalid."""
+    room = (room or DEFAULT_CHAT_ROOM).lower()
+    if room != DEFAULT_CHAT_ROOM and not _CHAT_ROOM_RE.match(room):
+        raise ValueError("Invalid room. Use 'global', 'district-<name>' or 'crop-<name>'.")
+    return room
+
+
+def _validate_transcribe_languages(languages) -> list:
+    """
+    Returns a message's transcription language codes, e.g. ['hi-IN', 'en-IN'].
+    Raises ValueError unless it is a short list of codes for the chat languages.
+    """
+    if not isinstance(languages, list) or not 0 < len(languages) <= MAX_TRANSCRIBE_LANGUAGES:
+        raise ValueError(f"'languages' must be a list of 1 to {MAX_TRANSCRIBE_LANGUAGES} language codes.")
+    for code in languages:
+        match = _LANGUAGE_CODE_RE.match(code) if isinstance(code, str) else None
+        if not match or match.group(1) not in CHAT_LANGUAGES:
+            raise ValueError(f"Invalid language code {code!r}. Use one of {CHAT_LANGUAGES}, e.g. 'hi-IN'.")
+    return list(dict.fromkeys(languages))
+
+
+def _chat_room_messages(db, room: str):
+    """Returns the collection holding a room's messages."""
+    if room == DEFAULT_CHAT_ROOM:
+        return db.collection('community_chat')
+    return db.collection('chat_rooms').document(room).collection('messages')
+
+
+def _chat_room_topic(room: str, lang: str = None) -> str:
+    """
+    Returns the FCM topic for a room's notifications. With a language, the
+    topic carries only that language's text.
+    """
+    topic = FCM_TOPIC if room == DEFAULT_CHAT_ROOM else f"community_chat_{room}"
+    return f"{topic}_{lang}" if lang else topic
+
+
+# --- Community Chat Sync ---
+DEFAULT_CHAT_PAGE_SIZE = 50
+MAX_CHAT_PAGE_SIZE = 200
+# How long an instance trusts its last look at the newest chat update when answering conditional polls.
+CHAT_ETAG_TTL_SECONDS = float(os.environ.get("CHAT_ETAG_TTL_SECONDS", "2"))
+CHAT_MESSAGE_FIELDS = ['senderId', 'senderName', 'room', 'text', 'audio_url', 'translationStatus', 'timestamp', 'updatedAt']
+
+# room -> {"marker": ..., "checked_at": ...}
+_latest_chat_update = {}
+_latest_chat_update_lock = threading.Lock()
+
+
+def _encode_cursor(value, doc_id: str) -> str:
+    """Encodes an ordering value and document ID as an opaque cursor."""
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    payload = json.dumps({"v": value, "id": doc_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(token: str):
+    """Decodes a cursor into (value, doc_id). Raises ValueError if it is invalid."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        return payload["v"], payload["id"]
+    except Exception:
+        raise ValueError("Invalid cursor.")
+
+
+def _decode_time_cursor(token: str):
+    """
+    Decodes a chat cursor into (datetime, doc_id). A plain ISO 8601 timestamp
+    is also accepted, with no document ID.
+    """
+    try:
+        return datetime.fromisoformat(token.replace("Z", "+00:00")), None
+    except ValueError:
+        value, doc_id = _decode_cursor(token)
+        try:
+            return datetime.fromisoformat(value), doc_id
+        except (TypeError, ValueError):
+            raise ValueError("Invalid cursor.")
+
+
+def _get_latest_chat_update(db, room: str) -> str:
+    """
+    Returns a marker for the newest change to a room, read with a single
+    one-document query and reused for CHAT_ETAG_TTL_SECONDS.
+    """
+    with _latest_chat_update_lock:
+        cached = _latest_chat_update.get(room)
+        if cached and time.monotonic() - cached["checked_at"] < CHAT_ETAG_TTL_SECONDS:
+            return cached["marker"]
+
+    marker = ""
+    # Messages written before 'updatedAt' existed are ordered by 'timestamp' instead.
+    for field in ('updatedAt', 'timestamp'):
+        query = _chat_room_messages(db, room).order_by(field, direction=firestore.Query.DESCENDING).limit(1)
+        docs = list(query.select([field]).stream())
+        if docs:
+            value = docs[0].get(field)
+            marker = f"{docs[0].id}:{value.isoformat() if hasattr(value, 'isoformat') else value}"
+            break
+
+    with _latest_chat_update_lock:
+        _latest_chat_update[room] = {"marker": marker, "checked_at": time.monotonic()}
+    return marker
+
+
+class _BucketedMessage:
+    """Gives a message read from a bucket the DocumentSnapshot methods the chat views use."""
+
+    def __init__(self, entry: dict):
+        self.id = entry['id']
+        self._data = {field: value for field, value in entry.items() if field != 'id'}
+
+    def to_dict(self) -> dict:
+        return dict(self._data)
+
+    def get(self, field: str):
+        return self._data[field]
+
+
+def _chat_message_view(doc, lang: str) -> dict:
+    """Returns the client view of a chat message, with 'text' in the requested language."""
+    msg_data = doc.to_dict()
+    msg_data['id'] = doc.id
+    if lang:
+        translated = msg_data.get(f'text_{lang}')
+        for field in [f for f in msg_data if f.startswith('text_')]:
+            del msg_data[field]
+        msg_data['text'] = translated or msg_data.get('text', '')
+        msg_data['lang'] = lang
+    return msg_data
+
+
+# --- Time-Bucketed Chat Storage ---
+# When enabled, every message is also copied into a bucket document per room
+# and hour ('community_chat_buckets/{room}_{YYYYMMDDHH}_{chunk}'), so the
+# latest history is read from one or two documents instead of one per message.
+# A bucket holds at most CHAT_BUCKET_MAX_MESSAGES; later messages in the same
+# hour overflow into the next chunk. Document IDs sort chronologically.
+CHAT_BUCKETS_ENABLED = os.environ.get("CHAT_BUCKETS_ENABLED", "false").lower() == "true"
+CHAT_BUCKET_COLLECTION = "community_chat_buckets"
+CHAT_BUCKET_MAX_MESSAGES = int(os.environ.get("CHAT_BUCKET_MAX_MESSAGES", "200"))
+
+
+def _chat_bucket_prefix(room: str, timestamp: datetime = None) -> str:
+    """The bucket ID prefix for a room, or for one hour of a room."""
+    # Underscores separate the ID parts, so they are not allowed in the room part.
+    prefix = f"{room.replace('_', '-')}_"
+    return prefix + f"{timestamp.strftime('%Y%m%d%H')}_" if timestamp else prefix
+
+
+def _id_prefix_query(collection, prefix: str):
+    """Queries the documents whose IDs start with `prefix`, highest ID first."""
+    upper_bound = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return (
+        collection
+        .where(filter=firestore.FieldFilter('__name__', '>=', collection.document(prefix)))
+        .where(filter=firestore.FieldFilter('__name__', '<', collection.document(upper_bound)))
+        .order_by('__name__', direction=firestore.Query.DESCENDING)
+    )
+
+
+def _chat_bucket_entry(message_data: dict) -> dict:
+    """The compact copy of a message stored in a bucket."""
+    return {
+        field: value for field, value in message_data.items()
+        if field in CHAT_MESSAGE_FIELDS or field.startswith('text_')
+    }
+
+
+def _latest_chat_buckets(db, room: str, limit: int):
+    """Returns up to `limit` of a room's newest bucket documents, newest first."""
+    collection = db.collection(CHAT_BUCKET_COLLECTION)
+    return list(_id_prefix_query(collection, _chat_bucket_prefix(room)).limit(limit).stream())
+
+
+def _read_latest_from_buckets(db, room: str, limit: int) -> list:
+    """
+    Reads up to `limit` of a room's latest messages from its two newest
+    buckets, oldest first. Fewer than `limit` means the buckets do not hold
+    a full page, e.g. in a quiet room, and the caller must query the messages.
+    Messages whose bucket write has not landed yet are picked up by the
+    next 'since' sync, because their translation bumps 'updatedAt'.
+    """
+    messages = []
+    # A page of recent history can span the start of the current hour, so two buckets are read.
+    for bucket in _latest_chat_buckets(db, room, 2):
+        for message_id, entry in (bucket.to_dict().get('messages') or {}).items():
+            messages.append({**entry, 'id': message_id})
+    messages.sort(key=lambda m: (m.get('timestamp') is not None, m.get('timestamp'), m['id']))
+    return messages[-limit:]
+
+
+@firestore.transactional
+def _add_to_chat_bucket(transaction, db, message_ref, room: str) -> str:
+    """
+    Copies a message into its bucket. A message that is not in a bucket yet
+    is appended to the newest chunk for its room and hour, and a new chunk is
+    started when that one is full.
+    """
+    snapshot = message_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return ""
+    message_data = snapshot.to_dict()
+    collection = db.collection(CHAT_BUCKET_COLLECTION)
+    # Another delivery may have placed the message while this one waited.
+    if message_data.get('bucketId'):
+        bucket_ref = collection.document(message_data['bucketId'])
+        transaction.update(bucket_ref, {f'messages.`{message_ref.id}`': _chat_bucket_entry(message_data)})
+        return bucket_ref.id
+
+    timestamp = message_data['timestamp']
+    prefix = _chat_bucket_prefix(room, timestamp)
+    latest = list(transaction.get(_id_prefix_query(collection, prefix).limit(1)))
+    chunk = 0
+    if latest:
+        chunk = latest[0].get('chunk')
+        if latest[0].get('count') >= CHAT_BUCKET_MAX_MESSAGES:
+            chunk += 1
+
+    bucket_ref = collection.document(f"{prefix}{chunk:03d}")
+    transaction.set(bucket_ref, {
+        'room': room,
+        'bucketStart': timestamp.replace(minute=0, second=0, microsecond=0),
+        'chunk': chunk,
+        'count': firestore.Increment(1),
+        'messages': {message_ref.id: _chat_bucket_entry(message_data)},
+        'updatedAt': firestore.SERVER_TIMESTAMP,
+    }, merge=True)
+    transaction.update(message_ref, {'bucketId': bucket_ref.id})
+    return bucket_ref.id
+
+
+@https_fn.on_request(**LIGHT_FUNCTION_OPTIONS)
 def getCommunityMessages(req: https_fn.Request) -> https_fn.Response:
     """
-    HTTP endpoint to fetch the most recent community chat messages.
+    HTTP endpoint to fetch community chat messages.
+
+    Query parameters (all optional):
+    - room: the room to read, e.g. 'district-coimbatore' (default 'global').
+    - since: a 'sync_cursor' from an earlier response, or an ISO 8601 timestamp.
+      Returns messages created or updated (e.g. translated) after it, oldest first.
+    - before: a 'before_cursor' from an earlier response. Returns the page of
+      messages older than it, for scroll-back.
+    - limit: the page size (default 50, at most 200).
+    - lang: a target language code. Each message's 'text' is returned in that
+      language and the other language fields are omitted.
+
+    Without 'since' or 'before', the latest messages are returned, from the
+    time buckets when CHAT_BUCKETS_ENABLED is set. Responses
+    carry an ETag; a matching If-None-Match returns 304 Not Modified without
+    reading any messages.
     """
     try:
+        room = _validate_chat_room(req.args.get('room'))
+        since = req.args.get('since')
+        before = req.args.get('before')
+        lang = req.args.get('lang', '').lower()
+        if since and before:
+            return https_fn.Response("Error: Use either 'since' or 'before', not both.", status=400)
+        if lang and lang not in TRANSLATION_TARGET_LANGUAGES and lang != 'en':
+            return https_fn.Response(f"Error: 'lang' must be one of {['en'] + TRANSLATION_TARGET_LANGUAGES}.", status=400)
+        if lang == 'en':
+            # Messages are written in English or transliterated; 'text' is the original.
+            lang = ''
+        try:
+            limit = min(max(int(req.args.get('limit', DEFAULT_CHAT_PAGE_SIZE)), 1), MAX_CHAT_PAGE_SIZE)
+        except ValueError:
+            return https_fn.Response("Error: 'limit' must be a number.", status=400)
+
         db = get_firestore_client()
-        # Fetch the last 50 messages, ordered by time
-        query = db.collection('community_chat').order_by(
-            'timestamp', direction=firestore.Query.DESCENDING
-        ).limit(50)
-
-        messages = []
-        for doc in query.stream():
-            msg_data = doc.to_dict()
-            msg_data['id'] = doc.id
-            messages.append(msg_data)
-        
-        # The messages are fetched in descending order, so we reverse them
-        # to show the oldest of the batch first.
-        messages.reverse()
 
-        return https_fn.Response(
-            json.dumps({"messages": messages}, cls=DateTimeEncoder),
-            mimetype="application/json"
-        )
+        # --- Conditional request: compare against the newest change first ---
+        etag_source = "|".join([room, _get_latest_chat_update(db, room), since or "", before or "", lang, str(limit)])
+        # A weak ETag, since the same content may be sent gzip- or Brotli-encoded.
+        opaque_tag = '"' + hashlib.sha1(etag_source.encode("utf-8")).hexdigest() + '"'
+        headers = {"ETag": "W/" + opaque_tag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if opaque_tag in [tag.strip().removeprefix("W/") for tag in req.headers.get('If-None-Match', '').split(',')]:
+            return https_fn.Response(status=304, headers=headers)
+
+        fields = CHAT_MESSAGE_FIELDS + ([f'text_{lang}'] if lang else [f'text_{code}' for code in TRANSLATION_TARGET_LANGUAGES])
+        collection = _chat_room_messages(db, room)
+
+        docs = None
+        if since:
+            since_time, since_id = _decode_time_cursor(since)
+            query = collection.order_by('updatedAt').order_by('__name__')
+            if since_id:
+                query = query.start_after({'updatedAt': since_time, '__name__': collection.document(since_id)})
+            else:
+                query = query.where(filter=firestore.FieldFilter('updatedAt', '>', since_time))
+            # One extra message tells whether there is more after this page.
+            docs = list(query.select(fields).limit(limit + 1).stream())
+            has_more = len(docs) > limit
+            docs = docs[:limit]
+        elif CHAT_BUCKETS_ENABLED and not before:
+            # One extra message tells whether there is older history.
+            entries = _read_latest_from_buckets(db, room, limit + 1)
+            if len(entries) > limit:
+                docs = [_BucketedMessage(entry) for entry in entries[-limit:]]
+                has_more = True
+        if docs is None:
+            query = collection.order_by('timestamp', direction=firestore.Query.DESCENDING) \
+                .order_by('__name__', direction=firestore.Query.DESCENDING)
+            if before:
+                before_time, before_id = _decode_time_cursor(before)
+                if before_id:
+                    query = query.start_after({'timestamp': before_time, '__name__': collection.document(before_id)})
+                else:
+                    query = query.where(filter=firestore.FieldFilter('timestamp', '<', before_time))
+            docs = list(query.select(fields).limit(limit + 1).stream())
+            has_more = len(docs) > limit
+            docs = docs[:limit]
+            # The messages are fetched in descending order, so we reverse them
+            # to show the oldest of the batch first.
+            docs.reverse()
+
+        messages = [_chat_message_view(doc, lang) for doc in docs]
+        response = {"messages": messages, "has_more": has_more}
+
+        if docs:
+            # Scroll-back continues from the oldest message returned.
+            oldest = docs[0]
+            response["before_cursor"] = _encode_cursor(oldest.get('timestamp'), oldest.id)
+        # Sync continues from the newest change seen, or from the caller's cursor.
+        updated = [doc for doc in docs if doc.to_dict().get('updatedAt')]
+        if updated:
+            newest = max(updated, key=lambda doc: (doc.get('updatedAt'), doc.id))
+            response["sync_cursor"] = _encode_cursor(newest.get('updatedAt'), newest.id)
+        else:
+            response["sync_cursor"] = since
+
+        return json_response(req, response, headers=headers)
+    except ValueError as ve:
+        return https_fn.Response(f"Error: {ve}", status=400)
     except Exception as e:
         print(f"Error getting community messages: {e}")
         return https_fn.Response("Internal server error.", status=500)
 
 
-@https_fn.on_request()
+# How long an instance reuses a room's message count for ranking searches.
+SEARCH_ROOM_SIZE_TTL_SECONDS = float(os.environ.get("SEARCH_ROOM_SIZE_TTL_SECONDS", "600"))
+
+# room -> {"total": ..., "checked_at": ...}
+_search_room_sizes = {}
+_search_room_sizes_lock = threading.Lock()
+
+
+def _search_token_frequencies(collection, room: str, tokens: list):
+    """
+    Counts, with aggregation queries run in parallel, the messages in a room
+    containing each token and all messages in the room. The room count only
+    scales the ranking, so it is reused for SEARCH_ROOM_SIZE_TTL_SECONDS.
+
+    Returns:
+        A tuple of ({token: count}, total count).
+    """
+    def count(query) -> int:
+        return int(query.count().get()[0][0].value)
+
+    with _search_room_sizes_lock:
+        cached = _search_room_sizes.get(room)
+    fresh = cached and time.monotonic() - cached["checked_at"] < SEARCH_ROOM_SIZE_TTL_SECONDS
+
+    with ThreadPoolExecutor(max_workers=len(tokens) + 1) as executor:
+        futures = {
+            token: executor.submit(count, collection.where(filter=firestore.FieldFilter('searchTokens', 'array_contains', token)))
+            for token in tokens
+        }
+        total_future = None if fresh else executor.submit(count, collection)
+        frequencies = {token: future.result() for token, future in futures.items()}
+        total = cached["total"] if fresh else total_future.result()
+
+    if not fresh:
+        with _search_room_sizes_lock:
+            _search_room_sizes[room] = {"total": total, "checked_at": time.monotonic()}
+    return frequencies, total
+
+
+@https_fn.on_request(**LIGHT_FUNCTION_OPTIONS)
+def searchCommunityMessages(req: https_fn.Request) -> https_fn.Response:
+    """
+    HTTP endpoint to search a chat room's messages in any language.
+
+    Query parameters:
+    - q: the search text (required), e.g. "pink bollworm" or "गुलाबी सुंडी".
+    - room: the room to search (default 'global').
+    - lang: return each message's 'text' in this language.
+    - limit: the page size (default 20, at most 50).
+    - page_token: the 'next_page_token' from an earlier response.
+
+    Matches are the messages containing the rarest query word, newest first,
+    read in batches of SEARCH_CANDIDATE_LIMIT from the 'searchTokens' index.
+    Each batch is ranked by how many of the rarer query words a message
+    contains, then by recency.
+    """
+    try:
+        query_text = req.args.get('q', '').strip()
+        if not query_text:
+            return https_fn.Response(json.dumps({"error": "Missing 'q' query parameter."}), status=400, mimetype="application/json")
+        room = _validate_chat_room(req.args.get('room'))
+        lang = req.args.get('lang', '').lower()
+        if lang and lang not in CHAT_LANGUAGES:
+            return https_fn.Response(json.dumps({"error": f"'lang' must be one of {CHAT_LANGUAGES}."}), status=400, mimetype="application/json")
+        if lang == 'en':
+            lang = ''
+        try:
+            limit = min(max(int(req.args.get('limit', 20)), 1), 50)
+        except ValueError:
+            return https_fn.Response(json.dumps({"error": "'limit' must be a number."}), status=400, mimetype="application/json")
+        page = decode_page_token(req.args['page_token']) if req.args.get('page_token') else None
+
+        tokens = query_tokens(query_text)
+        if not tokens:
+            return https_fn.Response(json.dumps({"results": [], "next_page_token": None}), mimetype="application/json")
+
+        db = get_firestore_client()
+        collection = _chat_room_messages(db, room)
+        frequencies, total = _search_token_frequencies(collection, room, tokens)
+        # A page token keeps the anchor it started with, so pages stay consistent.
+        anchor = page["anchor"] if page and page["anchor"] in tokens else choose_anchor(frequencies)
+        if not anchor:
+            return https_fn.Response(json.dumps({"results": [], "next_page_token": None}), mimetype="application/json")
+        after = page["after"] if page else None
+        offset = page["offset"] if page else 0
+
+        fields = CHAT_MESSAGE_FIELDS + ['searchTokens'] + (
+            [f'text_{lang}'] if lang else [f'text_{code}' for code in TRANSLATION_TARGET_LANGUAGES]
+        )
+        query = (
+            collection
+            .where(filter=firestore.FieldFilter('searchTokens', 'array_contains', anchor))
+            .order_by('timestamp', direction=firestore.Query.DESCENDING)
+            .order_by('__name__', direction=firestore.Query.DESCENDING)
+        )
+        if after:
+            query = query.start_after({'timestamp': after[0], '__name__': collection.document(after[1])})
+        batch = list(query.select(fields).limit(SEARCH_CANDIDATE_LIMIT).stream())
+        candidates = [{**doc.to_dict(), 'id': doc.id} for doc in batch]
+        ranked = rank_messages(candidates, tokens, frequencies, total)
+
+        results = []
+        for candidate in ranked[offset:offset + limit]:
+            matched = [token for token in tokens if token in (candidate.get('searchTokens') or [])]
+            view = _chat_message_view(_BucketedMessage(candidate), lang)
+            view.pop('searchTokens', None)
+            view['matched'] = matched
+            results.append(view)
+        next_offset = offset + limit
+        next_page_token = None
+        if next_offset < len(ranked):
+            next_page_token = encode_page_token(anchor, (after[0].isoformat(), after[1]) if after else None, next_offset)
+        elif len(batch) == SEARCH_CANDIDATE_LIMIT:
+            # Continue with the next batch of older messages.
+            last = batch[-1]
+            next_page_token = encode_page_token(anchor, (last.get('timestamp').isoformat(), last.id), 0)
+        response = {"results": results, "next_page_token": next_page_token}
+        return json_response(req, response)
+
+    except ValueError as ve:
+        return https_fn.Response(json.dumps({"error": str(ve)}), status=400, mimetype="application/json")
+    except Exception as e:
+        print(f"Error searching community messages: {e}")
+        return https_fn.Response(json.dumps({"error": f"An internal error occurred: {e}"}), status=500, mimetype="application/json")
+
+
+# Values of a chat message's 'translationStatus' field.
+TRANSLATION_PENDING = "pending"
+TRANSLATION_IN_PROGRESS = "in_progress"
+TRANSLATION_DONE = "done"
+TRANSLATION_FAILED = "failed"
+# A translation claimed longer ago than this is assumed to have crashed and may be claimed again.
+TRANSLATION_CLAIM_TIMEOUT_SECONDS = int(os.environ.get("TRANSLATION_CLAIM_TIMEOUT_SECONDS", "600"))
+# The translation triggers are retried on failure, until the event is this old.
+TRANSLATION_RETRY_MAX_AGE_SECONDS = int(os.environ.get("TRANSLATION_RETRY_MAX_AGE_SECONDS", "3600"))
+
+
+@https_fn.on_request(**LIGHT_FUNCTION_OPTIONS)
 def sendCommunityMessage(req: https_fn.Request) -> https_fn.Response:
     """
-    HTTP endpoint to receive, (transcribe), translate, and save a new chat message.
+    HTTP endpoint to receive and save a new chat message.
     Expects a JSON body with senderId, senderName, and EITHER 'text' OR 'audio_url'.
+    An optional 'room' selects the chat room (default 'global'), and an
+    optional 'languages' list of language codes (primary first) overrides
+    TRANSCRIBE_LANGUAGES for audio.
+
+    The message is stored right away with a 'translationStatus' of "pending";
+    the translation trigger transcribes and translates it afterwards and then
+    notifies the room.
     """
     if req.method != "POST" or not req.is_json:
         return https_fn.Response("Invalid request.", status=400)
@@ -963,123 +1964,498 @@ def sendCommunityMessage(req: https_fn.Request) -> https_fn.Response:
         if not original_text and not audio_url:
             return https_fn.Response("Request must include 'text' or 'audio_url'.", status=400)
 
-        # --- Speech-to-Text Step (if audio is provided) ---
-        if audio_url:
-            try:
-                print(f"Processing audio from URL: {audio_url}")
-                speech_client = get_speech_client()
-
-                # Download the audio content from the URL
-                audio_response = requests.get(audio_url)
-                audio_response.raise_for_status()
-                audio_content = audio_response.content
-
-                audio = speech.RecognitionAudio(content=audio_content)
-
-                # Configure the speech recognition request.
-                # This assumes the client sends audio in WEBM/Opus format.
-                config = speech.RecognitionConfig(
-                    encoding=speech.RecognitionConfig.AudioEncoding.WEBM_OPUS,
-                    sample_rate_hertz=16000, # Adjust if client sends a different sample rate
-                    language_code="en-IN",
-                    model="telephony", # A model optimized for audio from a phone call
-                )
-
-                print("Sending audio to Speech-to-Text API...")
-                response = speech_client.recognize(config=config, audio=audio)
-
-                if not response.results or not response.results[0].alternatives:
-                    return https_fn.Response("Could not transcribe audio.", status=400)
-                
-                original_text = response.results[0].alternatives[0].transcript
-                print(f"Successfully transcribed audio: '{original_text}'")
-            except Exception as e:
-                print(f"Error during speech-to-text processing: {e}")
-                return https_fn.Response(f"Failed to process audio: {e}", status=500)
-
-        # --- Translation Step (for original text or transcribed text) ---
-        translate_client = get_translate_client()
-        text_hi = original_text
-        text_ta = original_text
         try:
-            translation_hi = translate_client.translate(original_text, target_language='hi')
-            text_hi = translation_hi['translatedText']
-            translation_ta = translate_client.translate(original_text, target_language='ta')
-            text_ta = translation_ta['translatedText']
+            room = _validate_chat_room(data.get("room"))
+            languages = _validate_transcribe_languages(data["languages"]) if data.get("languages") else None
+        except ValueError as ve:
+            return https_fn.Response(str(ve), status=400)
 
-            print(f"Translated text for storage: hi='{text_hi}', ta='{text_ta}'")
-        except Exception as e:
-            print(f"Warning: Translation failed. Storing original text only. Error: {e}")
-
-        db = get_firestore_client()
         message_data = {
             'senderId': sender_id,
             'senderName': sender_name,
-            'text': original_text,
-            'text_hi': text_hi,
-            'text_ta': text_ta,
-            'timestamp': firestore.SERVER_TIMESTAMP
+            'room': room,
+            'text': original_text or "",
+            'translationStatus': TRANSLATION_PENDING,
+            'timestamp': firestore.SERVER_TIMESTAMP,
+            'updatedAt': firestore.SERVER_TIMESTAMP,
         }
-        db.collection('community_chat').add(message_data)
+        if audio_url:
+            message_data['audio_url'] = audio_url
+            if languages:
+                message_data['languages'] = languages
 
-        return https_fn.Response("Message sent successfully.", status=200)
+        db = get_firestore_client()
+        _, doc_ref = _chat_room_messages(db, room).add(message_data)
+
+        return https_fn.Response(
+            json.dumps({"message": "Message sent successfully.", "id": doc_ref.id, "room": room,
+                        "translationStatus": TRANSLATION_PENDING}),
+            mimetype="application/json",
+        )
 
     except Exception as e:
         print(f"Error sending message: {e}")
         return https_fn.Response("Internal server error.", status=500)
 
 
-FCM_TOPIC = "community_chat_updates"
+def _update_chat_room_membership(req: https_fn.Request, join: bool) -> https_fn.Response:
+    """
+    Adds a room to, or removes it from, a user's profile. The room is given as
+    'room', or as 'district' or 'crop' names. If 'fcm_token' is provided, the
+    device is also subscribed to, or unsubscribed from, the room's topic for
+    its 'lang' (or the all-language topic when no 'lang' is given).
+    """
+    try:
+        request_json = req.get_json(silent=True)
+        if not request_json or not request_json.get('user_id'):
+            return https_fn.Response(json.dumps({"error": "Missing 'user_id'."}), status=400, mimetype="application/json")
 
-@firestore_fn.on_document_created(document="community_chat/{messageId}", database=DATABASE)
-def notifyOnNewMessage(event: firestore_fn.Event[firestore.DocumentSnapshot | None]) -> None:
+        try:
+            if request_json.get('room'):
+                room = _validate_chat_room(request_json['room'])
+            elif request_json.get('district'):
+                room = _chat_room_id("district", request_json['district'])
+            elif request_json.get('crop'):
+                room = _chat_room_id("crop", request_json['crop'])
+            else:
+                raise ValueError("Provide 'room', 'district' or 'crop'.")
+        except ValueError as ve:
+            return https_fn.Response(json.dumps({"error": str(ve)}), status=400, mimetype="application/json")
+
+        lang = (request_json.get('lang') or '').lower() or None
+        if lang and lang not in CHAT_LANGUAGES:
+            return https_fn.Response(json.dumps({"error": f"'lang' must be one of {CHAT_LANGUAGES}."}), status=400, mimetype="application/json")
+
+        db = get_firestore_client()
+        user_ref = db.collection(USERS_COLLECTION).document(request_json['user_id'])
+        user_ref.set({
+            'chatRooms': firestore.ArrayUnion([room]) if join else firestore.ArrayRemove([room]),
+            'updatedAt': firestore.SERVER_TIMESTAMP,
+        }, merge=True)
+
+        topic = _chat_room_topic(room, lang)
+        fcm_token = request_json.get('fcm_token')
+        if fcm_token:
+            if join:
+                messaging.subscribe_to_topic([fcm_token], topic)
+            else:
+                messaging.unsubscribe_from_topic([fcm_token], topic)
+
+        action = "Joined" if join else "Left"
+        print(f"{action} room '{room}' for user '{request_json['user_id']}'.")
+        return https_fn.Response(json.dumps({"room": room, "topic": topic, "joined": join}), mimetype="application/json")
+
+    except Exception as e:
+        return https_fn.Response(json.dumps({"error": f"An internal error occurred: {e}"}), status=500, mimetype="application/json")
+
+
+@https_fn.on_request(**LIGHT_FUNCTION_OPTIONS)
+def joinChatRoom(req: https_fn.Request) -> https_fn.Response:
+    """
+    HTTP endpoint for a user to join a district or crop chat room.
+    Expects a JSON body with 'user_id' and one of 'room', 'district' or 'crop',
+    and an optional 'fcm_token' and 'lang' to subscribe to the room's topic
+    for that language.
+    """
+    return _update_chat_room_membership(req, join=True)
+
+
+@https_fn.on_request(**LIGHT_FUNCTION_OPTIONS)
+def leaveChatRoom(req: https_fn.Request) -> https_fn.Response:
+    """
+    HTTP endpoint for a user to leave a chat room.
+    Expects the same JSON body as joinChatRoom.
+    """
+    return _update_chat_room_membership(req, join=False)
+
+
+@https_fn.on_request(**LIGHT_FUNCTION_OPTIONS)
+def getChatRooms(req: https_fn.Request) -> https_fn.Response:
+    """
+    HTTP endpoint that lists the rooms a user has joined, with their FCM topics.
+    Expects a 'user_id' query parameter and an optional 'lang' for the
+    language-specific topics. Every user is in the global room.
+    """
+    try:
+        user_id = req.args.get('user_id')
+        if not user_id:
+            return https_fn.Response(json.dumps({"error": "Missing 'user_id' query parameter."}), status=400, mimetype="application/json")
+
+        lang = (req.args.get('lang') or '').lower() or None
+        if lang and lang not in CHAT_LANGUAGES:
+            return https_fn.Response(json.dumps({"error": f"'lang' must be one of {CHAT_LANGUAGES}."}), status=400, mimetype="application/json")
+
+        db = get_firestore_client()
+        user_doc = db.collection(USERS_COLLECTION).document(user_id).get(field_paths=['chatRooms'])
+        rooms = [DEFAULT_CHAT_ROOM] + [
+            room for room in ((user_doc.to_dict() or {}).get('chatRooms') or []) if room != DEFAULT_CHAT_ROOM
+        ]
+        return https_fn.Response(
+            json.dumps({"rooms": [{"room": room, "topic": _chat_room_topic(room, lang)} for room in rooms]}),
+            mimetype="application/json",
+        )
+    except Exception as e:
+        return https_fn.Response(json.dumps({"error": f"An internal error occurred: {e}"}), status=500, mimetype="application/json")
+
+
+@firestore.transactional
+def _claim_pending_message(transaction, message_ref, event_id: str) -> bool:
     """
-    Triggered when a new message is created. Reads the message data, including
-    pre-translated text, and sends it in an FCM data message.
+    Marks a pending message as in progress. A message already in progress can
+    be claimed again by a retry of the same event, or once its claim is stale.
+    Returns False if another worker holds the claim or the work is done.
     """
+    snapshot = message_ref.get(
+        transaction=transaction, field_paths=['translationStatus', 'translationClaimedBy', 'translationClaimedAt']
+    )
+    if not snapshot.exists:
+        return False
+    data = snapshot.to_dict() or {}
+    status = data.get('translationStatus')
+    if status == TRANSLATION_IN_PROGRESS:
+        claimed_at = data.get('translationClaimedAt')
+        stale = claimed_at is None or \
+            (datetime.now(timezone.utc) - claimed_at).total_seconds() > TRANSLATION_CLAIM_TIMEOUT_SECONDS
+        if data.get('translationClaimedBy') != event_id and not stale:
+            return False
+    elif status != TRANSLATION_PENDING:
+        return False
+    transaction.update(message_ref, {
+        'translationStatus': TRANSLATION_IN_PROGRESS,
+        'translationClaimedBy': event_id,
+        'translationClaimedAt': datetime.now(timezone.utc),
+    })
+    return True
+
+
+def _translate_chat_message(event: firestore_fn.Event[firestore.DocumentSnapshot | None], room: str) -> None:
+    """
+    Transcribes an audio message, translates the text into every target
+    language, stores the results and the message's search tokens on the
+    message and then notifies the room.
+    """
+    if event.data is None:
+        return
+    message_data = event.data.to_dict()
+    if message_data.get('translationStatus') != TRANSLATION_PENDING:
+        return
+
+    db = get_firestore_client()
+    message_ref = _chat_room_messages(db, room).document(event.params['messageId'])
+    event_age = (datetime.now(timezone.utc) - event.time).total_seconds() if event.time else 0
+    if event_age > TRANSLATION_RETRY_MAX_AGE_SECONDS:
+        print(f"Giving up on translating message {message_ref.id} after {event_age:.0f}s of retries.")
+        try:
+            message_ref.update({'translationStatus': TRANSLATION_FAILED, 'updatedAt': firestore.SERVER_TIMESTAMP})
+        except Exception as e:
+            print(f"Could not mark message {message_ref.id} as failed: {e}")
+        return
+    # Triggers are delivered at least once, so only one delivery does the work.
+    # A retry of a delivery that crashed carries the same event ID and takes over its claim.
+    if not _claim_pending_message(db.transaction(), message_ref, event.id):
+        print(f"Message {message_ref.id} is already being translated.")
+        return
+
+    updates = {}
     try:
-        if event.data is None:
-            print("No data associated with the event.")
+        original_text = message_data.get('text')
+        audio_url = message_data.get('audio_url')
+        if not original_text and audio_url:
+            # Imported here because it loads the Speech-to-Text SDK.
+            from transcription import transcribe_audio
+
+            print(f"Processing audio from URL: {audio_url}")
+            audio_content, _ = _download_media(audio_url)
+            transcript = transcribe_audio(
+                get_speech_client(), db, audio_content, languages=message_data.get('languages')
+            )
+            if not transcript['text']:
+                raise ValueError("Could not transcribe audio.")
+            original_text = transcript['text']
+            updates['text'] = original_text
+            print(f"Successfully transcribed audio ({transcript['language']}): '{original_text}'")
+
+        translations = translate_text(get_translate_client(), db, original_text)
+        for language, translated in translations.items():
+            updates[f'text_{language}'] = translated
+        updates['searchTokens'] = message_search_tokens([original_text, *translations.values()])
+        updates['translationStatus'] = TRANSLATION_DONE
+    except Exception as e:
+        print(f"Error translating message {message_ref.id}: {e}")
+        updates['translationStatus'] = TRANSLATION_FAILED
+        if original_text:
+            updates['searchTokens'] = message_search_tokens([original_text])
+
+    updates['updatedAt'] = firestore.SERVER_TIMESTAMP
+    try:
+        message_ref.update(updates)
+    except Exception as e:
+        print(f"Error saving the translation of message {message_ref.id}: {e}")
+        # The trigger is retried, and the retry takes over this delivery's claim.
+        raise
+    # If translation failed, the original text is still sent.
+    _send_chat_notification({**message_data, **updates}, room)
+
+
+@firestore_fn.on_document_created(document="community_chat/{messageId}", database=DATABASE, retry=True, **AI_FUNCTION_OPTIONS)
+def translateCommunityMessage(event: firestore_fn.Event[firestore.DocumentSnapshot | None]) -> None:
+    """Triggered when a new message is created in the global room."""
+    _translate_chat_message(event, DEFAULT_CHAT_ROOM)
+
+
+@firestore_fn.on_document_created(document="chat_rooms/{roomId}/messages/{messageId}", database=DATABASE, retry=True, **AI_FUNCTION_OPTIONS)
+def translateRoomMessage(event: firestore_fn.Event[firestore.DocumentSnapshot | None]) -> None:
+    """Triggered when a new message is created in a district or crop room."""
+    _translate_chat_message(event, event.params['roomId'])
+
+
+def _sync_chat_bucket(event: firestore_fn.Event[firestore_fn.Change[firestore.DocumentSnapshot | None]], room: str) -> None:
+    """
+    Keeps the time buckets consistent with the individual message documents:
+    new messages are appended, updates (e.g. translations) are copied and
+    deleted messages are removed.
+    """
+    if not CHAT_BUCKETS_ENABLED:
+        return
+    before = event.data.before.to_dict() if event.data.before and event.data.before.exists else None
+    after = event.data.after.to_dict() if event.data.after and event.data.after.exists else None
+    message_id = event.params['messageId']
+    db = get_firestore_client()
+
+    try:
+        if after is None:
+            if before and before.get('bucketId'):
+                db.collection(CHAT_BUCKET_COLLECTION).document(before['bucketId']).update({
+                    f'messages.`{message_id}`': firestore.DELETE_FIELD,
+                    'count': firestore.Increment(-1),
+                })
             return
 
-        message_data = event.data.to_dict()
-        sender_id = message_data.get("senderId", "unknown_id")
-        sender_name = message_data.get("senderName", "Unknown")
-        original_text = message_data.get("text", "")
+        entry = _chat_bucket_entry(after)
+        if after.get('bucketId'):
+            # Recording the bucket ID is this trigger's own write; nothing else changed.
+            if before and _chat_bucket_entry(before) == entry:
+                return
+            db.collection(CHAT_BUCKET_COLLECTION).document(after['bucketId']).update({
+                f'messages.`{message_id}`': entry,
+                'updatedAt': firestore.SERVER_TIMESTAMP,
+            })
+            return
+
+        if after.get('timestamp') is None:
+            return
+        message_ref = _chat_room_messages(db, room).document(message_id)
+        bucket_id = _add_to_chat_bucket(db.transaction(), db, message_ref, room)
+        print(f"Copied message {message_id} to chat bucket {bucket_id}.")
+    except Exception as e:
+        print(f"Error syncing message {message_id} to its chat bucket: {e}")
+
+
+@firestore_fn.on_document_written(document="community_chat/{messageId}", database=DATABASE, **LIGHT_FUNCTION_OPTIONS)
+def syncChatBucket(event: firestore_fn.Event[firestore_fn.Change[firestore.DocumentSnapshot | None]]) -> None:
+    """Keeps the global room's time buckets consistent with its messages."""
+    _sync_chat_bucket(event, DEFAULT_CHAT_ROOM)
+
 
-        if not original_text:
+@firestore_fn.on_document_written(document="chat_rooms/{roomId}/messages/{messageId}", database=DATABASE, **LIGHT_FUNCTION_OPTIONS)
+def syncRoomChatBucket(event: firestore_fn.Event[firestore_fn.Change[firestore.DocumentSnapshot | None]]) -> None:
+    """Keeps a district or crop room's time buckets consistent with its messages."""
+    _sync_chat_bucket(event, event.params['roomId'])
+
+
+@firestore_fn.on_document_created(document="community_chat/{messageId}", database=DATABASE, **LIGHT_FUNCTION_OPTIONS)
+def notifyOnNewMessage(event: firestore_fn.Event[firestore.DocumentSnapshot | None]) -> None:
+    """
+    Triggered when a new message is created. Messages that still need
+    translation are announced by the translation trigger instead, once
+    their translations are ready.
+    """
+    if event.data is None:
+        print("No data associated with the event.")
+        return
+
+    message_data = event.data.to_dict()
+    if message_data.get('translationStatus') in (TRANSLATION_PENDING, TRANSLATION_IN_PROGRESS):
+        return
+    _send_chat_notification(message_data, DEFAULT_CHAT_ROOM)
+
+
+# --- Chat Notifications ---
+# Every message is sent to one topic per language ('<room topic>_<lang>') with
+# only that language's text. FCM_LEGACY_TOPIC_ENABLED also sends the original
+# all-language payload to the room topic for older app versions.
+# Within FCM_COALESCE_SECONDS of a push to a room, further messages are
+# counted instead of pushed, and a task sends one "N new messages" push when
+# the window ends.
+CHAT_LANGUAGES = ['en'] + [lang for lang in TRANSLATION_TARGET_LANGUAGES if lang != 'en']
+FCM_LEGACY_TOPIC_ENABLED = os.environ.get("FCM_LEGACY_TOPIC_ENABLED", "true").lower() == "true"
+FCM_COALESCE_SECONDS = float(os.environ.get("FCM_COALESCE_SECONDS", "10"))
+CHAT_NOTIFICATION_STATE_COLLECTION = "chat_notification_state"
+COALESCED_MESSAGE_TEMPLATES = {
+    "en": ("1 new message", "{count} new messages"),
+    "hi": ("1 नया संदेश", "{count} नए संदेश"),
+    "ta": ("1 புதிய செய்தி", "{count} புதிய செய்திகள்"),
+}
+
+
+def _coalesced_text(lang: str, count: int) -> str:
+    singular, plural = COALESCED_MESSAGE_TEMPLATES.get(lang, COALESCED_MESSAGE_TEMPLATES["en"])
+    return singular if count == 1 else plural.format(count=count)
+
+
+def _chat_message_payloads(message_data: dict, room: str) -> list:
+    """Builds one FCM message per language topic for a chat message."""
+    sender_id = message_data.get("senderId", "unknown_id")
+    sender_name = message_data.get("senderName", "Unknown")
+    original_text = message_data.get("text", "")
+
+    # Convert the Firestore timestamp to a string for the payload.
+    timestamp_str = ""
+    timestamp = message_data.get("timestamp")
+    if timestamp:
+        # Firestore Timestamps can be converted to python datetimes.
+        if hasattr(timestamp, 'to_datetime') and callable(timestamp.to_datetime):
+            timestamp_str = timestamp.to_datetime().isoformat()
+        elif isinstance(timestamp, datetime):
+            timestamp_str = timestamp.isoformat()
+
+    base = {
+        'type': 'message',
+        'senderId': sender_id,
+        'senderName': sender_name,
+        'room': room,
+        'timestamp': timestamp_str,
+    }
+    # Fallback to original text if translated fields are missing.
+    texts = {lang: message_data.get(f"text_{lang}") or original_text for lang in CHAT_LANGUAGES}
+    texts['en'] = original_text
+    payloads = [
+        messaging.Message(data={**base, 'lang': lang, 'text': text}, topic=_chat_room_topic(room, lang))
+        for lang, text in texts.items()
+    ]
+    if FCM_LEGACY_TOPIC_ENABLED:
+        legacy = {**base, 'text': original_text}
+        legacy.update({f"text_{lang}": text for lang, text in texts.items() if lang != 'en'})
+        payloads.append(messaging.Message(data=legacy, topic=_chat_room_topic(room)))
+    return payloads
+
+
+def _coalesced_payloads(room: str, count: int) -> list:
+    """Builds the "N new messages" push for each language topic."""
+    payloads = []
+    for lang in CHAT_LANGUAGES:
+        data = {'type': 'summary', 'room': room, 'count': str(count), 'lang': lang, 'text': _coalesced_text(lang, count)}
+        payloads.append(messaging.Message(data=data, topic=_chat_room_topic(room, lang)))
+    if FCM_LEGACY_TOPIC_ENABLED:
+        data = {'type': 'summary', 'room': room, 'count': str(count), 'text': _coalesced_text("en", count)}
+        payloads.append(messaging.Message(data=data, topic=_chat_room_topic(room)))
+    return payloads
+
+
+def _send_payloads(payloads: list) -> None:
+    """Sends all payloads in one FCM batch request. Raises RuntimeError if none was sent."""
+    response = messaging.send_each(payloads)
+    print(f"Sent {response.success_count} of {len(payloads)} FCM messages.")
+    if payloads and response.success_count == 0:
+        errors = {str(r.exception) for r in response.responses if r.exception}
+        raise RuntimeError(f"No FCM message was sent: {'; '.join(errors)}")
+
+
+@firestore.transactional
+def _reserve_chat_push(transaction, state_ref) -> str:
+    """
+    Decides whether a new message is pushed now or counted toward a coalesced
+    push. Returns "send", "schedule" (counted; the caller schedules the flush)
+    or "count" (counted; a flush is already scheduled).
+    """
+    snapshot = state_ref.get(transaction=transaction)
+    state = snapshot.to_dict() if snapshot.exists else {}
+    now = datetime.now(timezone.utc)
+    last_sent = state.get('lastSentAt')
+    if last_sent is None or (now - last_sent).total_seconds() >= FCM_COALESCE_SECONDS:
+        transaction.set(state_ref, {'lastSentAt': now, 'pendingCount': 0, 'flushScheduled': False})
+        return "send"
+    transaction.set(state_ref, {'pendingCount': firestore.Increment(1), 'flushScheduled': True}, merge=True)
+    return "count" if state.get('flushScheduled') else "schedule"
+
+
+@firestore.transactional
+def _take_coalesced_count(transaction, state_ref) -> int:
+    """Returns and clears the number of messages waiting for a coalesced push."""
+    snapshot = state_ref.get(transaction=transaction)
+    state = snapshot.to_dict() if snapshot.exists else {}
+    count = state.get('pendingCount', 0)
+    updates = {'pendingCount': 0, 'flushScheduled': False}
+    if count:
+        updates['lastSentAt'] = datetime.now(timezone.utc)
+    transaction.set(state_ref, updates, merge=True)
+    return count
+
+
+def _send_chat_notification(message_data: dict, room: str) -> None:
+    """
+    Notifies a room of a new message, or counts it toward a coalesced push
+    when the room was notified within the last FCM_COALESCE_SECONDS.
+    """
+    try:
+        sender_name = message_data.get("senderName", "Unknown")
+        if not message_data.get("text"):
             print("Message text is empty, skipping notification.")
             return
 
-        # The translations are now read directly from the document.
-        # Fallback to original text if translated fields are missing.
-        text_hi = message_data.get("text_hi", original_text)
-        text_ta = message_data.get("text_ta", original_text)
-
-        # Convert the Firestore timestamp to a string for the payload.
-        timestamp_str = ""
-        timestamp = message_data.get("timestamp")
-        if timestamp:
-            # Firestore Timestamps can be converted to python datetimes.
-            if hasattr(timestamp, 'to_datetime') and callable(timestamp.to_datetime):
-                timestamp_str = timestamp.to_datetime().isoformat()
-            elif isinstance(timestamp, datetime):
-                timestamp_str = timestamp.isoformat()
-
-        print(f"New message from {sender_name}. Notifying topic: {FCM_TOPIC}")
-
-        message = messaging.Message(
-            data={
-                'senderId': sender_id,
-                'senderName': sender_name,
-                'text': original_text,
-                'text_hi': text_hi,
-                'text_ta': text_ta,
-                'timestamp': timestamp_str,
-            },
-            topic=FCM_TOPIC,
-        )
-        messaging.send(message)
-        print("Successfully sent FCM message.")
+        if FCM_COALESCE_SECONDS > 0:
+            db = get_firestore_client()
+            state_ref = db.collection(CHAT_NOTIFICATION_STATE_COLLECTION).document(room)
+            decision = _reserve_chat_push(db.transaction(), state_ref)
+            if decision != "send":
+                if decision == "schedule":
+                    try:
+                        admin_functions.task_queue("flushChatNotifications").enqueue(
+                            {"room": room},
+                            admin_functions.TaskOptions(schedule_delay_seconds=int(math.ceil(FCM_COALESCE_SECONDS))),
+                        )
+                    except Exception as e:
+                        # Without a scheduled flush the count would wait for the next message.
+                        print(f"Could not schedule a coalesced push for room '{room}': {e}")
+                        taken = _take_coalesced_count(db.transaction(), state_ref)
+                        try:
+                            # Other messages may have been counted since, so cover them all.
+                            _send_payloads(
+                                _coalesced_payloads(room, taken) if taken > 1
+                                else _chat_message_payloads(message_data, room)
+                            )
+                        except Exception:
+                            # Add the count back rather than overwrite counts reserved meanwhile.
+                            state_ref.set({'pendingCount': firestore.Increment(taken)}, merge=True)
+                            raise
+                        return
+                print(f"Coalescing the message from {sender_name} into the next push to room '{room}'.")
+                return
+
+        print(f"New message from {sender_name}. Notifying room '{room}'.")
+        _send_payloads(_chat_message_payloads(message_data, room))
     except Exception as e:
         print(f"Error sending FCM message: {e}")
+
+
+@tasks_fn.on_task_dispatched(
+    retry_config=RetryConfig(max_attempts=3, min_backoff_seconds=5), **LIGHT_FUNCTION_OPTIONS
+)
+def flushChatNotifications(req: tasks_fn.CallableRequest) -> None:
+    """
+    A task queued when a room's notifications are being coalesced. Sends one
+    "N new messages" push for the messages counted since the last push.
+    """
+    room = req.data.get("room", DEFAULT_CHAT_ROOM)
+    db = get_firestore_client()
+    state_ref = db.collection(CHAT_NOTIFICATION_STATE_COLLECTION).document(room)
+    count = _take_coalesced_count(db.transaction(), state_ref)
+    if count:
+        print(f"Sending a coalesced push for {count} message(s) to room '{room}'.")
+        try:
+            _send_payloads(_coalesced_payloads(room, count))
+        except Exception as e:
+            # Put the count back so the task's retry, or the next flush, sends it.
+            print(f"Coalesced push to room '{room}' failed; restoring the count of {count}. Error: {e}")
+            state_ref.set({'pendingCount': firestore.Increment(count), 'flushScheduled': True}, merge=True)
+            raise
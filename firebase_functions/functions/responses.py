@@ -0,0 +1,95 @@
+"""
+Fast JSON encoding and compression for HTTP responses.
+
+`json_response` serializes with orjson when it is installed, and falls back
+to the standard library otherwise. orjson encodes plain datetimes natively,
+but rejects subclasses such as Firestore's `DatetimeWithNanoseconds`, so
+those still go through `_default`, which formats them directly instead of
+through a JSONEncoder subclass. Bodies larger than
+`COMPRESSION_MIN_BYTES` are Brotli- or gzip-encoded according to the
+request's Accept-Encoding header. Brotli requires the `brotli` package.
+"""
+import gzip
+import json
+import os
+from datetime import datetime
+from typing import Optional
+
+from firebase_functions import https_fn
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are sent uncompressed; compressing them saves little.
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", "1024"))
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+
+def _default(o):
+    """Serializes the values neither JSON backend handles itself, e.g. Firestore timestamps."""
+    if isinstance(o, datetime):
+        # The base method, since subclasses may override isoformat().
+        return datetime.isoformat(o)
+    # Firestore's protobuf Timestamp.
+    if hasattr(o, 'to_datetime') and callable(o.to_datetime):
+        return o.to_datetime().isoformat()
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+def encode_json(data) -> bytes:
+    """Returns data as compact UTF-8 JSON."""
+    if orjson is not None:
+        return orjson.dumps(data, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _accepted_encodings(header: Optional[str]) -> set:
+    """Returns the content codings an Accept-Encoding header allows."""
+    accepted = set()
+    for item in (header or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def compress(body: bytes, accept_encoding: Optional[str]):
+    """
+    Compresses a body with the best coding the client accepts.
+
+    Returns:
+        A tuple of (body, content coding or None).
+    """
+    if len(body) < COMPRESSION_MIN_BYTES:
+        return body, None
+    accepted = _accepted_encodings(accept_encoding)
+    if brotli is not None and ("br" in accepted or "*" in accepted):
+        return brotli.compress(body, quality=BROTLI_QUALITY), "br"
+    if "gzip" in accepted or "*" in accepted:
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0), "gzip"
+    return body, None
+
+
+def json_response(req: https_fn.Request, data, status: int = 200, headers: Optional[dict] = None) -> https_fn.Response:
+    """Builds a JSON response, compressed if the client accepts it."""
+    body, coding = compress(encode_json(data), req.headers.get("Accept-Encoding"))
+    headers = dict(headers or {})
+    headers["Vary"] = "Accept-Encoding"
+    if coding:
+        headers["Content-Encoding"] = coding
+    return https_fn.Response(body, status=status, headers=headers, content_type="application/json; charset=utf-8")
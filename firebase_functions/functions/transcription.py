@@ -0,0 +1,246 @@
+"""
+Speech-to-text for community chat voice messages.
+
+The pipeline:
+1. Detects the container from the file's magic bytes.
+2. Transcodes the audio with ffmpeg to 16 kHz mono LINEAR16, detecting
+   silences in the same pass.
+3. Splits clips longer than `MAX_CHUNK_SECONDS` at silences, so each chunk
+   fits the synchronous Speech-to-Text limit, and recognizes the chunks in
+   parallel with a primary language and alternative languages.
+4. Caches the transcript by the SHA-256 of the audio and the language settings.
+
+Without ffmpeg, formats that Speech-to-Text decodes natively (WebM/Ogg Opus,
+FLAC, WAV, AMR) are sent as they are, in a single request.
+"""
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from firebase_admin import firestore
+from google.cloud import speech
+
+FFMPEG_PATH = os.environ.get("FFMPEG_PATH", "ffmpeg")
+# The first language is the primary one; the others are alternatives.
+TRANSCRIBE_LANGUAGES = [
+    code.strip() for code in os.environ.get("TRANSCRIBE_LANGUAGES", "en-IN,hi-IN,ta-IN").split(",") if code.strip()
+]
+TRANSCRIBE_CONCURRENCY = int(os.environ.get("TRANSCRIBE_CONCURRENCY", "4"))
+TRANSCRIPT_CACHE_COLLECTION = "transcript_cache"
+TRANSCRIPT_MEMORY_CACHE_SIZE = 256
+
+SAMPLE_RATE = 16000
+BYTES_PER_SECOND = SAMPLE_RATE * 2  # 16-bit mono
+# Synchronous recognition accepts up to a minute of audio per request.
+MAX_CHUNK_SECONDS = 55.0
+# Silence detection settings for ffmpeg's silencedetect filter.
+SILENCE_NOISE_DB = -35
+SILENCE_MIN_SECONDS = 0.4
+
+_SILENCE_START_RE = re.compile(r"silence_start: (-?[\d.]+)")
+_SILENCE_END_RE = re.compile(r"silence_end: ([\d.]+)")
+
+# Containers Speech-to-Text decodes without transcoding, and their encodings.
+_NATIVE_ENCODINGS = {
+    "webm": speech.RecognitionConfig.AudioEncoding.WEBM_OPUS,
+    "ogg": speech.RecognitionConfig.AudioEncoding.OGG_OPUS,
+    "flac": speech.RecognitionConfig.AudioEncoding.FLAC,
+    "wav": speech.RecognitionConfig.AudioEncoding.LINEAR16,
+    "amr": speech.RecognitionConfig.AudioEncoding.AMR,
+}
+
+
+def detect_container(data: bytes) -> Optional[str]:
+    """Identifies the audio container from its magic bytes."""
+    if data[4:8] == b"ftyp":
+        return "mp4"  # .m4a, .mp4 and .3gp
+    if data[:4] == b"\x1a\x45\xdf\xa3":
+        return "webm"
+    if data[:4] == b"OggS":
+        return "ogg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WAVE":
+        return "wav"
+    if data[:4] == b"fLaC":
+        return "flac"
+    if data[:3] == b"ID3" or (len(data) > 1 and data[0] == 0xFF and data[1] & 0xE0 == 0xE0):
+        return "mp3"
+    if data[:6] == b"#!AMR\n":
+        return "amr"
+    return None
+
+
+def transcode(data: bytes) -> Tuple[bytes, List[Tuple[float, float]]]:
+    """
+    Converts audio to raw 16 kHz mono LINEAR16 with ffmpeg.
+
+    Returns:
+        A tuple of (PCM bytes, [(silence_start, silence_end), ...] in seconds).
+    """
+    # MP4 files often store their index at the end, which ffmpeg cannot seek to
+    # through a pipe, so the input is written to a temporary file.
+    with tempfile.NamedTemporaryFile() as source:
+        source.write(data)
+        source.flush()
+        command = [
+            FFMPEG_PATH, "-hide_banner", "-nostats", "-i", source.name,
+            "-af", f"silencedetect=noise={SILENCE_NOISE_DB}dB:d={SILENCE_MIN_SECONDS}",
+            "-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "s16le", "pipe:1",
+        ]
+        result = subprocess.run(command, capture_output=True, timeout=120)
+    if result.returncode != 0:
+        raise ValueError(f"Could not decode audio: {result.stderr.decode(errors='ignore')[-300:]}")
+
+    log = result.stderr.decode(errors="ignore")
+    starts = [max(0.0, float(s)) for s in _SILENCE_START_RE.findall(log)]
+    ends = [float(e) for e in _SILENCE_END_RE.findall(log)]
+    return result.stdout, list(zip(starts, ends))
+
+
+def split_on_silence(duration: float, silences: List[Tuple[float, float]],
+                     max_chunk: float = MAX_CHUNK_SECONDS) -> List[Tuple[float, float]]:
+    """
+    Splits [0, duration] into chunks of at most `max_chunk` seconds, cutting
+    in the middle of the latest silence that fits, or hard at `max_chunk`
+    when there is none.
+    """
+    cut_points = sorted((start + end) / 2 for start, end in silences)
+    chunks = []
+    start = 0.0
+    while duration - start > max_chunk:
+        candidates = [p for p in cut_points if start < p <= start + max_chunk]
+        cut = candidates[-1] if candidates else start + max_chunk
+        chunks.append((start, cut))
+        start = cut
+    chunks.append((start, duration))
+    return chunks
+
+
+def _recognition_config(encoding, sample_rate: Optional[int], languages: List[str]) -> speech.RecognitionConfig:
+    return speech.RecognitionConfig(
+        encoding=encoding,
+        sample_rate_hertz=sample_rate,
+        language_code=languages[0],
+        alternative_language_codes=languages[1:],
+        enable_automatic_punctuation=True,
+    )
+
+
+def _recognize(speech_client, config: speech.RecognitionConfig, content: bytes) -> Tuple[str, Optional[str]]:
+    response = speech_client.recognize(config=config, audio=speech.RecognitionAudio(content=content))
+    texts = []
+    language = None
+    for result in response.results:
+        if result.alternatives:
+            texts.append(result.alternatives[0].transcript.strip())
+            language = language or result.language_code or None
+    return " ".join(t for t in texts if t), language
+
+
+class _TranscriptCache:
+    """An in-process LRU in front of a shared Firestore collection."""
+
+    def __init__(self, max_entries: int = TRANSCRIPT_MEMORY_CACHE_SIZE):
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, db, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        try:
+            doc = db.collection(TRANSCRIPT_CACHE_COLLECTION).document(key).get()
+        except Exception as e:
+            print(f"Warning: Transcript cache read failed: {e}")
+            return None
+        if not doc.exists:
+            return None
+        data = doc.to_dict()
+        entry = {"text": data.get("text", ""), "language": data.get("language")}
+        self._remember(key, entry)
+        return entry
+
+    def set(self, db, key: str, entry: dict) -> None:
+        self._remember(key, entry)
+        try:
+            db.collection(TRANSCRIPT_CACHE_COLLECTION).document(key).set(
+                {**entry, "createdAt": firestore.SERVER_TIMESTAMP}
+            )
+        except Exception as e:
+            print(f"Warning: Transcript cache write failed: {e}")
+
+    def _remember(self, key: str, entry: dict) -> None:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+_transcript_cache = _TranscriptCache()
+
+
+def transcribe_audio(speech_client, db, data: bytes, languages: Optional[List[str]] = None) -> dict:
+    """
+    Transcribes an audio file of any length.
+
+    Args:
+        speech_client: A `speech.SpeechClient`.
+        db: A Firestore client for the shared transcript cache.
+        data: The audio file's bytes.
+        languages: Language codes to recognize; the first is the primary one.
+
+    Returns:
+        A dictionary with the transcript 'text' and the detected 'language'.
+        Raises ValueError if the audio cannot be decoded.
+    """
+    languages = languages or TRANSCRIBE_LANGUAGES
+    key = hashlib.sha256(data + "|".join(languages).encode("utf-8")).hexdigest()
+    cached = _transcript_cache.get(db, key)
+    if cached is not None:
+        print(f"Serving cached transcript for audio {key[:12]}.")
+        return cached
+
+    container = detect_container(data)
+    print(f"Detected audio container: {container or 'unknown'} ({len(data)} bytes).")
+
+    if shutil.which(FFMPEG_PATH):
+        pcm, silences = transcode(data)
+        duration = len(pcm) / BYTES_PER_SECOND
+        chunks = split_on_silence(duration, silences)
+        print(f"Transcribing {duration:.1f}s of audio in {len(chunks)} chunk(s).")
+        config = _recognition_config(speech.RecognitionConfig.AudioEncoding.LINEAR16, SAMPLE_RATE, languages)
+
+        def recognize_chunk(chunk):
+            # Cut on sample boundaries.
+            start = int(chunk[0] * SAMPLE_RATE) * 2
+            end = int(chunk[1] * SAMPLE_RATE) * 2
+            return _recognize(speech_client, config, pcm[start:end])
+
+        with ThreadPoolExecutor(max_workers=max(1, min(TRANSCRIBE_CONCURRENCY, len(chunks)))) as executor:
+            results = list(executor.map(recognize_chunk, chunks))
+    elif container in _NATIVE_ENCODINGS:
+        print(f"ffmpeg is not available; sending {container} audio to Speech-to-Text as it is.")
+        # WAV and FLAC headers carry the sample rate. Opus is decoded at 48 kHz and AMR is 8 kHz.
+        sample_rate = {"webm": 48000, "ogg": 48000, "amr": 8000}.get(container)
+        config = _recognition_config(_NATIVE_ENCODINGS[container], sample_rate, languages)
+        results = [_recognize(speech_client, config, data)]
+    else:
+        raise ValueError(f"Audio in '{container or 'unknown'}' format needs ffmpeg to be transcoded.")
+
+    transcript = {
+        "text": " ".join(text for text, _ in results if text),
+        "language": next((language for _, language in results if language), languages[0]),
+    }
+    if transcript["text"]:
+        _transcript_cache.set(db, key, transcript)
+    return transcript
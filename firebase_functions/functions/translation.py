@@ -0,0 +1,127 @@
+"""
+Multi-target translation for community chat messages.
+
+Every configured target language (`TRANSLATION_TARGET_LANGUAGES`) is
+translated concurrently, so adding a language does not add latency.
+Translations are cached by the SHA-256 of the text and the target language,
+in an in-process LRU in front of a shared Firestore collection that is read
+for all targets in one round trip. Greetings and common phrases are
+therefore translated once.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from firebase_admin import firestore
+
+TRANSLATION_TARGET_LANGUAGES = [
+    code.strip() for code in os.environ.get("TRANSLATION_TARGET_LANGUAGES", "hi,ta").split(",") if code.strip()
+]
+TRANSLATION_CACHE_COLLECTION = "translation_cache"
+TRANSLATION_MEMORY_CACHE_SIZE = 2048
+# Texts longer than this are not written to the shared cache; they rarely repeat.
+MAX_CACHED_TEXT_LENGTH = 500
+
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="translate")
+
+
+def _cache_key(text: str, target: str) -> str:
+    return hashlib.sha256(f"{target}\n{text}".encode("utf-8")).hexdigest()
+
+
+class _TranslationCache:
+    """An in-process LRU in front of a shared Firestore collection."""
+
+    def __init__(self, max_entries: int = TRANSLATION_MEMORY_CACHE_SIZE):
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get_many(self, db, keys: List[str]) -> Dict[str, str]:
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    found[key] = self._entries[key]
+        missing = [key for key in keys if key not in found]
+        if not missing:
+            return found
+        try:
+            collection = db.collection(TRANSLATION_CACHE_COLLECTION)
+            for doc in db.get_all([collection.document(key) for key in missing], field_paths=["text"]):
+                if doc.exists:
+                    found[doc.id] = doc.get("text")
+                    self._remember(doc.id, found[doc.id])
+        except Exception as e:
+            print(f"Warning: Translation cache read failed: {e}")
+        return found
+
+    def set_many(self, db, entries: Dict[str, str], shared: bool) -> None:
+        for key, text in entries.items():
+            self._remember(key, text)
+        if not shared or not entries:
+            return
+        try:
+            batch = db.batch()
+            collection = db.collection(TRANSLATION_CACHE_COLLECTION)
+            for key, text in entries.items():
+                batch.set(collection.document(key), {"text": text, "createdAt": firestore.SERVER_TIMESTAMP})
+            batch.commit()
+        except Exception as e:
+            print(f"Warning: Translation cache write failed: {e}")
+
+    def _remember(self, key: str, text: str) -> None:
+        with self._lock:
+            self._entries[key] = text
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+_translation_cache = _TranslationCache()
+
+
+def translate_text(translate_client, db, text: str, targets: Optional[List[str]] = None) -> Dict[str, str]:
+    """
+    Translates text into every target language.
+
+    Args:
+        translate_client: A `translate_v2.Client`.
+        db: A Firestore client for the shared translation cache.
+        text: The text to translate.
+        targets: Language codes; defaults to TRANSLATION_TARGET_LANGUAGES.
+
+    Returns:
+        A dictionary of language code to translated text. A language whose
+        translation failed maps to the original text.
+    """
+    targets = targets or TRANSLATION_TARGET_LANGUAGES
+    keys = {target: _cache_key(text, target) for target in targets}
+    cached = _translation_cache.get_many(db, list(keys.values()))
+    translations = {target: cached[key] for target, key in keys.items() if key in cached}
+
+    missing = [target for target in targets if target not in translations]
+    if missing:
+        futures = {
+            target: _executor.submit(translate_client.translate, text, target_language=target, format_="text")
+            for target in missing
+        }
+        fresh = {}
+        for target, future in futures.items():
+            try:
+                fresh[target] = future.result()["translatedText"]
+            except Exception as e:
+                print(f"Warning: Translation to '{target}' failed. Using the original text. Error: {e}")
+                translations[target] = text
+        translations.update(fresh)
+        _translation_cache.set_many(
+            db,
+            {keys[target]: translated for target, translated in fresh.items()},
+            shared=len(text) <= MAX_CACHED_TEXT_LENGTH,
+        )
+    print(f"Translated into {len(targets)} language(s), {len(targets) - len(missing)} from cache.")
+    return translations
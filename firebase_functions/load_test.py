@@ -0,0 +1,100 @@
+"""
+Load test for the deployed (or emulated) Firebase functions.
+
+Sends a fixed number of requests to one endpoint at increasing numbers of
+concurrent clients and reports throughput, latency percentiles and errors.
+To compare per-instance concurrency levels at a fixed instance count, deploy
+with `MAX_INSTANCES` fixed and `LIGHT_CONCURRENCY=1`, run the test, then
+redeploy with the default concurrency and run it again:
+
+    MAX_INSTANCES=2 LIGHT_CONCURRENCY=1 firebase deploy --only functions:list_orders
+    python load_test.py https://<region>-<project>.cloudfunctions.net/list_orders \
+        --query user_id=<user> --clients 1,10,50,100
+
+Usage:
+    python load_test.py URL [--method GET] [--query k=v&...] [--body JSON]
+                            [--requests 500] [--clients 1,10,50] [--json]
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+_local = threading.local()
+
+
+def _session() -> requests.Session:
+    # One connection pool per client thread.
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def _send(url: str, method: str, params: str, body) -> tuple:
+    start = time.perf_counter()
+    try:
+        response = _session().request(method, url, params=params or None, json=body, timeout=120)
+        ok = response.status_code < 500 and response.status_code != 429
+    except requests.RequestException:
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+def run_level(url: str, method: str, params: str, body, total: int, clients: int) -> dict:
+    """Sends `total` requests from `clients` concurrent threads."""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        results = list(executor.map(lambda _: _send(url, method, params, body), range(total)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, ok in results if ok)
+    errors = sum(1 for _, ok in results if not ok)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else None
+
+    return {
+        "clients": clients,
+        "requests": total,
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "mean_ms": statistics.mean(latencies) * 1000 if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("url", help="The function URL.")
+    parser.add_argument("--method", default="GET")
+    parser.add_argument("--query", default="", help="The query string, e.g. 'user_id=abc&limit=20'.")
+    parser.add_argument("--body", default=None, help="A JSON request body.")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per concurrency level.")
+    parser.add_argument("--clients", default="1,10,50,100", help="Comma-separated concurrency levels.")
+    parser.add_argument("--warmup", type=int, default=10, help="Requests sent first, to start the instances.")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    args = parser.parse_args()
+
+    body = json.loads(args.body) if args.body else None
+    levels = [int(level) for level in args.clients.split(",") if level.strip()]
+    if args.warmup:
+        run_level(args.url, args.method, args.query, body, args.warmup, min(args.warmup, 10))
+
+    report = [run_level(args.url, args.method, args.query, body, args.requests, clients) for clients in levels]
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{'clients':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'errors':>8}")
+    for row in report:
+        p50 = f"{row['p50_ms']:.0f}" if row["p50_ms"] is not None else "-"
+        p95 = f"{row['p95_ms']:.0f}" if row["p95_ms"] is not None else "-"
+        print(f"{row['clients']:>8}{row['throughput_rps']:>10}{p50:>10}{p95:>10}{row['errors']:>8}")
+
+
+if __name__ == "__main__":
+    main()
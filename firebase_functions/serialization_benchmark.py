@@ -0,0 +1,123 @@
+"""
+Serialization and compression benchmark for the list endpoints.
+
+Builds synthetic product and chat message payloads of 1k to 10k items with
+Firestore-style timestamps, and compares the previous encoder
+(`json.dumps(cls=DateTimeEncoder)`) with `responses.encode_json`, followed by
+gzip and Brotli compression as `json_response` applies them.
+
+Usage:
+    python serialization_benchmark.py [--sizes 1000,5000,10000] [--repeat 5]
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "functions"))
+
+import responses  # noqa: E402
+
+try:
+    from google.api_core.datetime_helpers import DatetimeWithNanoseconds as Timestamp
+except ImportError:
+    class Timestamp(datetime):
+        """Stands in for DatetimeWithNanoseconds: a datetime subclass, which orjson does not encode natively."""
+
+
+class DateTimeEncoder(json.JSONEncoder):
+    """The encoder the endpoints used before `responses.json_response`."""
+    def default(self, o):
+        if isinstance(o, datetime):
+            return o.isoformat()
+        if hasattr(o, 'to_datetime') and callable(o.to_datetime):
+            return o.to_datetime().isoformat()
+        return super().default(o)
+
+
+def _timestamp(i: int):
+    value = datetime(2025, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=i)
+    return Timestamp(value.year, value.month, value.day, value.hour, value.minute, value.second, tzinfo=timezone.utc)
+
+
+def products(count: int) -> dict:
+    return {"products": [
+        {
+            "product_id": f"product{i:06d}",
+            "product_name": "Tomato",
+            "product_type": "vegetable",
+            "price_per_kg": 24.5 + i % 10,
+            "quantity_available": 100 + i,
+            "seller_id": f"seller{i % 50}",
+            "seller_name": "Ravi Kumar",
+            "state": "Tamil Nadu",
+            "district": "Villupuram",
+            "average_rating": 4.2,
+            "created_at": _timestamp(i),
+            "updated_at": _timestamp(i + 1),
+        }
+        for i in range(count)
+    ]}
+
+
+def messages(count: int) -> dict:
+    return {"messages": [
+        {
+            "id": f"message{i:06d}",
+            "senderId": f"user{i % 200}",
+            "senderName": "Lakshmi",
+            "room": "global",
+            "text": "My tomato leaves have yellow spots, what should I spray?",
+            "text_hi": "मेरे टमाटर के पत्तों पर पीले धब्बे हैं",
+            "text_ta": "என் தக்காளி இலைகளில் மஞ்சள் புள்ளிகள்",
+            "translationStatus": "done",
+            "timestamp": _timestamp(i),
+            "updatedAt": _timestamp(i),
+        }
+        for i in range(count)
+    ]}
+
+
+def _best_of(repeat: int, fn):
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,5000,10000", help="Comma-separated item counts.")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement; the best is reported.")
+    args = parser.parse_args()
+
+    print(f"JSON backend: {'orjson' if responses.orjson else 'json'}; Brotli: {'yes' if responses.brotli else 'no'}")
+    print(f"{'payload':<18}{'old ms':>9}{'new ms':>9}{'old KB':>9}{'new KB':>9}{'gzip ms':>9}{'gzip KB':>9}{'br ms':>8}{'br KB':>8}")
+    for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+        for name, build in (("products", products), ("messages", messages)):
+            data = build(size)
+            old_ms, old_body = _best_of(args.repeat, lambda: json.dumps(data, cls=DateTimeEncoder).encode("utf-8"))
+            new_ms, new_body = _best_of(args.repeat, lambda: responses.encode_json(data))
+            gzip_ms, gzip_body = _best_of(
+                args.repeat, lambda: gzip.compress(new_body, compresslevel=responses.GZIP_LEVEL, mtime=0)
+            )
+            br = "-", "-"
+            if responses.brotli is not None:
+                br_ms, br_body = _best_of(
+                    args.repeat, lambda: responses.brotli.compress(new_body, quality=responses.BROTLI_QUALITY)
+                )
+                br = f"{br_ms:.1f}", f"{len(br_body) / 1024:.0f}"
+            print(
+                f"{f'{name} x{size}':<18}{old_ms:>9.1f}{new_ms:>9.1f}{len(old_body) / 1024:>9.0f}"
+                f"{len(new_body) / 1024:>9.0f}{gzip_ms:>9.1f}{len(gzip_body) / 1024:>9.0f}{br[0]:>8}{br[1]:>8}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,16 @@
 from google.adk.agents import Agent
+from routing.model_tiers import apply_model_tier, get_model, record_model_usage
 from sub_agents.image_analyzer_agent.agent import farming_image_analyzer_agent
 from sub_agents.weather_agent.agent import weather_agent
 from sub_agents.scheme_analysis_agent.agent import scheme_analysis_agent
 from sub_agents.market_agent.agent import market_agent
 from sub_agents.finance_agent.agent import finance_agent
+from routing.pre_router import pre_route, record_llm_route
+from routing.answer_cache import lookup_cached_answer, store_answer
 
 manager_agent = Agent(
     name="manager_agent",
-    model="gemini-2.5-pro",
+    model=get_model("manager_agent"),
     description="One4Farmers Manager Agent",
     instruction="""
     You are the central Manager Agent for the One4Farmers platform. Your primary role is to act as a helpful agricultural assistant. First, you must try to delegate tasks to a specialized sub-agent. If no specialist can handle the request, but it is a general farming question, you should answer it yourself.
@@ -37,4 +40,8 @@ manager_agent = Agent(
     sub_agents=[
         farming_image_analyzer_agent, weather_agent, market_agent, scheme_analysis_agent, finance_agent
     ],
+    # Repeated general questions are answered from the cache, and clear-cut
+    # requests are routed locally, both skipping the routing model call.
+    before_model_callback=[lookup_cached_answer, pre_route, apply_model_tier],
+    after_model_callback=[record_llm_route, store_answer, record_model_usage],
 )
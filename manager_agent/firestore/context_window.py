@@ -0,0 +1,127 @@
+"""
+Keeps the conversation context sent to Gemini bounded.
+
+The session service returns only the last `CONTEXT_RECENT_TURNS` turns
+verbatim. Older turns are replaced by a single rolling summary event. The
+summary is generated in the background once enough unsummarized turns have
+piled up, and it is stored on the session document as `context_summary`:
+
+    {"text": "...", "until": <timestamp of the last summarized event>}
+
+A turn starts at each user-authored event, so tool calls and their responses
+are never split from each other.
+
+The summary event is authored as "user" so the model reads it as context,
+but it is not something the user said. It always has the ID
+`SUMMARY_EVENT_ID`, and anything that renders session history should skip
+events for which `is_summary_event` is true.
+"""
+import json
+import logging
+import os
+from typing import List, Optional, Tuple
+
+from google.adk.events.event import Event
+from google.genai import types
+
+logger = logging.getLogger("google_adk." + __name__)
+
+CONTEXT_RECENT_TURNS = int(os.environ.get("CONTEXT_RECENT_TURNS", "6"))
+# Summarize once this many turns beyond the recent window are unsummarized.
+CONTEXT_SUMMARY_BATCH_TURNS = int(os.environ.get("CONTEXT_SUMMARY_BATCH_TURNS", "4"))
+CONTEXT_SUMMARY_MODEL = os.environ.get("CONTEXT_SUMMARY_MODEL", "gemini-2.5-flash-lite")
+# Tool responses are truncated to this many characters in the summary prompt.
+MAX_TOOL_RESPONSE_CHARS = 500
+SUMMARY_EVENT_ID = "context_summary"
+
+SUMMARY_PROMPT = """You maintain a running summary of a conversation between a farmer and the One4Farmers assistant.
+Update the existing summary with the new conversation excerpt. Keep every fact the assistant may need later:
+the farmer's location, crops, farm size, products listed or bought, order IDs, prices quoted, recommendations
+made and any open questions. Be concise and write in English.
+
+Existing summary:
+{summary}
+
+New conversation excerpt:
+{excerpt}
+
+Updated summary:"""
+
+
+def split_recent_turns(events: List[Event], recent_turns: int = CONTEXT_RECENT_TURNS) -> Tuple[List[Event], List[Event]]:
+    """
+    Splits events into (older, recent), where `recent` starts at the
+    `recent_turns`-th most recent user-authored event.
+    """
+    turn_starts = [i for i, event in enumerate(events) if event.author == "user"]
+    if len(turn_starts) <= recent_turns:
+        return [], events
+    cut = turn_starts[-recent_turns]
+    return events[:cut], events[cut:]
+
+
+def count_turns(events: List[Event]) -> int:
+    return sum(1 for event in events if event.author == "user")
+
+
+def render_events(events: List[Event]) -> str:
+    """Renders events as plain text for the summarization prompt."""
+    lines = []
+    for event in events:
+        if not event.content or not event.content.parts:
+            continue
+        for part in event.content.parts:
+            if part.text:
+                lines.append(f"{event.author}: {part.text}")
+            elif part.function_call:
+                lines.append(f"{event.author} called {part.function_call.name}({json.dumps(part.function_call.args, default=str)})")
+            elif part.function_response:
+                response = json.dumps(part.function_response.response, default=str)[:MAX_TOOL_RESPONSE_CHARS]
+                lines.append(f"{part.function_response.name} returned: {response}")
+    return "\n".join(lines)
+
+
+def is_summary_event(event) -> bool:
+    """Returns whether an event, or its JSON form from the session API, is the synthetic summary event."""
+    event_id = event.get("id") if isinstance(event, dict) else getattr(event, "id", None)
+    return event_id == SUMMARY_EVENT_ID
+
+
+def build_summary_event(summary: dict) -> Event:
+    """Builds the synthetic event that stands in for every summarized turn."""
+    return Event(
+        id=SUMMARY_EVENT_ID,
+        invocation_id=SUMMARY_EVENT_ID,
+        author="user",
+        content=types.Content(
+            role="user",
+            parts=[types.Part(text=f"[Summary of the earlier conversation]\n{summary['text']}")],
+        ),
+        timestamp=summary["until"],
+    )
+
+
+_genai_client = None
+
+
+def _get_genai_client():
+    global _genai_client
+    if _genai_client is None:
+        from google import genai
+
+        _genai_client = genai.Client(
+            vertexai=True,
+            project=os.environ.get("GOOGLE_CLOUD_PROJECT"),
+            location=os.environ.get("GOOGLE_CLOUD_LOCATION", "us-central1"),
+        )
+    return _genai_client
+
+
+def summarize(previous_summary: Optional[str], events: List[Event]) -> str:
+    """Folds `events` into `previous_summary` with a small, fast model."""
+    prompt = SUMMARY_PROMPT.format(
+        summary=previous_summary or "(none)",
+        excerpt=render_events(events),
+    )
+    response = _get_genai_client().models.generate_content(model=CONTEXT_SUMMARY_MODEL, contents=prompt)
+    return (response.text or "").strip()
@@ -34,6 +34,15 @@ from google.adk.sessions.base_session_service import (
     GetSessionConfig,
     ListSessionsResponse,
 )
+from firestore.context_window import (
+    CONTEXT_RECENT_TURNS,
+    CONTEXT_SUMMARY_BATCH_TURNS,
+    build_summary_event,
+    count_turns,
+    is_summary_event,
+    split_recent_turns,
+    summarize,
+)
 
 logger = logging.getLogger("google_adk." + __name__)
 # Set the level to INFO to make sure our logs are captured.
@@ -44,10 +53,26 @@ EVENTS_SUBCOLLECTION = "events"
 
 
 class FirestoreSessionService(BaseSessionService):
-    def __init__(self, project: Optional[str] = None, database: Optional[str] = None):
-        """Initializes the FirestoreSessionService with the synchronous client."""
+    def __init__(
+        self,
+        project: Optional[str] = None,
+        database: Optional[str] = None,
+        recent_turns: Optional[int] = CONTEXT_RECENT_TURNS,
+    ):
+        """
+        Initializes the FirestoreSessionService with the synchronous client.
+
+        Args:
+            recent_turns: The number of most recent turns returned verbatim.
+                Older turns are replaced by a rolling summary. Pass None to
+                always return the full history.
+        """
         # Use the standard synchronous client instead of the AsyncClient
         self._db = firestore.Client(project=project, database=database)
+        self._recent_turns = recent_turns
+        self._summaries_in_flight = set()
+        # Keep references to background tasks so they are not garbage collected.
+        self._background_tasks = set()
 
     @override
     async def create_session(
@@ -121,10 +146,21 @@ class FirestoreSessionService(BaseSessionService):
 
             # Fetch events without ordering from the database to avoid index requirements.
             events_ref = session_ref.collection(EVENTS_SUBCOLLECTION)
+            context_summary = session_dict.get("context_summary") if self._recent_turns else None
+            if context_summary:
+                # Turns covered by the rolling summary are neither read nor sent to the model.
+                events_ref = events_ref.where(
+                    filter=FieldFilter("timestamp.seconds", ">=", int(context_summary["until"]))
+                )
             event_docs = events_ref.stream()
             events_list = [_from_firestore_doc_to_event(doc) for doc in event_docs]
             # Sort the events in the application code instead.
             events_list.sort(key=lambda e: e.timestamp)
+            if context_summary:
+                # The summary stands in for the older turns. Its fixed ID lets
+                # history views leave it out (see is_summary_event).
+                events_list = [e for e in events_list if e.timestamp > context_summary["until"]]
+                events_list.insert(0, build_summary_event(context_summary))
             session.events = events_list
 
             if config:
@@ -224,8 +260,56 @@ class FirestoreSessionService(BaseSessionService):
                 )
         
         await asyncio.to_thread(_append_in_firestore)
+
+        if self._recent_turns and event.author != "user" and event.is_final_response():
+            self._maybe_schedule_summary(session)
         return event
 
+    def _maybe_schedule_summary(self, session: Session) -> None:
+        """Starts a background summary of older turns once enough have accumulated."""
+        if session.id in self._summaries_in_flight:
+            return
+        events = [e for e in session.events if not is_summary_event(e)]
+        if count_turns(events) < self._recent_turns + CONTEXT_SUMMARY_BATCH_TURNS:
+            return
+        older, _ = split_recent_turns(events, self._recent_turns)
+        if not older:
+            return
+
+        self._summaries_in_flight.add(session.id)
+        task = asyncio.get_running_loop().create_task(
+            asyncio.to_thread(self._summarize_in_firestore, session.id, older)
+        )
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        task.add_done_callback(lambda _: self._summaries_in_flight.discard(session.id))
+
+    def _summarize_in_firestore(self, session_id: str, older_events: list) -> None:
+        """Folds `older_events` into the session's rolling summary."""
+        try:
+            session_ref = self._db.collection(SESSIONS_COLLECTION).document(session_id)
+            session_doc = session_ref.get(field_paths=["context_summary"])
+            previous = (session_doc.to_dict() or {}).get("context_summary") if session_doc.exists else None
+            previous_until = previous["until"] if previous else 0.0
+
+            new_events = [e for e in older_events if e.timestamp > previous_until]
+            if not new_events:
+                return
+
+            text = summarize(previous["text"] if previous else None, new_events)
+            if not text:
+                return
+            session_ref.update({
+                "context_summary": {"text": text, "until": new_events[-1].timestamp},
+            })
+            logger.info(
+                "Summarized %d events for session '%s' into the rolling context summary.",
+                len(new_events),
+                session_id,
+            )
+        except Exception as e:
+            logger.error("Failed to summarize older turns for session '%s': %s", session_id, e, exc_info=True)
+
 def _convert_event_to_json(event: Event) -> Dict[str, Any]:
   """Serializes an Event object into a JSON-compatible dictionary."""
   metadata_json = {
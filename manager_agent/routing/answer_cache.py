@@ -0,0 +1,247 @@
+"""
+A response cache for general farming questions answered by the manager agent.
+
+Under rule 7 the manager answers general farming questions itself, and many of
+them ("how to control aphids on chilli") are asked word for word by thousands
+of farmers. This module caches those answers, keyed on the normalized question
+text and its language, with an optional embedding-similarity match
+(`ANSWER_CACHE_EMBEDDING_MODEL`, requires `sentence-transformers`).
+
+The cache is bypassed whenever the answer could depend on session state or on
+earlier turns: questions that mention the farmer's own location, orders,
+revenue or farm, questions the pre-router would send to a specialist, short
+follow-ups, media messages and any model call after a tool response. Only
+plain-text answers with no function calls are stored.
+
+Entries expire after a TTL, and when the cache is full the entry with the
+fewest hits (oldest first) is evicted.
+"""
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from typing import Optional
+
+from google.adk.agents.callback_context import CallbackContext
+from google.adk.models import LlmRequest, LlmResponse
+from google.genai import types
+from routing.pre_router import classify
+
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_TTL_SECONDS = int(os.environ.get("ANSWER_CACHE_TTL_SECONDS", str(7 * 24 * 60 * 60)))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "2000"))
+ANSWER_CACHE_EMBEDDING_MODEL = os.environ.get("ANSWER_CACHE_EMBEDDING_MODEL")
+ANSWER_CACHE_SIMILARITY_THRESHOLD = float(os.environ.get("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.92"))
+# Questions shorter than this many words are usually follow-ups.
+MIN_QUESTION_WORDS = 3
+# Log cache statistics every N lookups.
+STATS_LOG_INTERVAL = 100
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s\u0900-\u0DFF]")
+# References to the farmer's own state, or to earlier turns, make an answer personal.
+_STATE_DEPENDENT_RE = re.compile(
+    r"\b(my|mine|our|i have|i grow|i am growing|here|near me|nearby|"
+    r"order|orders|revenue|earn\w*|income|listing|listed|today|tomorrow|this week|"
+    r"it|this|that|these|those|them|they|above|previous|again)\b"
+    r"|^\s*(yes|yeah|ok|okay|sure|no|nope)\b"
+    r"|मेरा|मेरी|मेरे|हमारा|यहाँ|यहां|आज|कल"
+    r"|என்|எனது|என்னுடைய|இங்கே|இன்று|நாளை",
+    re.IGNORECASE,
+)
+
+
+def detect_language(text: str) -> str:
+    """Detects Hindi and Tamil by script, defaulting to English."""
+    for ch in text:
+        if "\u0900" <= ch <= "\u097f":
+            return "hi"
+        if "\u0b80" <= ch <= "\u0bff":
+            return "ta"
+    return "en"
+
+
+def normalize_question(text: str) -> str:
+    """Lowercases the question and strips punctuation and extra whitespace."""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return " ".join(_PUNCTUATION_RE.sub(" ", text).split())
+
+
+def _question_text(content: Optional[types.Content]) -> Optional[str]:
+    """Returns the message text, or None if the message carries media."""
+    if not content or not content.parts:
+        return None
+    texts = []
+    for part in content.parts:
+        if part.inline_data or part.file_data:
+            return None
+        if part.text:
+            texts.append(part.text)
+    return " ".join(texts).strip() or None
+
+
+def is_cacheable_question(content: Optional[types.Content]) -> bool:
+    """True when the answer to this message cannot depend on session state."""
+    text = _question_text(content)
+    if not text or len(text.split()) < MIN_QUESTION_WORDS:
+        return False
+    if _STATE_DEPENDENT_RE.search(text):
+        return False
+    agent_name, _ = classify(content)
+    # Anything that looks like a specialist's job is not a general question.
+    return agent_name is None
+
+
+class AnswerCache:
+    """A thread-safe TTL cache with hit-count based eviction and optional similarity lookup."""
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES, ttl_seconds: int = ANSWER_CACHE_TTL_SECONDS,
+                 embedding_model: Optional[str] = ANSWER_CACHE_EMBEDDING_MODEL):
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._embedding_model = embedding_model
+        self._embedder = None
+        self._lock = threading.Lock()
+        # (language, normalized question) -> entry dict
+        self._entries = {}
+        self._stats = {"hits": 0, "similar_hits": 0, "misses": 0, "evictions": 0}
+
+    def _embed(self, text: str):
+        if not self._embedding_model:
+            return None
+        if self._embedder is None:
+            try:
+                from sentence_transformers import SentenceTransformer
+            except ImportError:
+                logging.warning("sentence-transformers is not installed; the answer cache will match exact text only.")
+                self._embedding_model = None
+                return None
+            self._embedder = SentenceTransformer(self._embedding_model)
+        return self._embedder.encode([text], normalize_embeddings=True)[0]
+
+    def _record(self, outcome: str) -> None:
+        with self._lock:
+            self._stats[outcome] += 1
+            lookups = self._stats["hits"] + self._stats["similar_hits"] + self._stats["misses"]
+        if lookups % STATS_LOG_INTERVAL == 0:
+            print(f"[Answer Cache] {self.stats()}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["similar_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["hits"] + stats["similar_hits"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+    def get(self, question: str, language: str) -> Optional[str]:
+        key = (language, normalize_question(question))
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry["expires_at"] <= now:
+                del self._entries[key]
+                entry = None
+            if entry:
+                entry["hits"] += 1
+                answer = entry["answer"]
+        if entry:
+            self._record("hits")
+            return answer
+
+        vector = self._embed(key[1])
+        if vector is not None:
+            with self._lock:
+                best, best_similarity = None, ANSWER_CACHE_SIMILARITY_THRESHOLD
+                for (entry_language, _), candidate in self._entries.items():
+                    if entry_language != language or candidate["vector"] is None or candidate["expires_at"] <= now:
+                        continue
+                    similarity = float(candidate["vector"] @ vector)
+                    if similarity >= best_similarity:
+                        best, best_similarity = candidate, similarity
+                if best:
+                    best["hits"] += 1
+                    answer = best["answer"]
+            if best:
+                self._record("similar_hits")
+                return answer
+
+        self._record("misses")
+        return None
+
+    def set(self, question: str, language: str, answer: str) -> None:
+        key = (language, normalize_question(question))
+        vector = self._embed(key[1])
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self._max_entries:
+                # Evict the least-hit entry, oldest first among ties.
+                victim = min(self._entries, key=lambda k: (self._entries[k]["hits"], self._entries[k]["created_at"]))
+                del self._entries[victim]
+                self._stats["evictions"] += 1
+            self._entries[key] = {
+                "answer": answer,
+                "vector": vector,
+                "hits": 0,
+                "created_at": time.time(),
+                "expires_at": time.time() + self._ttl_seconds,
+            }
+
+
+answer_cache = AnswerCache()
+# Questions awaiting an answer from the model, by invocation id.
+_pending_questions = {}
+_pending_lock = threading.Lock()
+
+
+def lookup_cached_answer(callback_context: CallbackContext, llm_request: LlmRequest) -> Optional[LlmResponse]:
+    """
+    A `before_model_callback` for the manager agent. Returns a cached answer to
+    a general farming question, or None to call the model.
+    """
+    if not ANSWER_CACHE_ENABLED:
+        return None
+
+    # Only the first model call for a new user message can be served from the cache.
+    # Function responses and other agents' output (e.g. a sub-agent transferring
+    # back) also arrive as "user" content, so the last content must be the
+    # user's own message.
+    last_content = llm_request.contents[-1] if llm_request.contents else None
+    content = callback_context.user_content
+    if not last_content or not content or last_content != content:
+        return None
+    if not is_cacheable_question(content):
+        return None
+
+    question = _question_text(content)
+    language = detect_language(question)
+    answer = answer_cache.get(question, language)
+    if answer is not None:
+        print(f"[Answer Cache] Serving cached answer for: '{question}'")
+        return LlmResponse(content=types.Content(role="model", parts=[types.Part(text=answer)]))
+
+    with _pending_lock:
+        if len(_pending_questions) > 1000:
+            _pending_questions.clear()
+        _pending_questions[callback_context.invocation_id] = (question, language)
+    return None
+
+
+def store_answer(callback_context: CallbackContext, llm_response: LlmResponse) -> Optional[LlmResponse]:
+    """An `after_model_callback` for the manager agent that caches plain-text answers."""
+    if llm_response.partial:
+        return None
+    with _pending_lock:
+        pending = _pending_questions.pop(callback_context.invocation_id, None)
+    if pending is None or not llm_response.content or not llm_response.content.parts:
+        return None
+
+    parts = llm_response.content.parts
+    if any(part.function_call for part in parts):
+        # The manager delegated or called a tool, so this is not a direct answer.
+        return None
+    answer = "".join(part.text for part in parts if part.text and not part.thought).strip()
+    if answer:
+        question, language = pending
+        answer_cache.set(question, language, answer)
+    return None
@@ -0,0 +1,223 @@
+"""
+Per-agent model selection with latency budgets.
+
+Each agent is assigned a model tier ("pro", "flash" or "lite") instead of a
+hard-coded model name. Tiers can be overridden per agent and per intent from
+the environment:
+
+    MODEL_TIER_<AGENT_NAME>=flash          e.g. MODEL_TIER_MARKET_AGENT=flash
+    MODEL_TIER_CONFIG=<json or path>       {"agents": {...}, "intents": [...],
+                                            "turn_latency_budget_seconds": 30}
+
+An intent entry is {"agents": [...], "pattern": "<regex>", "tier": "lite"} and
+applies to model calls whose user message matches the pattern.
+
+The `apply_model_tier` and `record_model_usage` callbacks pick the model for
+every call, downgrade one tier once a turn has used most of its latency
+budget, and record the latency and token usage of each tier.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Optional
+
+from google.adk.agents.callback_context import CallbackContext
+from google.adk.models import LlmRequest, LlmResponse
+
+TIER_ORDER = ["pro", "flash", "lite"]
+MODEL_TIERS = {
+    "pro": os.environ.get("MODEL_TIER_PRO_MODEL", "gemini-2.5-pro"),
+    "flash": os.environ.get("MODEL_TIER_FLASH_MODEL", "gemini-2.5-flash"),
+    "lite": os.environ.get("MODEL_TIER_LITE_MODEL", "gemini-2.5-flash-lite"),
+}
+
+# Routing and simple relays do not need the slowest model.
+DEFAULT_AGENT_TIERS = {
+    "manager_agent": "flash",
+    "finance_agent": "flash",
+    "market_agent": "pro",
+    "weather_agent": "pro",
+    "scheme_analysis_agent": "pro",
+    "farming_image_analyzer_agent": "pro",
+}
+
+# Questions that only relay a value from session state.
+DEFAULT_INTENT_TIERS = [
+    {
+        "agents": ["finance_agent"],
+        "pattern": r"\b(revenue|earnings?|income|how much (have i|did i) (earn|make))\b",
+        "tier": "lite",
+    },
+    {
+        "agents": ["market_agent"],
+        "pattern": r"\b(my orders|order history|list (my )?orders|order ids?)\b",
+        "tier": "lite",
+    },
+]
+
+# Once this share of the turn's budget has been spent, later calls are downgraded.
+DOWNGRADE_AT_BUDGET_FRACTION = 0.6
+# Log tier statistics every N model calls.
+STATS_LOG_INTERVAL = 50
+
+
+def _load_config() -> dict:
+    raw = os.environ.get("MODEL_TIER_CONFIG")
+    if not raw:
+        return {}
+    try:
+        if os.path.exists(raw):
+            with open(raw, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return json.loads(raw)
+    except Exception as e:
+        logging.error(f"Failed to load MODEL_TIER_CONFIG: {e}")
+        return {}
+
+
+_config = _load_config()
+TURN_LATENCY_BUDGET_SECONDS = float(
+    os.environ.get("TURN_LATENCY_BUDGET_SECONDS", _config.get("turn_latency_budget_seconds", 30))
+)
+_intent_tiers = [
+    {"agents": set(intent["agents"]), "pattern": re.compile(intent["pattern"], re.IGNORECASE), "tier": intent["tier"]}
+    for intent in _config.get("intents", DEFAULT_INTENT_TIERS)
+]
+
+
+def get_tier(agent_name: str) -> str:
+    """Returns the configured tier for an agent."""
+    tier = (
+        os.environ.get(f"MODEL_TIER_{agent_name.upper()}")
+        or _config.get("agents", {}).get(agent_name)
+        or DEFAULT_AGENT_TIERS.get(agent_name, "pro")
+    )
+    if tier not in MODEL_TIERS:
+        logging.warning(f"Unknown model tier '{tier}' for {agent_name}. Using 'pro'.")
+        tier = "pro"
+    return tier
+
+
+def get_model(agent_name: str) -> str:
+    """Returns the model name an agent should be constructed with."""
+    return MODEL_TIERS[get_tier(agent_name)]
+
+
+def _tier_of(model: Optional[str]) -> Optional[str]:
+    for tier, name in MODEL_TIERS.items():
+        if name == model:
+            return tier
+    return None
+
+
+def _downgrade(tier: str) -> str:
+    index = TIER_ORDER.index(tier)
+    return TIER_ORDER[min(index + 1, len(TIER_ORDER) - 1)]
+
+
+class _TierStats:
+    """Thread-safe per-tier latency and token counters, plus per-turn start times."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.turn_started = {}
+        self.call_started = {}
+        self.calls = 0
+        self.by_tier = {
+            tier: {"calls": 0, "seconds": 0.0, "prompt_tokens": 0, "output_tokens": 0, "downgrades": 0}
+            for tier in MODEL_TIERS
+        }
+
+    def turn_elapsed(self, invocation_id: str) -> float:
+        with self._lock:
+            if len(self.turn_started) > 1000:
+                self.turn_started.clear()
+                self.call_started.clear()
+            started = self.turn_started.setdefault(invocation_id, time.monotonic())
+        return time.monotonic() - started
+
+    def start_call(self, key: tuple, tier: str, downgraded: bool):
+        with self._lock:
+            self.call_started[key] = (tier, time.monotonic())
+            if downgraded:
+                self.by_tier[tier]["downgrades"] += 1
+
+    def finish_call(self, key: tuple, usage) -> None:
+        with self._lock:
+            started = self.call_started.pop(key, None)
+            if started is None:
+                return
+            tier, started_at = started
+            stats = self.by_tier[tier]
+            stats["calls"] += 1
+            stats["seconds"] += time.monotonic() - started_at
+            if usage:
+                stats["prompt_tokens"] += usage.prompt_token_count or 0
+                stats["output_tokens"] += usage.candidates_token_count or 0
+            self.calls += 1
+            should_log = self.calls % STATS_LOG_INTERVAL == 0
+        if should_log:
+            print(f"[Model Tiers] {self.summary()}")
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                tier: {
+                    "calls": s["calls"],
+                    "avg_seconds": round(s["seconds"] / s["calls"], 3) if s["calls"] else None,
+                    "avg_prompt_tokens": round(s["prompt_tokens"] / s["calls"]) if s["calls"] else None,
+                    "avg_output_tokens": round(s["output_tokens"] / s["calls"]) if s["calls"] else None,
+                    "downgrades": s["downgrades"],
+                }
+                for tier, s in self.by_tier.items()
+            }
+
+
+tier_stats = _TierStats()
+
+
+def _user_text(callback_context: CallbackContext) -> str:
+    content = callback_context.user_content
+    if not content or not content.parts:
+        return ""
+    return " ".join(part.text for part in content.parts if part.text)
+
+
+def apply_model_tier(callback_context: CallbackContext, llm_request: LlmRequest) -> Optional[LlmResponse]:
+    """
+    A `before_model_callback` that selects the model for this call: the agent's
+    tier, an intent-specific tier if one matches, and a one-tier downgrade when
+    the turn's latency budget is at risk.
+    """
+    agent_name = callback_context.agent_name
+    tier = _tier_of(llm_request.model) or get_tier(agent_name)
+
+    text = _user_text(callback_context)
+    for intent in _intent_tiers:
+        if agent_name in intent["agents"] and intent["pattern"].search(text):
+            tier = intent["tier"]
+            break
+
+    downgraded = False
+    elapsed = tier_stats.turn_elapsed(callback_context.invocation_id)
+    if elapsed > TURN_LATENCY_BUDGET_SECONDS * DOWNGRADE_AT_BUDGET_FRACTION and tier != TIER_ORDER[-1]:
+        tier = _downgrade(tier)
+        downgraded = True
+        print(f"[Model Tiers] Turn has used {elapsed:.1f}s of its {TURN_LATENCY_BUDGET_SECONDS:.0f}s budget. "
+              f"Downgrading {agent_name} to '{tier}'.")
+
+    llm_request.model = MODEL_TIERS[tier]
+    tier_stats.start_call((callback_context.invocation_id, agent_name), tier, downgraded)
+    return None
+
+
+def record_model_usage(callback_context: CallbackContext, llm_response: LlmResponse) -> Optional[LlmResponse]:
+    """An `after_model_callback` that records the latency and token usage of the call's tier."""
+    # Streaming responses call this for every partial chunk; only count the final one.
+    if llm_response.partial:
+        return None
+    tier_stats.finish_call((callback_context.invocation_id, callback_context.agent_name), llm_response.usage_metadata)
+    return None
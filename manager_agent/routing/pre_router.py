@@ -0,0 +1,305 @@
+"""
+A deterministic fast-path router that runs in front of the manager agent's LLM.
+
+The manager agent spends a full model call just to pick a sub-agent, using
+rules that are spelled out in its instruction. This module applies the same
+rules locally, as keyword/regex matches in English, Hindi and Tamil, and
+optionally a tiny naive Bayes text classifier. When it is confident, it
+answers the manager's model call itself with a `transfer_to_agent` function
+call, so the request goes straight to the sub-agent.
+
+When it is not confident, the LLM router runs as before. In that case the
+pre-router's guess is compared with the LLM's choice, which gives a running
+routing accuracy, and the LLM's latency is measured to estimate the time saved
+by each fast-path dispatch.
+"""
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import List, Optional, Tuple
+
+from google.adk.agents.callback_context import CallbackContext
+from google.adk.models import LlmRequest, LlmResponse
+from google.genai import types
+from sub_agents.market_agent.prefetch import start_market_prefetch
+
+PRE_ROUTER_ENABLED = os.environ.get("PRE_ROUTER_ENABLED", "true").lower() == "true"
+PRE_ROUTER_MIN_CONFIDENCE = float(os.environ.get("PRE_ROUTER_MIN_CONFIDENCE", "0.85"))
+# Optional JSON model produced by `train_naive_bayes`.
+PRE_ROUTER_MODEL_PATH = os.environ.get("PRE_ROUTER_MODEL_PATH")
+# Log routing statistics every N routed requests.
+STATS_LOG_INTERVAL = 50
+
+# The label used when the manager should answer (or reject) the request itself.
+MANAGER_LABEL = "manager_agent"
+
+_TOKEN_RE = re.compile(r"[\w\u0900-\u0DFF]+")
+
+ROUTING_RULES = {
+    "weather_agent": [
+        r"\b(weather|forecast|rain\w*|temperature|humidity|monsoon|climate|storm|drought|frost|heat ?wave|wind)\b",
+        r"मौसम|बारिश|वर्षा|तापमान|आंधी|ओले",
+        r"வானிலை|மழை|வெப்பநிலை|புயல்",
+    ],
+    "market_agent": [
+        r"\b(price|prices|mandi|market|sell|selling|buy|buying|purchase|my orders?|order (status|id|history))\b",
+        r"\b(available|show me)\b.*\b(fertili[sz]ers?|seeds?|pesticides?|products?)\b",
+        r"कीमत|भाव|दाम|बेच|खरीद|मंडी|ऑर्डर",
+        r"விலை|விற்க|விற்பனை|வாங்க|சந்தை",
+    ],
+    "scheme_analysis_agent": [
+        r"\b(schemes?|subsid(y|ies)|loans?|kisan credit card|kcc|pm[- ]?kisan|pmfby|yojana|crop insurance|government support)\b",
+        r"योजना|सब्सिडी|अनुदान|ऋण|लोन|बीमा",
+        r"திட்டம்|மானியம்|கடன்|காப்பீடு",
+    ],
+    "finance_agent": [
+        r"\b(profit\w*|revenue|earnings?|income|financial plan|what (crop )?should i (grow|plant)|which crops? (to|should i) (grow|plant)|maximi[sz]e (my )?yield)\b",
+        r"मुनाफा|मुनाफ़ा|कमाई|आमदनी|क्या उगा",
+        r"லாபம்|வருமானம்|எதை பயிரிட",
+    ],
+}
+_COMPILED_RULES = {
+    agent_name: [re.compile(pattern, re.IGNORECASE) for pattern in patterns]
+    for agent_name, patterns in ROUTING_RULES.items()
+}
+
+# Short follow-ups depend on the previous turn, so only the LLM can route them.
+_FOLLOW_UP_RE = re.compile(
+    r"^\s*(yes|yeah|yep|ok|okay|sure|do it|go ahead|no|nope|हाँ|हां|ठीक है|नहीं|ஆம்|சரி|இல்லை)[\s.!]*$",
+    re.IGNORECASE,
+)
+
+
+def _tokenize(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+
+def train_naive_bayes(examples: List[Tuple[str, str]], alpha: float = 1.0) -> dict:
+    """
+    Trains a multinomial naive Bayes classifier on (text, agent_name) pairs and
+    returns it as a JSON-serializable dict that `PRE_ROUTER_MODEL_PATH` can point to.
+    """
+    label_counts = Counter(label for _, label in examples)
+    token_counts = {label: Counter() for label in label_counts}
+    for text, label in examples:
+        token_counts[label].update(_tokenize(text))
+
+    vocabulary = set().union(*token_counts.values()) if token_counts else set()
+    model = {"priors": {}, "likelihoods": {}, "unknown": {}}
+    for label, count in label_counts.items():
+        total = sum(token_counts[label].values()) + alpha * (len(vocabulary) + 1)
+        model["priors"][label] = math.log(count / len(examples))
+        model["likelihoods"][label] = {
+            token: math.log((token_counts[label][token] + alpha) / total) for token in vocabulary
+        }
+        model["unknown"][label] = math.log(alpha / total)
+    return model
+
+
+class _NaiveBayes:
+    def __init__(self, model: dict):
+        self._priors = model["priors"]
+        self._likelihoods = model["likelihoods"]
+        self._unknown = model["unknown"]
+
+    def predict(self, text: str) -> Tuple[Optional[str], float]:
+        tokens = _tokenize(text)
+        if not tokens:
+            return None, 0.0
+        log_probs = {
+            label: prior + sum(self._likelihoods[label].get(t, self._unknown[label]) for t in tokens)
+            for label, prior in self._priors.items()
+        }
+        best = max(log_probs, key=log_probs.get)
+        # Softmax over the log-probabilities gives a normalized confidence.
+        top = log_probs[best]
+        normalizer = sum(math.exp(lp - top) for lp in log_probs.values())
+        return best, 1.0 / normalizer
+
+
+_classifier = None
+_classifier_loaded = False
+
+
+def _get_classifier() -> Optional[_NaiveBayes]:
+    global _classifier, _classifier_loaded
+    if not _classifier_loaded:
+        _classifier_loaded = True
+        if PRE_ROUTER_MODEL_PATH and os.path.exists(PRE_ROUTER_MODEL_PATH):
+            try:
+                with open(PRE_ROUTER_MODEL_PATH, "r", encoding="utf-8") as f:
+                    _classifier = _NaiveBayes(json.load(f))
+                print(f"[Pre-Router] Loaded text classifier from {PRE_ROUTER_MODEL_PATH}.")
+            except Exception as e:
+                logging.error(f"Failed to load pre-router classifier: {e}")
+    return _classifier
+
+
+def classify(content: Optional[types.Content]) -> Tuple[Optional[str], float]:
+    """
+    Predicts the sub-agent for a user message.
+
+    Returns:
+        A tuple of (agent_name, confidence). agent_name is None when the
+        message cannot be classified locally.
+    """
+    if not content or not content.parts:
+        return None, 0.0
+
+    text_parts = []
+    for part in content.parts:
+        mime_type = None
+        if part.inline_data:
+            mime_type = part.inline_data.mime_type
+        elif part.file_data:
+            mime_type = part.file_data.mime_type
+        if mime_type and mime_type.startswith("image/"):
+            # Rule 3: any request with an image goes to the image analyzer.
+            return "farming_image_analyzer_agent", 1.0
+        if mime_type:
+            # Audio and other media must be understood by the model first.
+            return None, 0.0
+        if part.text:
+            text_parts.append(part.text)
+
+    text = " ".join(text_parts).strip()
+    if not text or _FOLLOW_UP_RE.match(text):
+        return None, 0.0
+
+    hits = {
+        agent_name: sum(1 for rule in rules if rule.search(text))
+        for agent_name, rules in _COMPILED_RULES.items()
+    }
+    matched = {agent_name: count for agent_name, count in hits.items() if count}
+    if len(matched) == 1:
+        agent_name, count = next(iter(matched.items()))
+        return agent_name, 0.95 if count > 1 else 0.9
+    if len(matched) > 1:
+        # Conflicting rules (e.g. "loan to buy seeds") are left to the LLM.
+        return max(matched, key=matched.get), 0.5
+
+    classifier = _get_classifier()
+    if classifier:
+        return classifier.predict(text)
+    return None, 0.0
+
+
+class _RoutingStats:
+    """Thread-safe counters for fast-path dispatches and shadow-mode accuracy."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.fast_path = 0
+        self.llm_routed = 0
+        self.shadow_correct = 0
+        self.shadow_total = 0
+        self.llm_latency_total = 0.0
+        self.pending = {}
+
+    def _maybe_log(self):
+        if (self.fast_path + self.llm_routed) % STATS_LOG_INTERVAL == 0:
+            print(f"[Pre-Router] {self.summary()}")
+
+    def record_fast_path(self):
+        with self._lock:
+            self.fast_path += 1
+        self._maybe_log()
+
+    def start_llm_route(self, invocation_id: str, predicted: Optional[str]):
+        with self._lock:
+            # Drop entries whose model call never completed, e.g. after an error.
+            if len(self.pending) > 1000:
+                self.pending.clear()
+            self.pending[invocation_id] = (predicted, time.monotonic())
+
+    def finish_llm_route(self, invocation_id: str, actual: str):
+        with self._lock:
+            pending = self.pending.pop(invocation_id, None)
+            if pending is None:
+                return
+            predicted, started = pending
+            self.llm_routed += 1
+            self.llm_latency_total += time.monotonic() - started
+            if predicted is not None:
+                self.shadow_total += 1
+                self.shadow_correct += int(predicted == actual)
+        self._maybe_log()
+
+    def summary(self) -> dict:
+        with self._lock:
+            avg_llm_latency = self.llm_latency_total / self.llm_routed if self.llm_routed else 0.0
+            return {
+                "fast_path": self.fast_path,
+                "llm_routed": self.llm_routed,
+                "shadow_accuracy": round(self.shadow_correct / self.shadow_total, 4) if self.shadow_total else None,
+                "avg_llm_route_seconds": round(avg_llm_latency, 3),
+                "estimated_seconds_saved": round(avg_llm_latency * self.fast_path, 1),
+            }
+
+
+routing_stats = _RoutingStats()
+# Invocations already fast-routed, oldest first.
+_routed_invocations = OrderedDict()
+_routed_lock = threading.Lock()
+
+
+def pre_route(callback_context: CallbackContext, llm_request: LlmRequest) -> Optional[LlmResponse]:
+    """
+    A `before_model_callback` for the manager agent. Returns a transfer to the
+    predicted sub-agent when confident, or None to let the LLM route.
+    """
+    if not PRE_ROUTER_ENABLED:
+        return None
+
+    # Only route the first model call for a new user message. Function responses
+    # and other agents' output (e.g. a sub-agent transferring back) also arrive
+    # as "user" content, so the last content must be the user's own message,
+    # and an invocation is fast-routed at most once.
+    last_content = llm_request.contents[-1] if llm_request.contents else None
+    user_content = callback_context.user_content
+    if not last_content or not user_content or last_content != user_content:
+        return None
+    with _routed_lock:
+        if callback_context.invocation_id in _routed_invocations:
+            return None
+
+    agent_name, confidence = classify(user_content)
+    if agent_name and agent_name != MANAGER_LABEL and confidence >= PRE_ROUTER_MIN_CONFIDENCE:
+        print(f"[Pre-Router] Routing directly to '{agent_name}' (confidence {confidence:.2f}).")
+        with _routed_lock:
+            _routed_invocations[callback_context.invocation_id] = None
+            while len(_routed_invocations) > 1000:
+                _routed_invocations.popitem(last=False)
+        routing_stats.record_fast_path()
+        if agent_name == "market_agent":
+            start_market_prefetch(callback_context)
+        return LlmResponse(
+            content=types.Content(
+                role="model",
+                parts=[types.Part(function_call=types.FunctionCall(
+                    name="transfer_to_agent", args={"agent_name": agent_name}
+                ))],
+            )
+        )
+
+    routing_stats.start_llm_route(callback_context.invocation_id, agent_name)
+    return None
+
+
+def record_llm_route(callback_context: CallbackContext, llm_response: LlmResponse) -> Optional[LlmResponse]:
+    """An `after_model_callback` for the manager agent that records the LLM's routing decision."""
+    actual = MANAGER_LABEL
+    if llm_response.content and llm_response.content.parts:
+        for part in llm_response.content.parts:
+            if part.function_call and part.function_call.name == "transfer_to_agent":
+                actual = (part.function_call.args or {}).get("agent_name", MANAGER_LABEL)
+                break
+    routing_stats.finish_llm_route(callback_context.invocation_id, actual)
+    if actual == "market_agent":
+        start_market_prefetch(callback_context)
+    return None
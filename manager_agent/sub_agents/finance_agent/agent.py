@@ -1,4 +1,5 @@
 from google.adk.agents import Agent
+from routing.model_tiers import apply_model_tier, get_model, record_model_usage
 from google.adk.tools.tool_context import ToolContext
 import os
 import requests
@@ -103,7 +104,7 @@ def get_session_revenue(tool_context: ToolContext) -> dict:
 
 finance_agent = Agent(
     name="finance_agent",
-    model="gemini-2.5-pro",
+    model=get_model("finance_agent"),
     description="Provides financial planning and crop cultivation advice to maximize farm yield and profitability based on farm size and location.",
     instruction="""
     You are an expert agricultural financial advisor. Your goal is to help farmers make profitable decisions about which crops to grow and to track their earnings.
@@ -120,4 +121,6 @@ finance_agent = Agent(
     4.  **Handle Errors:** If a tool returns an error stating that session information is missing, you MUST ask the user for the missing details (e.g., "To create a plan, I need to know the size of your farm in acres. Could you please tell me?"). For any other error, inform the user that you were unable to generate a plan at this time.
     """,
     tools=[get_crop_profitability_plan, get_session_revenue],
+    before_model_callback=apply_model_tier,
+    after_model_callback=record_model_usage,
 )
\ No newline at end of file
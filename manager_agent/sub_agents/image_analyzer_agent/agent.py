@@ -1,8 +1,10 @@
 from google.adk.agents import Agent
+from routing.model_tiers import apply_model_tier, get_model, record_model_usage
+from sub_agents.image_analyzer_agent.image_pipeline import prepare_images, store_image_analysis
 
 farming_image_analyzer_agent = Agent(
     name="farming_image_analyzer_agent",
-    model="gemini-2.5-pro",
+    model=get_model("farming_image_analyzer_agent"),
     description="Analyzes any farming-related image, such as crops, livestock, soil, or equipment, and answers user questions based on the visual information.",
     instruction="""
     You are an expert in agricultural image analysis. Your purpose is to analyze any farming-related image provided by the user.
@@ -24,4 +26,6 @@ farming_image_analyzer_agent = Agent(
     **Call to Action (if applicable):**
     - If your analysis identifies a problem that can be solved with a product (e.g., a pest infestation, a nutrient deficiency), you should end your response by asking the user if they would like to purchase any recommended products. For example: "Would you like me to find some of these recommended products for you to buy?"
     """,
+    before_model_callback=[prepare_images, apply_model_tier],
+    after_model_callback=[store_image_analysis, record_model_usage],
 )
\ No newline at end of file
@@ -0,0 +1,322 @@
+"""
+Image preprocessing and a perceptual-hash analysis cache for the image analyzer.
+
+Farmers send full-resolution phone photos. Before each model call, every image
+in the request is decoded, rotated upright, stripped of EXIF metadata, scaled
+down to `IMAGE_MAX_DIMENSION` and re-encoded (WebP or JPEG at
+`IMAGE_QUALITY`). Images passed by gs:// reference are read from Cloud Storage
+first. The reads and image work run in a worker thread, off the event loop.
+Preprocessing requires Pillow; without it, images are sent unchanged.
+
+Each new image also gets a 64-bit perceptual hash (pHash). When the same
+question is asked about an image within `IMAGE_CACHE_MAX_DISTANCE` bits of a
+recently analyzed one, the earlier analysis is returned without calling the
+model.
+"""
+import asyncio
+import hashlib
+import io
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from google.adk.agents.callback_context import CallbackContext
+from google.adk.models import LlmRequest, LlmResponse
+from google.genai import types
+from routing.answer_cache import normalize_question
+
+IMAGE_PREPROCESS_ENABLED = os.environ.get("IMAGE_PREPROCESS_ENABLED", "true").lower() == "true"
+IMAGE_MAX_DIMENSION = int(os.environ.get("IMAGE_MAX_DIMENSION", "1024"))
+IMAGE_FORMAT = os.environ.get("IMAGE_FORMAT", "WEBP").upper()
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", "80"))
+IMAGE_CACHE_ENABLED = os.environ.get("IMAGE_CACHE_ENABLED", "true").lower() == "true"
+IMAGE_CACHE_TTL_SECONDS = int(os.environ.get("IMAGE_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+IMAGE_CACHE_MAX_ENTRIES = int(os.environ.get("IMAGE_CACHE_MAX_ENTRIES", "1000"))
+# Images whose hashes differ in at most this many of 64 bits count as the same image.
+IMAGE_CACHE_MAX_DISTANCE = int(os.environ.get("IMAGE_CACHE_MAX_DISTANCE", "4"))
+# Processed images are remembered by the hash of their original bytes, so
+# images earlier in the conversation are not processed again on every call.
+PROCESSED_IMAGE_MEMO_SIZE = 64
+# Log cache statistics every N lookups.
+STATS_LOG_INTERVAL = 50
+
+_MIME_TYPES = {"WEBP": "image/webp", "JPEG": "image/jpeg"}
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+    if IMAGE_PREPROCESS_ENABLED:
+        logging.warning("Pillow is not installed; images will be sent to the model unprocessed.")
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def _dct_matrix(size: int, coefficients: int) -> List[List[float]]:
+    """The first `coefficients` rows of the DCT-II basis for `size` samples."""
+    return [
+        [math.cos(math.pi * (2 * x + 1) * u / (2 * size)) for x in range(size)]
+        for u in range(coefficients)
+    ]
+
+
+_DCT_32x8 = _dct_matrix(32, 8)
+_DCT_32x8_ARRAY = np.array(_DCT_32x8) if np is not None else None
+
+
+def perceptual_hash(image) -> int:
+    """
+    Returns the 64-bit pHash of a Pillow image: the signs, relative to their
+    median, of the 8x8 lowest-frequency DCT coefficients of a 32x32 grayscale copy.
+    """
+    small = image.convert("L").resize((32, 32), Image.LANCZOS)
+    if _DCT_32x8_ARRAY is not None:
+        low = (_DCT_32x8_ARRAY @ np.asarray(small, dtype=np.float64) @ _DCT_32x8_ARRAY.T).ravel().tolist()
+    else:
+        pixels = list(small.getdata())
+        rows = [pixels[i * 32:(i + 1) * 32] for i in range(32)]
+        # DCT along each row, keeping 8 coefficients, then along each of those 8 columns.
+        row_dct = [[sum(b * p for b, p in zip(basis, row)) for basis in _DCT_32x8] for row in rows]
+        low = [
+            sum(_DCT_32x8[u][y] * row_dct[y][v] for y in range(32))
+            for u in range(8)
+            for v in range(8)
+        ]
+    # The DC term only reflects overall brightness, so it is left out of the median.
+    median = sorted(low[1:])[len(low[1:]) // 2]
+    value = 0
+    for coefficient in low:
+        value = (value << 1) | int(coefficient > median)
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def preprocess_image(data: bytes) -> Tuple[bytes, str, int]:
+    """
+    Decodes, rotates upright, strips metadata from, downscales and re-encodes an image.
+
+    Returns:
+        A tuple of (image bytes, MIME type, perceptual hash).
+    """
+    with Image.open(io.BytesIO(data)) as original:
+        # Apply the EXIF orientation before the metadata is dropped.
+        image = ImageOps.exif_transpose(original)
+        image = image.convert("RGB")
+    image.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+
+    image_format = IMAGE_FORMAT if IMAGE_FORMAT in _MIME_TYPES else "JPEG"
+    output = io.BytesIO()
+    # A freshly converted image carries no EXIF, so none is written.
+    image.save(output, format=image_format, quality=IMAGE_QUALITY, optimize=True)
+    return output.getvalue(), _MIME_TYPES[image_format], perceptual_hash(image)
+
+
+_storage_client = None
+
+
+def _read_gcs_object(uri: str) -> bytes:
+    global _storage_client
+    if _storage_client is None:
+        from google.cloud import storage
+
+        _storage_client = storage.Client()
+    bucket, _, name = uri[len("gs://"):].partition("/")
+    return _storage_client.bucket(bucket).blob(name).download_as_bytes()
+
+
+class _ProcessedImages:
+    """A small LRU of processed images, keyed by the SHA-256 of the original bytes or the gs:// URI."""
+
+    def __init__(self, max_entries: int = PROCESSED_IMAGE_MEMO_SIZE):
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key: str) -> Optional[Tuple[bytes, str, int]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, entry: Tuple[bytes, str, int]) -> None:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+_processed_images = _ProcessedImages()
+
+
+def _process_part(part: types.Part) -> Optional[Tuple[types.Part, int]]:
+    """Returns the processed replacement for an image part and its pHash, or None to leave it as it is."""
+    if part.inline_data and (part.inline_data.mime_type or "").startswith("image/"):
+        key = hashlib.sha256(part.inline_data.data).hexdigest()
+        load = lambda: part.inline_data.data
+    elif part.file_data and (part.file_data.mime_type or "").startswith("image/") \
+            and (part.file_data.file_uri or "").startswith("gs://"):
+        key = part.file_data.file_uri
+        load = lambda: _read_gcs_object(part.file_data.file_uri)
+    else:
+        return None
+
+    processed = _processed_images.get(key)
+    if processed is None:
+        original = load()
+        processed = preprocess_image(original)
+        _processed_images.set(key, processed)
+        logging.debug(f"[Image Pipeline] Re-encoded image from {len(original)} to {len(processed[0])} bytes.")
+    data, mime_type, phash = processed
+    return types.Part(inline_data=types.Blob(data=data, mime_type=mime_type)), phash
+
+
+class ImageAnalysisCache:
+    """A thread-safe TTL/LRU cache of analyses, matched by question and pHash distance."""
+
+    def __init__(self, max_entries: int = IMAGE_CACHE_MAX_ENTRIES, ttl_seconds: int = IMAGE_CACHE_TTL_SECONDS,
+                 max_distance: int = IMAGE_CACHE_MAX_DISTANCE):
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._max_distance = max_distance
+        self._lock = threading.Lock()
+        # (question, pHash) -> (answer, expires_at)
+        self._entries = OrderedDict()
+        self._stats = {"hits": 0, "misses": 0}
+
+    def _record(self, outcome: str) -> None:
+        with self._lock:
+            self._stats[outcome] += 1
+            lookups = self._stats["hits"] + self._stats["misses"]
+        if lookups % STATS_LOG_INTERVAL == 0:
+            print(f"[Image Pipeline] {self.stats()}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+    def get(self, question: str, phash: int) -> Optional[str]:
+        now = time.time()
+        best_key, best_distance = None, self._max_distance + 1
+        with self._lock:
+            for key, (_, expires_at) in list(self._entries.items()):
+                if expires_at <= now:
+                    del self._entries[key]
+                    continue
+                if key[0] != question:
+                    continue
+                distance = hamming_distance(key[1], phash)
+                if distance < best_distance:
+                    best_key, best_distance = key, distance
+            answer = None
+            if best_key is not None:
+                self._entries.move_to_end(best_key)
+                answer = self._entries[best_key][0]
+        self._record("hits" if answer is not None else "misses")
+        return answer
+
+    def set(self, question: str, phash: int, answer: str) -> None:
+        with self._lock:
+            self._entries[(question, phash)] = (answer, time.time() + self._ttl_seconds)
+            self._entries.move_to_end((question, phash))
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+
+image_analysis_cache = ImageAnalysisCache()
+# (question, pHash) awaiting an analysis from the model, by invocation id.
+_pending_analyses = {}
+_pending_lock = threading.Lock()
+
+
+async def prepare_images(callback_context: CallbackContext, llm_request: LlmRequest) -> Optional[LlmResponse]:
+    """
+    A `before_model_callback` for the image analyzer. Shrinks every image in the
+    request, and returns a cached analysis when the new image and question
+    match an earlier one.
+    """
+    if not IMAGE_PREPROCESS_ENABLED or Image is None:
+        return None
+    # Cloud Storage reads, decoding and hashing block, so they run off the event loop.
+    return await asyncio.to_thread(_prepare_images, callback_context, llm_request)
+
+
+def _prepare_images(callback_context: CallbackContext, llm_request: LlmRequest) -> Optional[LlmResponse]:
+    for content in llm_request.contents:
+        for i, part in enumerate(content.parts or []):
+            try:
+                processed = _process_part(part)
+            except Exception as e:
+                logging.warning(f"[Image Pipeline] Could not process image; sending it unchanged. Error: {e}")
+                continue
+            if processed is not None:
+                content.parts[i] = processed[0]
+
+    # The image analyzer is usually reached by a transfer, so the last content
+    # is the manager's output; the turn's image and question are the user's.
+    # Calls that follow a tool call have already been looked up.
+    user_content = callback_context.user_content
+    last_content = llm_request.contents[-1] if llm_request.contents else None
+    if not IMAGE_CACHE_ENABLED or not user_content or not user_content.parts or \
+            (last_content and any(part.function_response for part in last_content.parts or [])):
+        return None
+    current_hashes = []
+    for part in user_content.parts:
+        try:
+            # Memoized by the original bytes, so this reuses the work done above.
+            processed = _process_part(part)
+        except Exception:
+            continue
+        if processed is not None:
+            current_hashes.append(processed[1])
+
+    # Only a single-image question can be served from the cache.
+    if len(current_hashes) != 1:
+        return None
+    question = normalize_question(" ".join(part.text for part in user_content.parts if part.text))
+    phash = current_hashes[0]
+    answer = image_analysis_cache.get(question, phash)
+    if answer is not None:
+        print(f"[Image Pipeline] Serving cached analysis for image {phash:016x}.")
+        return LlmResponse(content=types.Content(role="model", parts=[types.Part(text=answer)]))
+
+    with _pending_lock:
+        if len(_pending_analyses) > 1000:
+            _pending_analyses.clear()
+        _pending_analyses[callback_context.invocation_id] = (question, phash)
+    return None
+
+
+def store_image_analysis(callback_context: CallbackContext, llm_response: LlmResponse) -> Optional[LlmResponse]:
+    """An `after_model_callback` for the image analyzer that caches plain-text analyses."""
+    if llm_response.partial:
+        return None
+    with _pending_lock:
+        pending = _pending_analyses.pop(callback_context.invocation_id, None)
+    if pending is None or not llm_response.content or not llm_response.content.parts:
+        return None
+
+    parts = llm_response.content.parts
+    if any(part.function_call for part in parts):
+        return None
+    answer = "".join(part.text for part in parts if part.text and not part.thought).strip()
+    if answer:
+        question, phash = pending
+        image_analysis_cache.set(question, phash, answer)
+    return None
@@ -1,10 +1,13 @@
 from google.adk.agents import Agent
+from routing.model_tiers import apply_model_tier, get_model, record_model_usage
 from google.adk.tools.tool_context import ToolContext
+from sub_agents.market_agent.prefetch import use_prefetched_result
 from google.cloud import firestore
 import logging
 from typing import Optional
 import os
 import json
+import base64
 import requests
 from datetime import datetime
 
@@ -101,12 +104,74 @@ def get_latest_market_price_from_session_location(tool_context: ToolContext, com
         print(f"[Tool] API request failed: {e}")
         return {"error": f"Failed to fetch data from the API. Error: {e}"}
 
+# Only the fields the agent presents to the user are returned for each product.
+PRODUCT_LIST_FIELDS = ["product_id", "product_name", "seller_name", "price_per_kg", "quantity_available"]
+DEFAULT_PRODUCT_LIMIT = 10
+MAX_PRODUCT_LIMIT = 25
+# Weights for ranking products: cheaper, better rated and more recently listed first.
+RANKING_WEIGHTS = {"price": 0.5, "rating": 0.3, "freshness": 0.2}
+
+
+def _normalize(value: float, low: float, high: float) -> float:
+    """Scales a value into [0, 1], returning 0.5 when all values are equal."""
+    return (value - low) / (high - low) if high > low else 0.5
+
+
+def _rank_products(products: list) -> list:
+    """Sorts products by a weighted score of price, rating and freshness."""
+    prices = [p.get("price_per_kg") or 0 for p in products]
+    listed = [p["listed_at"].timestamp() if hasattr(p.get("listed_at"), "timestamp") else 0 for p in products]
+    low_price, high_price = min(prices), max(prices)
+    oldest, newest = min(listed), max(listed)
+
+    def score(index_and_product):
+        index, product = index_and_product
+        # Unrated products are treated as average (3 of 5).
+        rating = product.get("rating")
+        rating = rating if isinstance(rating, (int, float)) else 3.0
+        return (
+            RANKING_WEIGHTS["price"] * (1 - _normalize(prices[index], low_price, high_price))
+            + RANKING_WEIGHTS["rating"] * rating / 5
+            + RANKING_WEIGHTS["freshness"] * _normalize(listed[index], oldest, newest)
+        )
+
+    ranked = sorted(enumerate(products), key=lambda item: (-score(item), item[1]["product_id"]))
+    return [product for _, product in ranked]
+
+
+def _encode_page_token(offset: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode("utf-8")).decode("ascii")
+
+
+def _decode_page_token(page_token: Optional[str]) -> int:
+    if not page_token:
+        return 0
+    try:
+        return max(int(json.loads(base64.urlsafe_b64decode(page_token.encode("ascii")))["offset"]), 0)
+    except Exception:
+        raise ValueError("Invalid page_token. Call the tool again without a page_token to start over.")
+
+
+def _summarize_products(products: list) -> dict:
+    """Summarizes products that are not on the current page as counts."""
+    by_type = {}
+    by_name = {}
+    for product in products:
+        product_type = product.get("product_type") or "unknown"
+        product_name = product.get("product_name") or "Unknown Product"
+        by_type[product_type] = by_type.get(product_type, 0) + 1
+        by_name[product_name] = by_name.get(product_name, 0) + 1
+    return {"count": len(products), "by_product_type": by_type, "by_product_name": by_name}
+
+
 def list_products_for_sale(
     tool_context: ToolContext,
     product_type: Optional[str] = None,
     product_name: Optional[str] = None,
     state: Optional[str] = None,
     district: Optional[str] = None,
+    limit: Optional[int] = None,
+    page_token: Optional[str] = None,
 ) -> dict:
     """
     Lists products available for sale from the Firestore database.
@@ -114,6 +179,13 @@ def list_products_for_sale(
     available to everyone (e.g., fertilizers, seeds).
     Can be filtered by product_type and product_name.
     If state or district are not provided, it uses the values from the session.
+
+    Products are ranked by price, rating and freshness, and only one page is
+    returned. Pass the returned `next_page_token` to get the next page.
+
+    Args:
+        limit: The number of products to return (default 10, maximum 25).
+        page_token: The `next_page_token` from a previous call.
     """
     if not db:
         return {"error": "Database connection is not available."}
@@ -179,8 +251,24 @@ def list_products_for_sale(
         if not products:
             return {"message": f"No products found for the specified criteria in {query_district}, {query_state} or nationwide."}
 
-        return {"products": products}
+        page_size = min(max(int(limit or DEFAULT_PRODUCT_LIMIT), 1), MAX_PRODUCT_LIMIT)
+        offset = _decode_page_token(page_token)
+
+        ranked = _rank_products(products)
+        page = ranked[offset:offset + page_size]
+        remaining = ranked[offset + page_size:]
+
+        result = {
+            "products": [{field: product.get(field) for field in PRODUCT_LIST_FIELDS} for product in page],
+            "total_matches": len(ranked),
+        }
+        if remaining:
+            result["next_page_token"] = _encode_page_token(offset + page_size)
+            result["not_shown"] = _summarize_products(remaining)
+        return result
 
+    except ValueError as ve:
+        return {"error": str(ve)}
     except Exception as e:
         logging.error(f"Error listing products: {e}")
         return {"error": f"An error occurred while fetching products: {e}"}
@@ -541,7 +629,7 @@ def sell_product(
 
 market_agent = Agent(
     name="market_agent",
-    model="gemini-2.5-pro",
+    model=get_model("market_agent"),
     description="Handles all market-related activities, including buying, selling, and providing real-time market price analysis for agricultural products.",
     instruction="""
     You are a specialized agricultural market analyst for India. Your purpose is to provide farmers with the latest market prices for their crops, and to help them buy and sell products on the marketplace.
@@ -560,6 +648,7 @@ market_agent = Agent(
     3.  **Listing Products (User wants to see/browse):**
         - If the user asks to see available products (e.g., "what fertilizers are available?"), call the `list_products_for_sale` tool.
         - When presenting the list, format it clearly. For each product, show the `product_name`, `seller_name`, `price_per_kg`, `quantity_available`, and the `product_id`. The `product_id` is very important for the user to make a purchase.
+        - Products are returned best first, one page at a time. If the tool returns `not_shown`, tell the user how many more products are available (using its counts) and offer to show more. To show more, call the tool again with the same filters and the `next_page_token`.
 
     4.  **Buying a Product:**
         - To buy a product, the user needs to specify the `product_name` (e.g., "tomato") and the `quantity`.
@@ -596,4 +685,8 @@ market_agent = Agent(
         get_order_details,
         get_latest_market_price_from_session_location,
     ],
+    before_model_callback=apply_model_tier,
+    after_model_callback=record_model_usage,
+    # Price and listing lookups started speculatively at routing time are reused here.
+    before_tool_callback=use_prefetched_result,
 )
\ No newline at end of file
@@ -0,0 +1,186 @@
+"""
+Speculative, parallel prefetch of market tool results.
+
+A sell request always needs `get_latest_market_price_from_session_location`
+before `sell_product`, and a buy request always needs `list_products_for_sale`.
+The model only discovers this over several sequential model -> tool round
+trips. As soon as a turn is routed to the market agent (by the pre-router or
+by the manager's model), `start_market_prefetch` detects the intent and the
+commodity and runs the likely read-only tools concurrently. When the model
+later calls one of them with matching arguments, `use_prefetched_result`
+returns the prefetched result instead of calling the tool again, if it is
+ready. A prefetch that is still running is never waited for, since the
+callback runs on the event loop, and each result is served at most once.
+"""
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+from google.adk.agents.callback_context import CallbackContext
+from google.adk.tools.base_tool import BaseTool
+from google.adk.tools.tool_context import ToolContext
+
+# Prefetched results are only valid for the turn, and never for longer than this.
+PREFETCH_TTL_SECONDS = 60
+
+PRICE_TOOL = "get_latest_market_price_from_session_location"
+LIST_TOOL = "list_products_for_sale"
+
+# Commodity names in English, Hindi and Tamil, mapped to the English name the tools use.
+COMMODITIES = {
+    "tomato": ["tomato", "टमाटर", "தக்காளி"],
+    "onion": ["onion", "प्याज", "வெங்காயம்"],
+    "potato": ["potato", "आलू", "உருளைக்கிழங்கு"],
+    "brinjal": ["brinjal", "eggplant", "बैंगन", "கத்தரிக்காய்"],
+    "cabbage": ["cabbage", "पत्ता गोभी", "முட்டைக்கோஸ்"],
+    "cauliflower": ["cauliflower", "फूलगोभी", "காலிஃபிளவர்"],
+    "green chilli": ["chilli", "chili", "मिर्च", "மிளகாய்"],
+    "paddy": ["paddy", "rice", "धान", "நெல்"],
+    "wheat": ["wheat", "गेहूं", "गेहूँ", "கோதுமை"],
+    "maize": ["maize", "corn", "मक्का", "மக்காச்சோளம்"],
+    "cotton": ["cotton", "कपास", "பருத்தி"],
+    "sugarcane": ["sugarcane", "गन्ना", "கரும்பு"],
+    "banana": ["banana", "केला", "வாழை"],
+    "mango": ["mango", "மாம்பழம்"],
+    "groundnut": ["groundnut", "peanut", "मूंगफली", "நிலக்கடலை"],
+    "turmeric": ["turmeric", "हल्दी", "மஞ்சள்"],
+    "garlic": ["garlic", "लहसुन", "பூண்டு"],
+    "ginger": ["ginger", "अदरक", "இஞ்சி"],
+    "carrot": ["carrot", "गाजर", "கேரட்"],
+    "coconut": ["coconut", "नारियल", "தேங்காய்"],
+}
+_COMMODITY_PATTERNS = [
+    (commodity, re.compile(r"(?<!\w)(" + "|".join(re.escape(n) for n in names) + r")(e?s)?(?!\w)", re.IGNORECASE))
+    for commodity, names in COMMODITIES.items()
+]
+
+_SELL_RE = re.compile(r"\b(sell|selling)\b|बेच|விற்க|விற்பனை", re.IGNORECASE)
+_BUY_RE = re.compile(r"\b(buy|buying|purchase|available|show me)\b|खरीद|வாங்க", re.IGNORECASE)
+_PRICE_RE = re.compile(r"\b(price|prices|rate)\b|कीमत|भाव|दाम|விலை", re.IGNORECASE)
+
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="market-prefetch")
+_lock = threading.Lock()
+# (invocation_id, tool_name, argument key) -> (started_at, future)
+_prefetched: Dict[tuple, tuple] = {}
+
+
+class _PrefetchContext:
+    """A stand-in for ToolContext. The prefetched tools only read session state."""
+
+    def __init__(self, state: dict):
+        self.state = state
+
+
+def detect_commodity(text: str) -> Optional[str]:
+    for commodity, pattern in _COMMODITY_PATTERNS:
+        if pattern.search(text):
+            return commodity
+    return None
+
+
+def _mentioned_commodity(text: str) -> Optional[str]:
+    """
+    Returns the commodity the text mentions, as the model is likely to pass it
+    to a tool: the English word the user wrote ("chillies", "rice"), or the
+    English name for a Hindi or Tamil one.
+    """
+    for commodity, pattern in _COMMODITY_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            return match.group(0) if match.group(1).isascii() else commodity
+    return None
+
+
+def _commodity_key(name: str) -> str:
+    """Normalizes a commodity name the way the tools do before querying ("chillies" -> "Chilli")."""
+    # Imported here because the market agent module registers this module's callback.
+    from sub_agents.market_agent.agent import _singularize
+
+    return _singularize(name.strip()).title()
+
+
+def _argument_key(tool_name: str, args: Dict[str, Any]) -> Optional[str]:
+    """Normalizes tool arguments to the key used for prefetched results."""
+    if tool_name == PRICE_TOOL:
+        commodity = args.get("commodity")
+        return _commodity_key(commodity) if commodity else None
+    if tool_name == LIST_TOOL:
+        # Only the plain "list this product" call is prefetched.
+        if any(value is not None for name, value in args.items() if name != "product_name"):
+            return None
+        product_name = args.get("product_name")
+        return _commodity_key(product_name) if product_name else None
+    return None
+
+
+def _user_text(callback_context: CallbackContext) -> str:
+    content = callback_context.user_content
+    if not content or not content.parts:
+        return ""
+    return " ".join(part.text for part in content.parts if part.text)
+
+
+def start_market_prefetch(callback_context: CallbackContext) -> None:
+    """Starts the tool calls a market turn is likely to need, in the background."""
+    from sub_agents.market_agent.agent import (
+        get_latest_market_price_from_session_location,
+        list_products_for_sale,
+    )
+
+    text = _user_text(callback_context)
+    commodity = _mentioned_commodity(text)
+    if not commodity:
+        return
+
+    calls = []
+    if _SELL_RE.search(text) or _PRICE_RE.search(text):
+        calls.append((PRICE_TOOL, get_latest_market_price_from_session_location, {"commodity": commodity}))
+    if _BUY_RE.search(text):
+        calls.append((LIST_TOOL, list_products_for_sale, {"product_name": commodity}))
+    if not calls:
+        return
+
+    # Snapshot the state so the background threads never touch the live session.
+    state = callback_context.state.to_dict()
+    invocation_id = callback_context.invocation_id
+    now = time.monotonic()
+    with _lock:
+        for key in [k for k, (started, _) in _prefetched.items() if now - started > PREFETCH_TTL_SECONDS]:
+            del _prefetched[key]
+        for tool_name, tool, args in calls:
+            key = (invocation_id, tool_name, _argument_key(tool_name, args))
+            if key not in _prefetched:
+                _prefetched[key] = (now, _executor.submit(tool, _PrefetchContext(dict(state)), **args))
+                print(f"[Market Prefetch] Started {tool_name}({args}).")
+
+
+def use_prefetched_result(tool: BaseTool, args: Dict[str, Any], tool_context: ToolContext) -> Optional[dict]:
+    """
+    A `before_tool_callback` for the market agent. Returns the prefetched
+    result for a matching call, or None to run the tool normally.
+    """
+    argument_key = _argument_key(tool.name, args)
+    if argument_key is None:
+        return None
+    # Popped so a repeated call, e.g. listing again after a purchase, reads fresh data.
+    with _lock:
+        entry = _prefetched.pop((tool_context.invocation_id, tool.name, argument_key), None)
+    if entry is None:
+        return None
+
+    started, future = entry
+    if time.monotonic() - started > PREFETCH_TTL_SECONDS:
+        return None
+    if not future.done():
+        print(f"[Market Prefetch] {tool.name} is still being prefetched; calling it directly.")
+        return None
+    try:
+        result = future.result()
+    except Exception as e:
+        logging.warning(f"[Market Prefetch] Prefetched {tool.name} failed; calling it directly. Error: {e}")
+        return None
+    print(f"[Market Prefetch] Served {tool.name}({args}) from the prefetch.")
+    return result
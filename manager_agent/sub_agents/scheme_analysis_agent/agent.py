@@ -1,7 +1,11 @@
 from google.adk.agents import Agent
+from routing.model_tiers import apply_model_tier, get_model, record_model_usage
 from google.adk.tools import ToolContext
 from vertexai.preview import rag
 from google.genai import types
+from sub_agents.scheme_analysis_agent.context_shaping import shape_context
+from sub_agents.scheme_analysis_agent.local_index import LOCAL_MIN_CONFIDENCE, get_local_index
+from sub_agents.scheme_analysis_agent.retrieval_cache import make_cache_key, retrieval_cache
 
 # --- Configuration for the "Scheme Analysis Sub-Agent" ---
 
@@ -10,17 +14,49 @@ from google.genai import types
 SCHEMES_LOANS_CORPUS_NAME = "projects/valued-mediator-461216-k7/locations/us-central1/ragCorpora/4611686018427387904"
 
 # Configure retrieval parameters
+RETRIEVAL_TOP_K = 5
+VECTOR_DISTANCE_THRESHOLD = 0.7
 rag_retrieval_config = rag.RagRetrievalConfig(
-            top_k=5,
-            filter=rag.Filter(vector_distance_threshold=0.7),
+            top_k=RETRIEVAL_TOP_K,
+            filter=rag.Filter(vector_distance_threshold=VECTOR_DISTANCE_THRESHOLD),
         )
 
+def _query_remote_corpus(query: str) -> list:
+    """Queries the Vertex RAG corpus and returns its contexts as summaries."""
+    # Use the rag.retrieval_query method as requested.
+    # Note that rag_corpora expects a list of strings.
+    print("Performing retrieval query...")
+    response = rag.retrieval_query(
+        rag_resources=[
+            rag.RagResource(
+                rag_corpus=SCHEMES_LOANS_CORPUS_NAME,
+            )
+        ],
+        text=query,
+        rag_retrieval_config=rag_retrieval_config,
+    )
+
+    summaries = []
+    # The relevant information is in the 'contexts' attribute of the response
+    if response.contexts and response.contexts.contexts:
+        contexts = response.contexts.contexts
+        print(f"[Scheme Agent] Found {len(contexts)} relevant contexts. Processing...")
+        for rank, context in enumerate(contexts):
+            summaries.append({
+                "content": context.text if context.text else 'No content available.',
+                "source": context.source_uri if context.source_uri else 'Source not available',
+                # Contexts are returned best first, so the rank doubles as a score.
+                "score": 1.0 - rank / len(contexts),
+            })
+    return summaries
+
+
 def query_schemes_and_loans_kb(tool_context: ToolContext, query: str) -> dict:
     """
     This tool acts as a specialist for government schemes and loans.
-    It searches a dedicated knowledge base (RAG corpus) using the
-    rag.retrieval_query method to answer a farmer's specific question.
-    It then extracts and structures the key information and source links.
+    It first searches a local index of the scheme documents and only falls
+    back to the dedicated knowledge base (RAG corpus) when the local match
+    is weak. It then extracts and structures the key information and source links.
 
     Args:
         farmer_query: The farmer's question in natural language, for example,
@@ -33,38 +69,50 @@ def query_schemes_and_loans_kb(tool_context: ToolContext, query: str) -> dict:
     """
     print(f"[Scheme Agent] Querying schemes/loans KB with: '{query}'")
     try:
-        # Use the rag.retrieval_query method as requested.
-        # Note that rag_corpora expects a list of strings.
-        print("Performing retrieval query...")
-        response = rag.retrieval_query(
-            rag_resources=[
-                rag.RagResource(
-                    rag_corpus=SCHEMES_LOANS_CORPUS_NAME,
-                )
-            ],
-            text=query,
-            rag_retrieval_config=rag_retrieval_config,
+        local_index = get_local_index()
+
+        # --- Check the retrieval cache first ---
+        # Rebuilding the local index changes its build id, which invalidates its entries.
+        cache_key = make_cache_key(
+            query,
+            SCHEMES_LOANS_CORPUS_NAME,
+            {
+                "top_k": RETRIEVAL_TOP_K,
+                "vector_distance_threshold": VECTOR_DISTANCE_THRESHOLD,
+                "local_min_confidence": LOCAL_MIN_CONFIDENCE,
+                "local_index": local_index.build_id if local_index is not None else None,
+            },
         )
-        
-        # --- Process the response from retrieval_query ---
-        summaries = []
+        cached_output = retrieval_cache.get(cache_key) if cache_key else None
+        if cached_output is not None:
+            print("[Scheme Agent] Returning cached retrieval result.")
+            return cached_output
+
+        summaries = None
+
+        # --- Tier 1: the local, memory-mapped index ---
+        if local_index is not None:
+            local_result = local_index.search(query, top_k=RETRIEVAL_TOP_K)
+            if local_result["results"] and local_result["confidence"] >= LOCAL_MIN_CONFIDENCE:
+                print(f"[Scheme Agent] Answered from the local index (confidence {local_result['confidence']}).")
+                summaries = local_result["results"]
+            else:
+                print(f"[Scheme Agent] Local confidence {local_result['confidence']} is too low. Using the remote corpus.")
+
+        # --- Tier 2: the remote Vertex RAG corpus ---
+        if summaries is None:
+            summaries = _query_remote_corpus(query)
+
+        # --- Deduplicate, merge and trim the chunks to the token budget ---
+        summaries = shape_context(summaries)
+
+        # --- Process the retrieved summaries ---
         application_links = set()
-        
-        # The relevant information is in the 'contexts' attribute of the response
-        if response.contexts and response.contexts.contexts:
-            print(f"[Scheme Agent] Found {len(response.contexts.contexts)} relevant contexts. Processing...")
-            for context in response.contexts.contexts:
-                source_uri = context.source_uri if context.source_uri else 'Source not available'
-                content_text = context.text if context.text else 'No content available.'
-
-                # Add source URI to the links set if it's a web URL
-                if source_uri and source_uri.startswith('http'):
-                    application_links.add(source_uri)
-                
-                summaries.append({
-                    "content": content_text,
-                    "source": source_uri
-                })
+        for summary in summaries:
+            source_uri = summary["source"]
+            # Add source URI to the links set if it's a web URL
+            if source_uri and source_uri.startswith('http'):
+                application_links.add(source_uri)
 
         # The final, clean output for the LLM
         final_output = {
@@ -74,7 +122,10 @@ def query_schemes_and_loans_kb(tool_context: ToolContext, query: str) -> dict:
         
         if application_links:
             print(f"[Scheme Agent] Extracted links: {list(application_links)}")
-            
+
+        # Empty results are not cached, so newly indexed documents show up immediately.
+        if summaries and cache_key:
+            retrieval_cache.set(cache_key, final_output)
         return final_output
         
     except Exception as e:
@@ -85,7 +136,7 @@ def query_schemes_and_loans_kb(tool_context: ToolContext, query: str) -> dict:
 
 scheme_analysis_agent = Agent(
     name="scheme_analysis_agent",
-    model="gemini-2.5-pro",
+    model=get_model("scheme_analysis_agent"),
     description="Provides detailed information on government schemes, subsidies, and loans for farmers by searching a dedicated knowledge base.",
     instruction="""
     You are a specialist in Indian government agricultural schemes and loans. Your primary function is to help farmers understand and apply for financial support.
@@ -104,4 +155,6 @@ scheme_analysis_agent = Agent(
     Structure your answer clearly. Use headings (like "Scheme Details", "Eligibility", "Application Links") and bullet points to make the information easy to digest.
     """,
     tools=[query_schemes_and_loans_kb],
+    before_model_callback=apply_model_tier,
+    after_model_callback=record_model_usage,
 )
\ No newline at end of file
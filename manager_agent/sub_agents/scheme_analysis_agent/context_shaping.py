@@ -0,0 +1,121 @@
+"""
+Post-retrieval shaping of scheme chunks before they are handed to the LLM.
+
+Retrieved chunks often overlap: the same PDF is chunked with overlapping
+windows, and several windows match the same question. This module
+1. drops near-duplicate chunks (word-shingle Jaccard similarity),
+2. merges chunks from the same source whose text overlaps end-to-start, and
+3. keeps the highest-scoring chunks that fit in a token budget.
+"""
+import os
+from typing import List
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("SCHEME_CONTEXT_TOKEN_BUDGET", "1500"))
+# Chunks at least this similar to a higher-scoring chunk are dropped.
+DUPLICATE_JACCARD_THRESHOLD = 0.8
+SHINGLE_SIZE = 5
+# Minimum number of shared words for two chunks to be considered adjacent.
+MIN_MERGE_OVERLAP_WORDS = 8
+# Do not bother appending a truncated chunk shorter than this.
+MIN_TRUNCATED_TOKENS = 50
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    A cheap token estimate: about four characters per token for English, but
+    never fewer tokens than words, which holds better for Indic scripts.
+    """
+    return max(len(text) // 4, len(text.split()))
+
+
+def _shingles(words: List[str]) -> set:
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def _jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _overlap_length(first: List[str], second: List[str]) -> int:
+    """Returns the number of words at the end of `first` that begin `second`."""
+    for k in range(min(len(first), len(second)), MIN_MERGE_OVERLAP_WORDS - 1, -1):
+        if first[-k:] == second[:k]:
+            return k
+    return 0
+
+
+def _remove_near_duplicates(chunks: List[dict]) -> List[dict]:
+    kept = []
+    kept_shingles = []
+    for chunk in chunks:
+        shingles = _shingles(chunk["content"].lower().split())
+        if any(_jaccard(shingles, other) >= DUPLICATE_JACCARD_THRESHOLD for other in kept_shingles):
+            continue
+        kept.append(chunk)
+        kept_shingles.append(shingles)
+    return kept
+
+
+def _merge_adjacent(chunks: List[dict]) -> List[dict]:
+    merged = []
+    for chunk in chunks:
+        words = chunk["content"].split()
+        for existing in merged:
+            if existing["source"] != chunk["source"]:
+                continue
+            existing_words = existing["content"].split()
+            overlap = _overlap_length(existing_words, words)
+            if overlap:
+                existing["content"] = " ".join(existing_words + words[overlap:])
+                break
+            overlap = _overlap_length(words, existing_words)
+            if overlap:
+                existing["content"] = " ".join(words + existing_words[overlap:])
+                break
+        else:
+            merged.append(dict(chunk))
+            continue
+        existing["score"] = max(existing["score"], chunk["score"])
+    return merged
+
+
+def shape_context(chunks: List[dict], token_budget: int = CONTEXT_TOKEN_BUDGET) -> List[dict]:
+    """
+    Deduplicates, merges and trims retrieved chunks to fit `token_budget`.
+
+    Args:
+        chunks: Dicts with 'content', 'source' and 'score' keys. Higher scores
+                are more relevant.
+        token_budget: The approximate maximum number of tokens to return.
+
+    Returns:
+        The shaped chunks as 'content' and 'source' dicts, best first.
+    """
+    ranked = sorted(chunks, key=lambda c: c["score"], reverse=True)
+    shaped = _merge_adjacent(_remove_near_duplicates(ranked))
+    shaped.sort(key=lambda c: c["score"], reverse=True)
+
+    result = []
+    remaining = token_budget
+    for chunk in shaped:
+        tokens = estimate_tokens(chunk["content"])
+        if tokens <= remaining:
+            result.append({"content": chunk["content"], "source": chunk["source"]})
+            remaining -= tokens
+        elif remaining >= MIN_TRUNCATED_TOKENS:
+            words = chunk["content"].split()
+            # Scale the word count by the chunk's own tokens-per-word ratio.
+            keep = max(int(len(words) * remaining / tokens), 1)
+            result.append({"content": " ".join(words[:keep]) + " ...", "source": chunk["source"]})
+            break
+        else:
+            break
+
+    before = sum(estimate_tokens(c["content"]) for c in chunks)
+    after = sum(estimate_tokens(c["content"]) for c in result)
+    print(f"[Scheme Agent] Shaped {len(chunks)} chunks (~{before} tokens) into {len(result)} chunks (~{after} tokens).")
+    return result
@@ -0,0 +1,306 @@
+"""
+A local, first-tier retrieval index for the scheme and loan documents.
+
+The index is built offline from the same PDFs that were imported into the
+Vertex RAG corpus (see `build_scheme_index.py` at the repository root) and is
+shipped next to this module. It combines a BM25 inverted index with an
+optional dense embedding matrix. The large files are memory-mapped at startup,
+so loading costs almost nothing and queries are answered in milliseconds
+without a network call.
+
+Index layout (all files live in one directory):
+    index.json      - Metadata: chunk table, sources, vocabulary and BM25 parameters.
+    chunks.bin      - The UTF-8 text of every chunk, concatenated.
+    postings.bin    - Little-endian (uint32 chunk_id, uint32 term_frequency) pairs.
+    embeddings.npy  - Optional float32 matrix (n_chunks x dim) of L2-normalized embeddings.
+"""
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import time
+import uuid
+from collections import Counter
+from typing import List, Optional
+
+INDEX_FORMAT_VERSION = 1
+DEFAULT_INDEX_DIR = os.environ.get(
+    "SCHEME_LOCAL_INDEX_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "scheme_index"),
+)
+# Below this confidence the caller should fall back to the remote RAG corpus.
+LOCAL_MIN_CONFIDENCE = float(os.environ.get("SCHEME_LOCAL_MIN_CONFIDENCE", "0.6"))
+# Weight of the dense score when both indexes are available.
+DENSE_WEIGHT = float(os.environ.get("SCHEME_LOCAL_DENSE_WEIGHT", "0.5"))
+
+_POSTING = struct.Struct("<II")
+# Latin word characters plus the Indic script blocks (Devanagari to Sinhala),
+# so that vowel signs do not split Hindi or Tamil words apart.
+_TOKEN_RE = re.compile(r"[\w\u0900-\u0DFF]+")
+
+STOP_WORDS = frozenset("""
+a about all am an and any are as at be been but by can could do does for from
+get give has have how i if in into is it its me my of on or our please show so
+tell than that the their them then there these they this to us was we what
+when where which who why will with would you your available list
+""".split())
+
+
+def _stem(token: str) -> str:
+    """A very basic stemmer so 'schemes' and 'scheme' share a posting list."""
+    if token.endswith("ies") and len(token) > 4:
+        return token[:-3] + "y"
+    if token.endswith("s") and not token.endswith("ss") and len(token) > 3:
+        return token[:-1]
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercases, splits and stems text, dropping stop-words."""
+    return [
+        _stem(token)
+        for token in _TOKEN_RE.findall(text.lower())
+        if token not in STOP_WORDS
+    ]
+
+
+def build_index(chunks: List[dict], out_dir: str, embeddings=None, embedding_model: Optional[str] = None,
+                k1: float = 1.5, b: float = 0.75) -> dict:
+    """
+    Writes a local index for the given chunks to `out_dir`.
+
+    Args:
+        chunks: A list of dicts, each with 'text' and 'source' keys.
+        out_dir: The directory to write the index files into.
+        embeddings: An optional numpy array of shape (len(chunks), dim).
+        embedding_model: The name of the model used for `embeddings`. The same
+                         model is used to embed queries at search time.
+
+    Returns:
+        The metadata dictionary that was written to index.json.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+
+    sources = []
+    source_ids = {}
+    chunk_table = []
+    postings = {}
+
+    with open(os.path.join(out_dir, "chunks.bin"), "wb") as chunks_file:
+        offset = 0
+        for chunk_id, chunk in enumerate(chunks):
+            encoded = chunk["text"].encode("utf-8")
+            chunks_file.write(encoded)
+
+            source = chunk.get("source") or "Source not available"
+            if source not in source_ids:
+                source_ids[source] = len(sources)
+                sources.append(source)
+
+            tokens = tokenize(chunk["text"])
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append((chunk_id, tf))
+
+            chunk_table.append([offset, len(encoded), source_ids[source], len(tokens)])
+            offset += len(encoded)
+
+    terms = {}
+    with open(os.path.join(out_dir, "postings.bin"), "wb") as postings_file:
+        position = 0
+        for term in sorted(postings):
+            entries = postings[term]
+            for chunk_id, tf in entries:
+                postings_file.write(_POSTING.pack(chunk_id, tf))
+            terms[term] = [position, len(entries)]
+            position += len(entries)
+
+    total_length = sum(row[3] for row in chunk_table)
+    metadata = {
+        "format_version": INDEX_FORMAT_VERSION,
+        "build_id": uuid.uuid4().hex,
+        "built_at": time.time(),
+        "k1": k1,
+        "b": b,
+        "avgdl": (total_length / len(chunk_table)) if chunk_table else 0.0,
+        "sources": sources,
+        "chunks": chunk_table,
+        "terms": terms,
+        "embedding_model": None,
+    }
+
+    if embeddings is not None:
+        import numpy as np
+
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        np.save(os.path.join(out_dir, "embeddings.npy"), matrix / norms)
+        metadata["embedding_model"] = embedding_model
+
+    with open(os.path.join(out_dir, "index.json"), "w", encoding="utf-8") as meta_file:
+        json.dump(metadata, meta_file, ensure_ascii=False)
+
+    return metadata
+
+
+class LocalSchemeIndex:
+    """A read-only, memory-mapped hybrid BM25 + embedding index."""
+
+    def __init__(self, index_dir: str):
+        with open(os.path.join(index_dir, "index.json"), "r", encoding="utf-8") as meta_file:
+            metadata = json.load(meta_file)
+        if metadata.get("format_version") != INDEX_FORMAT_VERSION:
+            raise ValueError(f"Unsupported local index format: {metadata.get('format_version')}")
+
+        self.build_id = metadata["build_id"]
+        self._k1 = metadata["k1"]
+        self._b = metadata["b"]
+        self._avgdl = metadata["avgdl"] or 1.0
+        self._sources = metadata["sources"]
+        self._chunks = metadata["chunks"]
+        self._terms = metadata["terms"]
+        self._n_chunks = len(self._chunks)
+
+        self._chunks_file = open(os.path.join(index_dir, "chunks.bin"), "rb")
+        self._postings_file = open(os.path.join(index_dir, "postings.bin"), "rb")
+        self._chunks_map = _mmap_file(self._chunks_file)
+        self._postings_map = _mmap_file(self._postings_file)
+
+        self._embeddings = None
+        self._embedder = None
+        self._embedding_model = metadata.get("embedding_model")
+        embeddings_path = os.path.join(index_dir, "embeddings.npy")
+        if self._embedding_model and os.path.exists(embeddings_path):
+            try:
+                import numpy as np
+
+                self._embeddings = np.load(embeddings_path, mmap_mode="r")
+            except ImportError:
+                logging.warning("numpy is not installed; the local index will use BM25 only.")
+
+    def __len__(self) -> int:
+        return self._n_chunks
+
+    def _idf(self, df: int) -> float:
+        return math.log(1 + (self._n_chunks - df + 0.5) / (df + 0.5))
+
+    def _postings(self, term: str):
+        position, count = self._terms[term]
+        start = position * _POSTING.size
+        return _POSTING.iter_unpack(self._postings_map[start:start + count * _POSTING.size])
+
+    def _chunk_text(self, chunk_id: int) -> str:
+        offset, length, _, _ = self._chunks[chunk_id]
+        return self._chunks_map[offset:offset + length].decode("utf-8")
+
+    def _embed_query(self, query: str):
+        """Embeds the query with the model the index was built with, if it is installed."""
+        if self._embeddings is None:
+            return None
+        if self._embedder is None:
+            try:
+                from sentence_transformers import SentenceTransformer
+            except ImportError:
+                logging.warning("sentence-transformers is not installed; the local index will use BM25 only.")
+                self._embeddings = None
+                return None
+            self._embedder = SentenceTransformer(self._embedding_model)
+        return self._embedder.encode([query], normalize_embeddings=True)[0]
+
+    def search(self, query: str, top_k: int = 5) -> dict:
+        """
+        Searches the index.
+
+        Returns:
+            A dictionary with a `results` list (each with 'content', 'source'
+            and 'score') and a `confidence` between 0 and 1. The confidence is
+            the IDF-weighted share of the query terms found in the best chunk,
+            blended with its embedding similarity when dense search is enabled.
+        """
+        query_terms = set(tokenize(query))
+        if not query_terms or not self._n_chunks:
+            return {"results": [], "confidence": 0.0}
+
+        scores = {}
+        matched_idf = {}
+        total_idf = 0.0
+        for term in query_terms:
+            if term not in self._terms:
+                # Unknown terms weigh as much as the rarest known term, so
+                # queries about topics absent from the corpus get low confidence.
+                total_idf += self._idf(1)
+                continue
+            df = self._terms[term][1]
+            idf = self._idf(df)
+            total_idf += idf
+            for chunk_id, tf in self._postings(term):
+                doc_len = self._chunks[chunk_id][3]
+                denominator = tf + self._k1 * (1 - self._b + self._b * doc_len / self._avgdl)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (self._k1 + 1) / denominator
+                matched_idf[chunk_id] = matched_idf.get(chunk_id, 0.0) + idf
+
+        query_vector = self._embed_query(query)
+        if query_vector is not None:
+            similarities = self._embeddings @ query_vector
+            max_bm25 = max(scores.values()) if scores else 1.0
+            candidates = set(scores) | set(int(i) for i in similarities.argsort()[-top_k:])
+            combined = {
+                chunk_id: (1 - DENSE_WEIGHT) * scores.get(chunk_id, 0.0) / max_bm25
+                + DENSE_WEIGHT * max(float(similarities[chunk_id]), 0.0)
+                for chunk_id in candidates
+            }
+        else:
+            similarities = None
+            combined = scores
+
+        ranked = sorted(combined, key=combined.get, reverse=True)[:top_k]
+        if not ranked:
+            return {"results": [], "confidence": 0.0}
+
+        best = ranked[0]
+        confidence = matched_idf.get(best, 0.0) / total_idf if total_idf else 0.0
+        if similarities is not None:
+            confidence = (1 - DENSE_WEIGHT) * confidence + DENSE_WEIGHT * max(float(similarities[best]), 0.0)
+
+        results = [
+            {
+                "content": self._chunk_text(chunk_id),
+                "source": self._sources[self._chunks[chunk_id][2]],
+                "score": round(combined[chunk_id], 4),
+            }
+            for chunk_id in ranked
+        ]
+        return {"results": results, "confidence": round(confidence, 4)}
+
+
+def _mmap_file(file_obj):
+    """Memory-maps a file read-only. Empty files cannot be mapped, so they map to b''."""
+    if os.fstat(file_obj.fileno()).st_size == 0:
+        return b""
+    return mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+_local_index = None
+_local_index_loaded = False
+
+
+def get_local_index() -> Optional[LocalSchemeIndex]:
+    """
+    Loads and returns the local index, ensuring it's only loaded once per
+    process. Returns None if no index has been built.
+    """
+    global _local_index, _local_index_loaded
+    if not _local_index_loaded:
+        _local_index_loaded = True
+        if os.path.exists(os.path.join(DEFAULT_INDEX_DIR, "index.json")):
+            try:
+                _local_index = LocalSchemeIndex(DEFAULT_INDEX_DIR)
+                print(f"[Scheme Agent] Loaded local index with {len(_local_index)} chunks from {DEFAULT_INDEX_DIR}.")
+            except Exception as e:
+                logging.error(f"Failed to load local scheme index: {e}")
+        else:
+            print(f"[Scheme Agent] No local index found at {DEFAULT_INDEX_DIR}. Using the remote corpus only.")
+    return _local_index
@@ -0,0 +1,215 @@
+"""
+A two-tier cache for scheme retrieval results.
+
+Scheme questions repeat constantly across users and languages, so the final,
+post-processed output of `query_schemes_and_loans_kb` is cached under a key
+built from the normalized query text, the corpus id and the retrieval config.
+
+- Tier 1 is an in-process LRU with a TTL.
+- Tier 2 is a Firestore collection shared by all agent instances. Its
+  `expires_at` field can be used as a Firestore TTL policy field.
+
+Re-indexing the corpus invalidates every entry: the corpus version (from
+`SCHEME_CORPUS_VERSION`) and the local index build id are both part of the key,
+and `invalidate()` clears the in-process tier and purges stale shared entries.
+`build_scheme_index.py` and `deploy.py` call it after re-indexing and deploying.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from google.cloud import firestore
+from sub_agents.scheme_analysis_agent.local_index import tokenize
+
+PROJECT_ID = os.environ.get("GCP_PROJECT", "valued-mediator-461216-k7")
+DATABASE = os.environ.get("FIRESTORE_DATABASE", "one4farmers")
+CACHE_COLLECTION = "scheme_retrieval_cache"
+
+# Bump this (or set it at deploy time) whenever the RAG corpus is re-indexed.
+CORPUS_VERSION = os.environ.get("SCHEME_CORPUS_VERSION", "1")
+CACHE_TTL_SECONDS = int(os.environ.get("SCHEME_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+CACHE_MAX_ENTRIES = int(os.environ.get("SCHEME_CACHE_MAX_ENTRIES", "1024"))
+SHARED_CACHE_ENABLED = os.environ.get("SCHEME_CACHE_SHARED", "true").lower() == "true"
+# Log the hit rate every N lookups.
+STATS_LOG_INTERVAL = 100
+
+
+def _transliterate(text: str) -> str:
+    """
+    Transliterates Devanagari and Tamil text to Latin so that the same question
+    typed in either script maps to one key. Uses `indic_transliteration` when it
+    is installed, and otherwise leaves the text unchanged.
+    """
+    try:
+        from indic_transliteration import sanscript
+        from indic_transliteration.sanscript import transliterate
+    except ImportError:
+        return text
+
+    for script, low, high in ((sanscript.DEVANAGARI, 0x0900, 0x097F), (sanscript.TAMIL, 0x0B80, 0x0BFF)):
+        if any(low <= ord(ch) <= high for ch in text):
+            text = transliterate(text, script, sanscript.ITRANS)
+    return text
+
+
+def normalize_query(query: str) -> str:
+    """
+    Reduces a query to a canonical form: transliterated, lowercased and free of
+    stop-words. Word order is kept, since it can change the meaning of a question.
+    """
+    text = unicodedata.normalize("NFKC", query)
+    text = _transliterate(text).lower()
+    # Strip accents left over from transliteration (e.g. 'ā' -> 'a').
+    text = "".join(ch for ch in unicodedata.normalize("NFKD", text) if not unicodedata.combining(ch))
+    return " ".join(tokenize(text))
+
+
+def make_cache_key(query: str, corpus_id: str, retrieval_config: dict) -> Optional[str]:
+    """
+    Builds a stable cache key from the normalized query, the corpus and the
+    retrieval config. Returns None for a query made only of stop-words, which
+    must not share one cached answer.
+    """
+    normalized = normalize_query(query)
+    if not normalized:
+        return None
+    payload = json.dumps(
+        {
+            "query": normalized,
+            "corpus": corpus_id,
+            "corpus_version": CORPUS_VERSION,
+            "config": retrieval_config,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class RetrievalCache:
+    """An in-process TTL + LRU cache backed by an optional shared Firestore tier."""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl_seconds: int = CACHE_TTL_SECONDS,
+                 shared: bool = SHARED_CACHE_ENABLED):
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._shared = shared
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._stats = {"local_hits": 0, "shared_hits": 0, "misses": 0, "evictions": 0}
+
+    def _get_db(self):
+        if self._db is None:
+            self._db = firestore.Client(project=PROJECT_ID, database=DATABASE)
+        return self._db
+
+    def _record(self, outcome: str) -> None:
+        with self._lock:
+            self._stats[outcome] += 1
+            lookups = self._stats["local_hits"] + self._stats["shared_hits"] + self._stats["misses"]
+        if lookups % STATS_LOG_INTERVAL == 0:
+            print(f"[Scheme Cache] {self.stats()}")
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters and the overall hit rate."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["local_hits"] + stats["shared_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["local_hits"] + stats["shared_hits"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+    def _put_local(self, key: str, value: dict, expires_at: float) -> None:
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def get(self, key: str) -> Optional[dict]:
+        """Returns the cached value for `key`, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+            elif entry:
+                del self._entries[key]
+                entry = None
+        if entry:
+            self._record("local_hits")
+            return entry[1]
+
+        if self._shared:
+            try:
+                doc = self._get_db().collection(CACHE_COLLECTION).document(key).get()
+                if doc.exists:
+                    data = doc.to_dict()
+                    expires_at = data["expires_at"].timestamp()
+                    if expires_at > now and data.get("corpus_version") == CORPUS_VERSION:
+                        value = json.loads(data["value"])
+                        self._put_local(key, value, expires_at)
+                        self._record("shared_hits")
+                        return value
+            except Exception as e:
+                logging.warning(f"[Scheme Cache] Shared cache read failed: {e}")
+
+        self._record("misses")
+        return None
+
+    def set(self, key: str, value: dict) -> None:
+        """Stores `value` in both tiers."""
+        expires_at = time.time() + self._ttl_seconds
+        self._put_local(key, value, expires_at)
+
+        if self._shared:
+            try:
+                self._get_db().collection(CACHE_COLLECTION).document(key).set({
+                    # Stored as a JSON string to keep arbitrary nesting out of Firestore's index.
+                    "value": json.dumps(value, ensure_ascii=False),
+                    "corpus_version": CORPUS_VERSION,
+                    "expires_at": datetime.now(timezone.utc) + timedelta(seconds=self._ttl_seconds),
+                })
+            except Exception as e:
+                logging.warning(f"[Scheme Cache] Shared cache write failed: {e}")
+
+    def invalidate(self, all_versions: bool = False) -> int:
+        """
+        Clears the in-process tier and deletes shared entries written for any
+        other corpus version, or every shared entry with `all_versions`. Call
+        this after re-indexing the corpus.
+
+        Returns:
+            The number of shared entries deleted.
+        """
+        with self._lock:
+            self._entries.clear()
+
+        if not self._shared:
+            return 0
+
+        deleted = 0
+        db = self._get_db()
+        batch = db.batch()
+        for doc in db.collection(CACHE_COLLECTION).stream():
+            if all_versions or doc.to_dict().get("corpus_version") != CORPUS_VERSION:
+                batch.delete(doc.reference)
+                deleted += 1
+                # Firestore batches are limited to 500 writes.
+                if deleted % 500 == 0:
+                    batch.commit()
+                    batch = db.batch()
+        batch.commit()
+        print(f"[Scheme Cache] Invalidated local tier and deleted {deleted} stale shared entries.")
+        return deleted
+
+
+retrieval_cache = RetrievalCache()
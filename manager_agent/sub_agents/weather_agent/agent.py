@@ -1,4 +1,5 @@
 from google.adk.agents import Agent
+from routing.model_tiers import apply_model_tier, get_model, record_model_usage
 import requests
 import datetime
 from google.adk.tools.tool_context import ToolContext
@@ -63,7 +64,7 @@ def get_weather_forecast(
 
 weather_agent = Agent(
     name="weather_agent",
-    model="gemini-2.5-pro",
+    model=get_model("weather_agent"),
     description="Provides weather-based farming tips, including crop suitability and protective measures.",
     instruction="""
     You are a specialized agricultural meteorologist. Your purpose is to provide farmers with actionable advice based on weather data obtained from your tools.
@@ -105,4 +106,6 @@ weather_agent = Agent(
     Always structure your answers clearly with headings and bullet points for easy readability.
     """,
     tools=[get_weather_forecast],
+    before_model_callback=apply_model_tier,
+    after_model_callback=record_model_usage,
 )
\ No newline at end of file